@@ -6,24 +6,62 @@
 @email: rxy216@case.edu
 @time: 4/11/24 11:48
 """
-import boto3
-import redis
 from boto3.dynamodb.conditions import Key
+import json
 import logging
 import os
+import threading
+import time
+from collections import Counter
+from ClientRegistry import get_dynamodb_table, get_redis_client
+from TTLCache import TTLCache
+from Metrics import CACHE_REQUESTS
 
 logging.basicConfig(level=logging.INFO)
 
+# the local tier is short lived so prompt edits still reach the workers quickly
+PROMPT_LOCAL_CACHE_SIZE = int(os.getenv("PROMPT_LOCAL_CACHE_SIZE", "512"))
+PROMPT_LOCAL_CACHE_TTL = int(os.getenv("PROMPT_LOCAL_CACHE_TTL", "300"))
+PROMPT_REDIS_CACHE_TTL = 7200
+# agents used by a feedback job within this window count as active and are kept warm
+PROMPT_ACTIVE_AGENT_WINDOW = int(os.getenv("PROMPT_ACTIVE_AGENT_WINDOW", "7200"))
+ACTIVE_AGENTS_KEY = "prepit_active_agents"
+
 
 class AgentPromptHandler:
+    """
+    Agent prompts are read through two cache tiers: an in-process LRU holding the raw and the parsed
+    prompt, then redis, and only then DynamoDB. Concurrent misses on the same prompt in this process
+    share one DynamoDB query.
+    """
     DYNAMODB_TABLE_NAME = "prepit_agent_prompt"
 
     def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-2',
-                                       aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID_DYNAMODB"),
-                                       aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY_DYNAMODB"))
-        self.table = self.dynamodb.Table(self.DYNAMODB_TABLE_NAME)
-        self.redis_client = redis.Redis(host=os.getenv("REDIS_ADDRESS"), port=6379, protocol=3, decode_responses=True)
+        self.redis_client = get_redis_client()
+        # (agent_id, step) -> (raw prompt, parsed prompt)
+        self.local_cache = TTLCache(PROMPT_LOCAL_CACHE_SIZE, PROMPT_LOCAL_CACHE_TTL)
+        self._inflight_loads: dict[tuple[str, str], threading.Lock] = {}
+        self._inflight_loads_lock = threading.Lock()
+        # local_hit, redis_hit, db_hit and db_miss counts of prompt lookups
+        self.cache_stats = Counter()
+        self._cache_stats_lock = threading.Lock()
+
+    def __count(self, stat: str, count: int = 1):
+        with self._cache_stats_lock:
+            self.cache_stats[stat] += count
+        CACHE_REQUESTS.labels("agent_prompt", stat).inc(count)
+
+    def get_cache_stats(self) -> dict:
+        """
+        Get the prompt cache counters of this process.
+        :return: The local_hit, redis_hit, db_hit and db_miss counts.
+        """
+        with self._cache_stats_lock:
+            return dict(self.cache_stats)
+
+    @property
+    def table(self):
+        return get_dynamodb_table(self.DYNAMODB_TABLE_NAME)
 
     def put_agent_prompt(self, agent_id: str, prompt: str, step: str) -> bool:
         """
@@ -42,6 +80,7 @@ class AgentPromptHandler:
                 }
             )
             self.__cache_agent_prompt(agent_id, prompt, step)
+            self.__cache_locally(agent_id, str(step), prompt)
             return True
         except Exception as e:
             logging.error(f"Error putting the agent prompt into the database: {e}")
@@ -54,47 +93,148 @@ class AgentPromptHandler:
         :param step: The step of the agent.
         :return: The prompt of the agent.
         """
-        cached_prompt = self.__get_cached_agent_prompt(agent_id, step)
-        if cached_prompt:
-            logging.info(f"Cache hit, getting the agent prompt from the cache. {agent_id}")
-            return cached_prompt
-        # if cache miss, get the prompt from the database, and cache it
-        logging.info(f"Cache miss, getting the agent prompt from the database. {agent_id}")
-        try:
-            response = self.table.query(
-                KeyConditionExpression=Key('agent_id').eq(agent_id) & Key('step').eq(str(step))
-            )
-            if response['Items']:
-                prompt = response['Items'][0]['prompt']
-                self.__cache_agent_prompt(agent_id, prompt, step)
-                return prompt
+        entry = self.__get_agent_prompt_entries(agent_id, [str(step)])[str(step)]
+        return entry[0] if entry else None
+
+    def get_agent_prompts(self, agent_id: str, steps: list[str]) -> dict[str, dict | None]:
+        """
+        Get several parsed agent prompts at once, with a single redis round trip for the local cache misses.
+        The returned dicts are shared with the cache and must not be modified.
+        :param agent_id: The ID of the agent.
+        :param steps: The steps of the agent.
+        :return: A dict mapping each step to its parsed prompt, None if it does not exist.
+        """
+        entries = self.__get_agent_prompt_entries(agent_id, [str(step) for step in steps])
+        return {step: entry[1] if entry else None for step, entry in entries.items()}
+
+    def __get_agent_prompt_entries(self, agent_id: str, steps: list[str]) -> dict[str, tuple | None]:
+        entries = {step: self.local_cache.get((agent_id, step)) for step in steps}
+        local_misses = [step for step, entry in entries.items() if entry is None]
+        self.__count("local_hit", len(entries) - len(local_misses))
+        if not local_misses:
+            logging.debug(f"Local cache hit, getting the agent prompts from memory. {agent_id}")
+            return entries
+        cached_prompts = self.__get_cached_agent_prompts(agent_id, local_misses)
+        for step, prompt in zip(local_misses, cached_prompts):
+            if prompt:
+                logging.debug(f"Cache hit, getting the agent prompt from the cache. {agent_id}")
+                self.__count("redis_hit")
+                entries[step] = self.__cache_locally(agent_id, step, prompt)
             else:
-                return None
+                # if cache miss, get the prompt from the database, and cache it
+                logging.debug(f"Cache miss, getting the agent prompt from the database. {agent_id}")
+                entries[step] = self.__load_agent_prompt(agent_id, step)
+        return entries
+
+    def __load_agent_prompt(self, agent_id: str, step: str) -> tuple | None:
+        """
+        Load the agent prompt from the database. Only one thread queries per prompt,
+        the others wait for it and then read its result from the local cache.
+        """
+        key = (agent_id, step)
+        with self._inflight_loads_lock:
+            load_lock = self._inflight_loads.setdefault(key, threading.Lock())
+        try:
+            with load_lock:
+                entry = self.local_cache.get(key)
+                if entry is not None:
+                    return entry
+                response = self.table.query(
+                    KeyConditionExpression=Key('agent_id').eq(agent_id) & Key('step').eq(str(step))
+                )
+                if response['Items']:
+                    self.__count("db_hit")
+                    prompt = response['Items'][0]['prompt']
+                    self.__cache_agent_prompt(agent_id, prompt, step)
+                    return self.__cache_locally(agent_id, step, prompt)
+                else:
+                    self.__count("db_miss")
+                    return None
         except Exception as e:
             logging.error(f"Error getting the agent prompt from the database: {e}")
             return None
+        finally:
+            with self._inflight_loads_lock:
+                if self._inflight_loads.get(key) is load_lock:
+                    del self._inflight_loads[key]
+
+    def __cache_locally(self, agent_id: str, step: str, prompt: str) -> tuple:
+        """
+        Parse the prompt once and keep both forms in the local cache.
+        """
+        try:
+            parsed_prompt = json.loads(prompt)
+        except ValueError:
+            logging.error(f"Agent prompt of agent {agent_id} at step {step} is not valid JSON")
+            parsed_prompt = None
+        entry = (prompt, parsed_prompt)
+        self.local_cache.set((agent_id, step), entry)
+        return entry
 
     def cache_agent_all_steps(self, agent_id: str) -> bool:
         """
-        Cache all the agent prompts into redis.
+        Cache all the agent prompts into redis, following DynamoDB pagination,
+        and write them with a single pipelined round trip.
         :param agent_id: The ID of the agent.
         :return: True if successful, False otherwise.
         """
         try:
-            response = self.table.query(
-                KeyConditionExpression=Key('agent_id').eq(agent_id)
-            )
-            if response['Items']:
-                for item in response['Items']:
-                    self.__cache_agent_prompt(agent_id, item['prompt'], item['step'])
-                    logging.info(f"Cached agent prompt for agent {agent_id} at step {item['step']}")
-                return True
-            else:
+            items = []
+            query_kwargs = {'KeyConditionExpression': Key('agent_id').eq(agent_id)}
+            while True:
+                response = self.table.query(**query_kwargs)
+                items.extend(response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            if not items:
                 return False
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for item in items:
+                pipeline.set(f"{agent_id}_{item['step']}", item['prompt'], ex=PROMPT_REDIS_CACHE_TTL)
+                self.__cache_locally(agent_id, str(item['step']), item['prompt'])
+            pipeline.execute()
+            logging.info(f"Cached {len(items)} agent prompts for agent {agent_id}")
+            return True
         except Exception as e:
             logging.error(f"Error caching all prompts for agent into redis: {e}")
             return False
 
+    def mark_agent_active(self, agent_id: str):
+        """
+        Record that the agent is used by an ongoing interview, so the cache warmer keeps its prompts warm.
+        :param agent_id: The ID of the agent.
+        """
+        try:
+            self.redis_client.zadd(ACTIVE_AGENTS_KEY, {agent_id: time.time()})
+        except Exception as e:
+            logging.error(f"Error marking agent {agent_id} as active: {e}")
+
+    def get_active_agents(self) -> list[str]:
+        """
+        Get the agents used within the active agent window, and forget the older ones.
+        :return: The IDs of the active agents.
+        """
+        try:
+            cutoff = time.time() - PROMPT_ACTIVE_AGENT_WINDOW
+            self.redis_client.zremrangebyscore(ACTIVE_AGENTS_KEY, "-inf", cutoff)
+            return list(self.redis_client.zrangebyscore(ACTIVE_AGENTS_KEY, cutoff, "+inf"))
+        except Exception as e:
+            logging.error(f"Error getting the active agents: {e}")
+            return []
+
+    def warm_cache(self, extra_agent_ids: list[str] | None = None) -> int:
+        """
+        Preload the prompts of all active agents, and of extra_agent_ids, into redis and the local cache.
+        :param extra_agent_ids: Agents to warm regardless of their activity.
+        :return: The number of agents warmed.
+        """
+        agent_ids = set(self.get_active_agents()) | set(extra_agent_ids or [])
+        warmed = sum(self.cache_agent_all_steps(agent_id) for agent_id in agent_ids)
+        logging.info(f"Warmed the prompt cache for {warmed}/{len(agent_ids)} agents, "
+                     f"cache stats: {self.get_cache_stats()}")
+        return warmed
+
     def __cache_agent_prompt(self, agent_id: str, prompt: str, step: str) -> bool:
         """
         Cache the agent prompt into redis. Expire in 2 hours.
@@ -104,19 +244,41 @@ class AgentPromptHandler:
         :return: True if successful, False otherwise.
         """
         try:
-            self.redis_client.set(f"{agent_id}_{step}", prompt, ex=7200)
+            self.redis_client.set(f"{agent_id}_{step}", prompt, ex=PROMPT_REDIS_CACHE_TTL)
             return True
         except Exception as e:
             logging.error(f"Error caching the agent prompt into redis: {e}")
             return False
 
-    def __get_cached_agent_prompt(self, agent_id: str, step: str) -> str | None:
+    def __get_cached_agent_prompts(self, agent_id: str, steps: list[str]) -> list[str | None]:
         """
-        Get the agent prompt from redis.
+        Get the agent prompts of several steps from redis in one MGET.
         :param agent_id: The ID of the agent.
+        :param steps: The steps of the agent.
+        :return: The prompts in the order of steps, None for the ones not cached.
         """
         try:
-            return self.redis_client.get(f"{agent_id}_{step}")
+            return self.redis_client.mget([f"{agent_id}_{step}" for step in steps])
         except Exception as e:
             logging.error(f"Error getting the agent prompt from redis cache: {e}")
-            return None
+            return [None] * len(steps)
+
+
+class PromptCacheWarmer(threading.Thread):
+    """
+    Background thread warming the prompt cache at startup and then periodically.
+    """
+
+    def __init__(self, handler: AgentPromptHandler, interval: float, extra_agent_ids: list[str] | None = None):
+        super().__init__(name="prompt-cache-warmer", daemon=True)
+        self.handler = handler
+        self.interval = interval
+        self.extra_agent_ids = extra_agent_ids
+
+    def run(self):
+        while True:
+            try:
+                self.handler.warm_cache(self.extra_agent_ids)
+            except Exception as e:
+                logging.error(f"Error warming the prompt cache: {e}")
+            time.sleep(self.interval)
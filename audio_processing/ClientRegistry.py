@@ -0,0 +1,127 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: ClientRegistry.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 15:40
+"""
+import os
+import threading
+from typing import Callable, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="/run/secrets/prepit-secret")
+
+AWS_REGION = "us-east-2"
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+# concurrent S3 requests of all uploads of a process together
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "16"))
+DYNAMODB_MAX_POOL_CONNECTIONS = int(os.getenv("DYNAMODB_MAX_POOL_CONNECTIONS", "32"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+
+T = TypeVar("T")
+
+# process wide clients, created on first use so a replica only pays for what it actually handles.
+# The SDK imports are deferred to first use as well, they dominate worker startup time
+_shared: dict[str, object] = {}
+_shared_lock = threading.Lock()
+# boto3 resources are not thread-safe, so every thread gets its own
+_thread_local = threading.local()
+
+
+def _reset_after_fork():
+    # sockets and locks inherited from the parent must never be used by the child
+    global _shared_lock, _thread_local
+    _shared.clear()
+    _shared_lock = threading.Lock()
+    _thread_local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_shared(name: str, factory: Callable[[], T]) -> T:
+    """
+    Get the process wide instance registered under name, creating it with factory on first use.
+    Instances are dropped in forked children, which lazily create their own.
+    :param name: The name of the instance.
+    :param factory: Creates the instance, only called once per process.
+    :return: The shared instance.
+    """
+    instance = _shared.get(name)
+    if instance is None:
+        with _shared_lock:
+            instance = _shared.get(name)
+            if instance is None:
+                instance = _shared[name] = factory()
+    return instance
+
+
+def get_s3_client():
+    import boto3
+    from botocore.config import Config
+    return get_shared("s3", lambda: boto3.client(
+        's3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                            retries={'mode': 'adaptive', 'max_attempts': 5})))
+
+
+def get_s3_transfer_manager():
+    from boto3.s3.transfer import TransferConfig, create_transfer_manager
+    # one pool of upload threads per process, shared by every upload. Clips are small, so only really large
+    # files are split into parts
+    return get_shared("s3_transfer_manager", lambda: create_transfer_manager(get_s3_client(), TransferConfig(
+        multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=S3_UPLOAD_CONCURRENCY, use_threads=True)))
+
+
+def _create_dynamodb_resource():
+    import boto3
+    from botocore.config import Config
+    return boto3.resource('dynamodb', region_name=AWS_REGION,
+                          aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID_DYNAMODB"),
+                          aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY_DYNAMODB"),
+                          config=Config(max_pool_connections=DYNAMODB_MAX_POOL_CONNECTIONS))
+
+
+def get_dynamodb_resource():
+    """
+    Get this thread's DynamoDB resource. Its meta.client is thread-safe and may be shared.
+    """
+    resource = getattr(_thread_local, "dynamodb", None)
+    if resource is None:
+        resource = _thread_local.dynamodb = _create_dynamodb_resource()
+    return resource
+
+
+def get_dynamodb_table(table_name: str):
+    """
+    Get this thread's Table object for table_name.
+    """
+    tables = getattr(_thread_local, "dynamodb_tables", None)
+    if tables is None:
+        tables = _thread_local.dynamodb_tables = {}
+    if table_name not in tables:
+        tables[table_name] = get_dynamodb_resource().Table(table_name)
+    return tables[table_name]
+
+
+def get_redis_client():
+    import redis
+    # blocks for a free connection instead of failing when every pooled connection is busy
+    return get_shared("redis", lambda: redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        host=os.getenv("REDIS_ADDRESS"), port=6379, protocol=3, decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS, timeout=5)))
+
+
+def get_async_openai_client():
+    from openai import AsyncOpenAI
+    # retries are handled by FeedbackLLMClient, with its own backoff and budget
+    return get_shared("async_openai", lambda: AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0))
+
+
+def get_async_anthropic_client():
+    from anthropic import AsyncAnthropic
+    return get_shared("async_anthropic", lambda: AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"),
+                                                                max_retries=0))
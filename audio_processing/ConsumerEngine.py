@@ -0,0 +1,343 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: ConsumerEngine.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 13:20
+"""
+import functools
+import json
+import multiprocessing
+import time
+from datetime import datetime, timezone
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Callable
+
+import pika
+
+RETRY_COUNT_HEADER = "x-retry-count"
+# how often a message was redelivered after losing its consumer, the broker's redelivered flag does not tell
+REDELIVERY_COUNT_HEADER = "x-redelivery-count"
+# set by the API's publisher, kept on retries, so the wait also covers the retry delays
+PUBLISHED_AT_HEADER = "x-published-at"
+
+
+class PoisonMessageError(Exception):
+    """Raised for messages that can never succeed, they are dead-lettered without retrying."""
+
+
+@dataclass
+class QueueSpec:
+    name: str
+    prefetch_count: int
+    max_priority: int | None = None  # None declares a plain queue without priority support
+
+    @property
+    def arguments(self) -> dict | None:
+        return {'x-max-priority': self.max_priority} if self.max_priority else None
+
+    def retry_queue(self, attempt: int) -> str:
+        # the .retry.<attempt> queues of earlier versions carried their TTL as a queue argument, they drain on
+        # their own into the task queue and can be deleted
+        return f"{self.name}.backoff.{attempt}"
+
+    @property
+    def dead_letter_queue(self) -> str:
+        return f"{self.name}.dead"
+
+
+class ConsumerEngine:
+    """
+    Consume tasks from one or more RabbitMQ queues and run them concurrently.
+    Every queue gets its own channel and prefetch, so each task class is tuned independently.
+    CPU-bound audio tasks run in a process pool, I/O-bound feedback tasks in a thread pool.
+    The pika connection is only ever touched from the thread running run(),
+    workers hand their acks back to it with add_callback_threadsafe.
+    Failed tasks are retried with exponential backoff through per-attempt delay queues that
+    dead-letter back into the task queue as messages expire; once retries are exhausted, or for poison messages,
+    the message is parked in the queue's dead-letter queue together with the failure reason.
+    How long tasks waited, and how many are ready in each queue, is reported through callbacks.
+    """
+    PROCESS_POOL = "process"
+    THREAD_POOL = "thread"
+
+    def __init__(self, host: str, queues: list[QueueSpec], task_runner: Callable[[dict], None],
+                 pool_sizes: dict[str, int], task_pools: dict[str, str], max_retries: int = 3,
+                 retry_base_delay_ms: int = 10000, non_retryable_errors: tuple = (PoisonMessageError,),
+                 on_dead_letter: Callable[[bytes, BaseException], None] | None = None,
+                 on_redelivered: Callable[[bytes], bool] | None = None,
+                 on_delivery: Callable[[str, float], None] | None = None,
+                 on_queue_stats: Callable[[str, int, int], None] | None = None, queue_stats_interval: float = 15,
+                 preload_modules: list[str] | None = None):
+        """
+        :param host: The RabbitMQ host.
+        :param queues: The queues to consume.
+        :param task_runner: Module level function running one task message, must be picklable.
+        :param pool_sizes: The number of workers for each pool kind.
+        :param task_pools: The pool kind each task type runs in.
+        :param max_retries: How many times a failed task is retried before it is dead-lettered.
+        :param retry_base_delay_ms: The delay before the first retry, doubled on every further attempt.
+        :param non_retryable_errors: Exception types that dead-letter a message immediately.
+        :param on_dead_letter: Called with the message body and the exception when a message is dead-lettered.
+        :param on_redelivered: Called with the message body when a message is redelivered after its consumer was
+                               lost, returns False if the task already completed and the message is dropped.
+                               A message lost more than max_retries times is dead-lettered.
+        :param on_delivery: Called with the queue name and the seconds since the message was published,
+                            for every delivered message that carries its publishing time.
+        :param on_queue_stats: Called every queue_stats_interval seconds with the name, ready message count
+                               and consumer count of every task queue and dead-letter queue.
+        :param queue_stats_interval: Seconds between two queue stats reports.
+        :param preload_modules: Modules imported once by the fork server the process pool workers are forked from,
+                                '__main__' preloads the running script and everything it imports.
+        """
+        self.host = host
+        self.queues = {queue.name: queue for queue in queues}
+        self.max_retries = max_retries
+        self.retry_base_delay_ms = retry_base_delay_ms
+        self.non_retryable_errors = non_retryable_errors
+        self.on_dead_letter = on_dead_letter
+        self.on_redelivered = on_redelivered
+        self.on_delivery = on_delivery
+        self.on_queue_stats = on_queue_stats
+        self.queue_stats_interval = queue_stats_interval
+        self.task_runner = task_runner
+        self.pool_sizes = pool_sizes
+        self.task_pools = task_pools
+        self.preload_modules = preload_modules or []
+        self.executors: dict[str, Executor] = {}
+        self.consumer_queues: dict[str, QueueSpec] = {}
+        self.connection: pika.BlockingConnection | None = None
+        self.stats_channel = None
+        # bodies of the messages this engine put back with a nack, their redelivery is not a lost consumer
+        self.requeued: set[bytes] = set()
+
+    def _create_executor(self, pool_kind: str) -> Executor:
+        if pool_kind == self.PROCESS_POOL:
+            # workers are forked from a single threaded fork server that already imported the audio libraries,
+            # never from this process, whose threads may hold locks a forked child would inherit. That matters
+            # most for the pools replacing a broken one, created while the feedback and connection threads run
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(self.preload_modules)
+            return ProcessPoolExecutor(max_workers=self.pool_sizes[pool_kind], mp_context=context)
+        return ThreadPoolExecutor(max_workers=self.pool_sizes[pool_kind], thread_name_prefix="task-worker")
+
+    def _executor(self, pool_kind: str) -> Executor:
+        if pool_kind not in self.executors:
+            self.executors[pool_kind] = self._create_executor(pool_kind)
+        return self.executors[pool_kind]
+
+    def start_pools(self):
+        """
+        Start the worker pools. Process pools come first, so the fork server is up and has preloaded its
+        modules before the first task arrives.
+        """
+        for pool_kind in sorted(set(self.task_pools.values()), key=lambda kind: kind != self.PROCESS_POOL):
+            executor = self._executor(pool_kind)
+            if pool_kind == self.PROCESS_POOL:
+                # starts the fork server and a first worker
+                executor.submit(int).result()
+
+    def connect(self, retry_interval: float = 5):
+        """
+        Connect to RabbitMQ, retrying until the broker is reachable.
+        """
+        while True:
+            try:
+                self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+                break
+            except Exception as e:
+                print(f"RabbitMQ connection failed {e}, retrying in {retry_interval} seconds")
+                time.sleep(retry_interval)
+        for queue in self.queues.values():
+            channel = self.connection.channel()
+            # retries and dead-letters are republished before the ack, so make sure the broker has them
+            channel.confirm_delivery()
+            self._declare_queue_topology(channel, queue)
+            # prefetch is per channel, so a backlog in one queue never starves the others
+            channel.basic_qos(prefetch_count=queue.prefetch_count)
+            consumer_tag = channel.basic_consume(queue=queue.name, on_message_callback=self._on_message)
+            self.consumer_queues[consumer_tag] = queue
+        if self.on_queue_stats is not None:
+            self._report_queue_stats()
+
+    def run(self):
+        """
+        Block and consume messages until interrupted.
+        """
+        print(f'Waiting for messages in {", ".join(self.queues)}. To exit press CTRL+C')
+        try:
+            # drives the consumers and the deferred acks of every channel on this connection
+            while True:
+                self.connection.process_data_events(time_limit=None)
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True, cancel_futures=True)
+            if self.connection.is_open:
+                self.connection.close()
+
+    def _declare_queue_topology(self, channel, queue: QueueSpec):
+        channel.queue_declare(queue=queue.name, durable=True, arguments=queue.arguments)
+        for attempt in range(1, self.max_retries + 1):
+            # messages wait out their expiration here, then expire back into the task queue. The delay is set per
+            # message, the arguments never change with the retry settings, which the broker would refuse.
+            # Every message of a queue has the same delay, so the one at the head always expires first
+            channel.queue_declare(queue=queue.retry_queue(attempt), durable=True, arguments={
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue.name
+            })
+        channel.queue_declare(queue=queue.dead_letter_queue, durable=True)
+
+    def _report_queue_stats(self):
+        # runs on the connection thread, scheduled by itself
+        try:
+            if self.stats_channel is None or not self.stats_channel.is_open:
+                self.stats_channel = self.connection.channel()
+            for queue in self.queues.values():
+                for name in (queue.name, queue.dead_letter_queue):
+                    result = self.stats_channel.queue_declare(queue=name, passive=True)
+                    self.on_queue_stats(name, result.method.message_count, result.method.consumer_count)
+        except Exception as e:
+            print(f"Error reading queue stats: {e!r}")
+        self.connection.call_later(self.queue_stats_interval, self._report_queue_stats)
+
+    def _on_message(self, ch, method, properties, body):
+        published_at = (properties.headers or {}).get(PUBLISHED_AT_HEADER)
+        if self.on_delivery is not None and published_at is not None:
+            try:
+                self.on_delivery(self._queue_of(method).name, max(0.0, time.time() - float(published_at)))
+            except Exception as e:
+                print(f"Error in delivery callback: {e!r}")
+        try:
+            message = json.loads(body)
+            task_type = message['task_type']
+        except (ValueError, KeyError, TypeError) as e:
+            self._dead_letter(ch, method, properties, body, PoisonMessageError(f"Malformed message: {e!r}"))
+            return
+        pool_kind = self.task_pools.get(task_type)
+        if pool_kind is None:
+            self._dead_letter(ch, method, properties, body, PoisonMessageError(f"Unknown task type {task_type}"))
+            return
+        if method.redelivered and body in self.requeued:
+            self.requeued.discard(body)
+        elif method.redelivered:
+            self._handle_redelivery(ch, method, properties, body)
+            return
+        executor = self._executor(pool_kind)
+        try:
+            future = executor.submit(self.task_runner, message)
+        except BrokenProcessPool:
+            # a worker process died (e.g. OOM killed), replace the whole pool
+            print(f"{pool_kind} pool is broken, recreating it")
+            self._discard_executor(pool_kind, executor)
+            executor = self._executor(pool_kind)
+            future = executor.submit(self.task_runner, message)
+        future.add_done_callback(functools.partial(self._on_task_done, ch, method, properties, body, pool_kind,
+                                                   executor))
+
+    def _handle_redelivery(self, ch, method, properties, body: bytes):
+        # the previous consumer was lost mid-task, in a deploy or a crash, possibly because of this message
+        queue = self._queue_of(method)
+        if self.on_redelivered is not None:
+            try:
+                if not self.on_redelivered(body):
+                    print(f"Dropping redelivered task from {queue.name}, it already completed")
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    return
+            except Exception as e:
+                print(f"Error in redelivery callback: {e!r}")
+        redeliveries = int((properties.headers or {}).get(REDELIVERY_COUNT_HEADER, 0)) + 1
+        if redeliveries > self.max_retries:
+            self._dead_letter(ch, method, properties, body,
+                              RuntimeError(f"Redelivered {redeliveries} times after consumer loss"))
+            return
+        print(f"Requeueing task redelivered to {queue.name}, redelivery {redeliveries}/{self.max_retries}")
+        # without a delay or a retry attempt, the count is carried in the message from now on
+        self._republish(ch, method, properties, body, queue.name, {REDELIVERY_COUNT_HEADER: redeliveries})
+
+    def _discard_executor(self, pool_kind: str, executor: Executor):
+        # only if it is still the registered one, a late failure from a pool that was already replaced
+        # must not shut down its replacement and cancel the tasks queued on it
+        if self.executors.get(pool_kind) is executor:
+            del self.executors[pool_kind]
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_task_done(self, ch, method, properties, body: bytes, pool_kind: str, executor: Executor,
+                      future: Future):
+        # runs on a worker thread, so defer channel work to the connection thread
+        self.connection.add_callback_threadsafe(
+            functools.partial(self._finish_task, ch, method, properties, body, pool_kind, executor, future))
+
+    def _finish_task(self, ch, method, properties, body: bytes, pool_kind: str, executor: Executor,
+                     future: Future):
+        if not ch.is_open:
+            # the broker already requeued everything unacked on this channel
+            return
+        if future.cancelled():
+            # still queued when its broken pool was shut down, it never ran
+            print(f"Task from {self._queue_of(method).name} was cancelled with its pool, requeueing it")
+            self._republish(ch, method, properties, body, self._queue_of(method).name, {})
+            return
+        exception = future.exception()
+        if exception is None:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        print(f"Error processing task from {self._queue_of(method).name}: {exception!r}")
+        if isinstance(exception, BrokenProcessPool):
+            # the next submit gets a fresh pool
+            self._discard_executor(pool_kind, executor)
+        if isinstance(exception, self.non_retryable_errors):
+            self._dead_letter(ch, method, properties, body, exception)
+        else:
+            self._handle_failure(ch, method, properties, body, exception)
+
+    def _handle_failure(self, ch, method, properties, body: bytes, exception: BaseException):
+        headers = properties.headers or {}
+        attempt = int(headers.get(RETRY_COUNT_HEADER, 0)) + 1
+        if attempt > self.max_retries:
+            self._dead_letter(ch, method, properties, body, exception)
+            return
+        queue = self._queue_of(method)
+        delay_ms = self.retry_base_delay_ms * 2 ** (attempt - 1)
+        print(f"Retrying task from {queue.name} in {delay_ms} ms, attempt {attempt}/{self.max_retries}")
+        # back in the task queue after the delay, behind the fresh tasks. The broker drops the expiration
+        # when it dead-letters the expired message there
+        self._republish(ch, method, properties, body, queue.retry_queue(attempt), {RETRY_COUNT_HEADER: attempt},
+                        priority=0, expiration=str(delay_ms))
+
+    def _dead_letter(self, ch, method, properties, body: bytes, exception: BaseException):
+        queue = self._queue_of(method)
+        print(f"Dead-lettering task from {queue.name}: {exception!r}")
+        self._republish(ch, method, properties, body, queue.dead_letter_queue, {
+            'x-failure-reason': repr(exception)[:1024],
+            'x-failure-type': type(exception).__name__,
+            'x-failed-at': datetime.now(timezone.utc).isoformat(),
+            'x-original-queue': queue.name
+        })
+        if self.on_dead_letter is not None:
+            try:
+                self.on_dead_letter(body, exception)
+            except Exception as e:
+                print(f"Error in dead-letter callback: {e!r}")
+
+    def _queue_of(self, method) -> QueueSpec:
+        return self.consumer_queues[method.consumer_tag]
+
+    def _republish(self, ch, method, properties, body: bytes, routing_key: str, extra_headers: dict,
+                   priority: int | None = None, expiration: str | None = None):
+        headers = dict(properties.headers or {})
+        headers.update(extra_headers)
+        try:
+            ch.basic_publish(exchange='', routing_key=routing_key, body=body,
+                             properties=pika.BasicProperties(
+                                 delivery_mode=2, priority=properties.priority if priority is None else priority,
+                                 headers=headers, expiration=expiration))
+        except Exception as e:
+            # could not hand the message over, let the broker redeliver it instead of losing it
+            print(f"Error republishing task to {routing_key}: {e}")
+            self.requeued.add(body)
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -0,0 +1,51 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: EventPublishHandler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 21:40
+"""
+import json
+import logging
+import time
+
+from ClientRegistry import get_redis_client, get_shared
+
+# the channel layout is shared with the API's event stream, one channel per thread
+EVENTS_CHANNEL_PREFIX = "prepit_events:"
+
+
+class EventPublishHandler:
+    """
+    Publishes progress events of a thread, e.g. a clip or a feedback being ready, to redis pub/sub.
+    The API streams them to the clients listening on that thread. Events are best effort: nobody
+    listening, or redis being down, never fails a job, and clients catch up through the job status.
+    """
+
+    def __init__(self):
+        self.redis_client = get_redis_client()
+
+    def publish(self, thread_id: str, event: str, data: dict) -> bool:
+        """
+        Publish an event of a thread.
+        :param thread_id: The ID of the thread.
+        :param event: The event type, e.g. 'clip_ready'.
+        :param data: The event payload.
+        :return: True if published, False otherwise.
+        """
+        try:
+            self.redis_client.publish(EVENTS_CHANNEL_PREFIX + thread_id, json.dumps({
+                'event': event,
+                'thread_id': thread_id,
+                'time': time.time(),
+                **data
+            }))
+            return True
+        except Exception as e:
+            logging.error(f"Error publishing {event} event of thread {thread_id}: {e}")
+            return False
+
+
+def publish_event(thread_id: str, event: str, data: dict) -> bool:
+    return get_shared("event_publish_handler", EventPublishHandler).publish(thread_id, event, data)
@@ -0,0 +1,280 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: FeedbackLLMClient.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 17:45
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+
+from ClientRegistry import get_async_openai_client, get_async_anthropic_client
+from Metrics import LLM_FAILURES, LLM_REQUEST_DURATION, LLM_TOKENS
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))
+# a stream that stays silent this long is treated as stalled and retried
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_REQUESTS_PER_SECOND = float(os.getenv("LLM_REQUESTS_PER_SECOND", "5"))
+LLM_LATENCY_WINDOW = 200  # number of recent calls the latency stats are computed over
+
+
+class LLMRetryableError(Exception):
+    """A failed call that is worth retrying, e.g. a timeout, a rate limit or a server error."""
+
+
+@dataclass
+class LLMResult:
+    text: str
+    provider: str
+    model: str
+    input_tokens: int
+    output_tokens: int
+    latency: float
+    time_to_first_token: float | None
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket, refilled continuously at rate tokens per second up to capacity.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class LLMProvider(ABC):
+    """
+    A streaming LLM backend. Subclasses implement stream(), which yields text chunks
+    and records token usage on the usage dict it is given.
+    """
+    name = ""
+
+    def __init__(self, model: str):
+        self.model = model
+
+    @abstractmethod
+    def stream(self, system_prompt: str, user_prompt: str, usage: dict):
+        """
+        Stream the completion of a prompt.
+        :param system_prompt: system prompt
+        :param user_prompt: user prompt
+        :param usage: dict the input and output token counts are recorded on
+        :return: async iterator of text chunks
+        """
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    async def stream(self, system_prompt: str, user_prompt: str, usage: dict):
+        import openai
+        try:
+            stream = await get_async_openai_client().chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    usage['input_tokens'] = chunk.usage.prompt_tokens
+                    usage['output_tokens'] = chunk.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError) as e:
+            raise LLMRetryableError(f"{self.name}: {e!r}") from e
+
+
+class AnthropicProvider(LLMProvider):
+    name = "anthropic"
+
+    async def stream(self, system_prompt: str, user_prompt: str, usage: dict):
+        import anthropic
+        try:
+            async with get_async_anthropic_client().messages.stream(
+                model=self.model,
+                system=system_prompt,
+                messages=[{"role": "user", "content": user_prompt}],
+                max_tokens=1024
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield text
+                final_message = await stream.get_final_message()
+                usage['input_tokens'] = final_message.usage.input_tokens
+                usage['output_tokens'] = final_message.usage.output_tokens
+        except (anthropic.APIConnectionError, anthropic.RateLimitError, anthropic.InternalServerError) as e:
+            raise LLMRetryableError(f"{self.name}: {e!r}") from e
+
+
+class StubProvider(LLMProvider):
+    """
+    Local stand-in for an LLM, for trying out provider routing without any API key.
+    Answers after latency seconds (plus up to jitter seconds) and fails with failure_rate probability.
+    """
+
+    def __init__(self, name: str, latency: float = 0.5, jitter: float = 0.5, failure_rate: float = 0.0):
+        super().__init__(model=f"{name}-model")
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    async def stream(self, system_prompt: str, user_prompt: str, usage: dict):
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.failure_rate:
+            raise LLMRetryableError(f"{self.name}: simulated failure")
+        usage['input_tokens'] = len(system_prompt.split()) + len(user_prompt.split())
+        usage['output_tokens'] = 2
+        yield f"{self.name} "
+        yield "feedback"
+
+
+class FeedbackLLMClient:
+    """
+    Runs LLM calls on a dedicated asyncio event loop thread, so any number of worker threads can keep
+    requests in flight without holding a thread per socket. Every provider gets its own concurrency
+    limit and request rate limit, and every call a timeout and jittered exponential retries.
+    Latency and token usage are tracked per provider.
+    """
+
+    def __init__(self, providers: list[LLMProvider]):
+        self.providers = {provider.name: provider for provider in providers}
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True)
+        self._loop_thread.start()
+        self._semaphores = {name: asyncio.Semaphore(LLM_MAX_CONCURRENCY) for name in self.providers}
+        self._rate_limiters = {name: TokenBucket(LLM_REQUESTS_PER_SECOND, max(1.0, LLM_REQUESTS_PER_SECOND))
+                               for name in self.providers}
+        self._stats_lock = threading.Lock()
+        self._latencies = {name: deque(maxlen=LLM_LATENCY_WINDOW) for name in self.providers}
+        self._counters = {name: {"calls": 0, "errors": 0, "retries": 0, "input_tokens": 0, "output_tokens": 0}
+                          for name in self.providers}
+
+    def generate(self, provider_name: str, system_prompt: str, user_prompt: str) -> LLMResult:
+        """
+        Generate a completion, blocking the calling thread but not the event loop.
+        :param provider_name: The provider to use.
+        :param system_prompt: The system prompt.
+        :param user_prompt: The user prompt.
+        :return: The generated text with its usage and latency.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.agenerate(provider_name, system_prompt, user_prompt), self.loop).result()
+
+    async def agenerate(self, provider_name: str, system_prompt: str, user_prompt: str) -> LLMResult:
+        """
+        Generate a completion, must be awaited on this client's event loop.
+        """
+        provider = self.providers[provider_name]
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with self._semaphores[provider_name]:
+                    await self._rate_limiters[provider_name].acquire()
+                    result = await asyncio.wait_for(self._stream(provider, system_prompt, user_prompt), LLM_TIMEOUT)
+                self._record(result)
+                return result
+            except (LLMRetryableError, asyncio.TimeoutError) as e:
+                self._count(provider_name, "errors")
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                # full jitter, so requests that failed together do not retry together
+                delay = random.uniform(0, LLM_RETRY_BASE_DELAY * 2 ** attempt)
+                logging.warning(f"LLM call to {provider_name} failed ({e!r}), retrying in {delay:.1f}s")
+                self._count(provider_name, "retries")
+                await asyncio.sleep(delay)
+            except Exception:
+                self._count(provider_name, "errors")
+                raise
+
+    async def _stream(self, provider: LLMProvider, system_prompt: str, user_prompt: str) -> LLMResult:
+        usage = {'input_tokens': 0, 'output_tokens': 0}
+        chunks = []
+        time_to_first_token = None
+        started_at = time.monotonic()
+        stream = provider.stream(system_prompt, user_prompt, usage).__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), LLM_STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                if time_to_first_token is None:
+                    time_to_first_token = time.monotonic() - started_at
+                chunks.append(chunk)
+        finally:
+            await stream.aclose()
+        return LLMResult(text="".join(chunks), provider=provider.name, model=provider.model,
+                         input_tokens=usage['input_tokens'], output_tokens=usage['output_tokens'],
+                         latency=time.monotonic() - started_at, time_to_first_token=time_to_first_token)
+
+    def _count(self, provider_name: str, counter: str, value: int = 1):
+        with self._stats_lock:
+            self._counters[provider_name][counter] += value
+        LLM_FAILURES.labels(provider_name, counter).inc(value)
+
+    def _record(self, result: LLMResult):
+        with self._stats_lock:
+            counters = self._counters[result.provider]
+            counters["calls"] += 1
+            counters["input_tokens"] += result.input_tokens
+            counters["output_tokens"] += result.output_tokens
+            self._latencies[result.provider].append(result.latency)
+        LLM_REQUEST_DURATION.labels(result.provider).observe(result.latency)
+        LLM_TOKENS.labels(result.provider, "input").inc(result.input_tokens)
+        LLM_TOKENS.labels(result.provider, "output").inc(result.output_tokens)
+        logging.info(f"LLM call to {result.provider}/{result.model} took {result.latency:.2f}s "
+                     f"(first token after {result.time_to_first_token or 0:.2f}s), "
+                     f"{result.input_tokens} input / {result.output_tokens} output tokens")
+
+    def latency_percentile(self, provider_name: str, percentile: float) -> float | None:
+        """
+        Get a latency percentile of the provider's recent successful calls.
+        :param provider_name: The provider.
+        :param percentile: The percentile, between 0 and 100.
+        :return: The latency in seconds, None if there were no calls yet.
+        """
+        with self._stats_lock:
+            latencies = sorted(self._latencies[provider_name])
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    def get_stats(self) -> dict:
+        """
+        Get the call, error, retry and token counters and the p50/p95 latency of every provider.
+        """
+        with self._stats_lock:
+            stats = {name: dict(counters) for name, counters in self._counters.items()}
+        for name in stats:
+            stats[name]["p50_latency"] = self.latency_percentile(name, 50)
+            stats[name]["p95_latency"] = self.latency_percentile(name, 95)
+        return stats
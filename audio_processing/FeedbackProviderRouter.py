@@ -0,0 +1,181 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: FeedbackProviderRouter.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 19:05
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+from FeedbackLLMClient import FeedbackLLMClient, LLMResult
+
+FEEDBACK_HEDGE_ENABLED = os.getenv("FEEDBACK_HEDGE_ENABLED", "true").lower() == "true"
+# the secondary provider is fired once the primary is slower than this percentile of its recent calls
+FEEDBACK_HEDGE_PERCENTILE = float(os.getenv("FEEDBACK_HEDGE_PERCENTILE", "95"))
+FEEDBACK_HEDGE_MIN_SAMPLES = int(os.getenv("FEEDBACK_HEDGE_MIN_SAMPLES", "20"))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "60"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+
+
+class CircuitBreaker:
+    """
+    Opens when the error rate over the last window seconds reaches error_rate, with at least min_calls calls.
+    After cooldown seconds one trial call is let through (half-open), its outcome closes or re-opens it.
+    """
+
+    def __init__(self, error_rate: float, min_calls: int, window: float, cooldown: float):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.outcomes: deque = deque()  # (time, succeeded)
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """
+        Whether a call may go to the provider now. While half-open this claims the single trial call,
+        so the check and the claim happen under the same lock.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def call_cancelled(self):
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record(self, succeeded: bool):
+        with self._lock:
+            now = time.monotonic()
+            if self.opened_at is not None:
+                if self.trial_in_flight:
+                    self.trial_in_flight = False
+                    # the trial call decides, with a fresh window either way
+                    self.opened_at = None if succeeded else now
+                    self.outcomes.clear()
+                return
+            self.outcomes.append((now, succeeded))
+            while self.outcomes and self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+            failures = sum(1 for _, ok in self.outcomes if not ok)
+            if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.error_rate:
+                logging.warning(f"Circuit opened after {failures}/{len(self.outcomes)} failed calls")
+                self.opened_at = now
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+
+class FeedbackProviderRouter:
+    """
+    Picks the LLM provider for each feedback call. Providers are tried in the configured order,
+    skipping the ones whose circuit is open. While the primary is slower than its usual tail latency,
+    the next provider is hedged in and the first answer wins. If the primary fails, the next one is used.
+    """
+
+    def __init__(self, client: FeedbackLLMClient, provider_order: Callable[[], list[str]]):
+        """
+        :param client: The client running the calls.
+        :param provider_order: Returns the current provider order, called for every request
+                               so the order can change at runtime.
+        """
+        self.client = client
+        self.provider_order = provider_order
+        self.breakers = {name: CircuitBreaker(CIRCUIT_ERROR_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW, CIRCUIT_COOLDOWN)
+                         for name in client.providers}
+
+    def generate(self, system_prompt: str, user_prompt: str) -> LLMResult:
+        """
+        Generate a completion with the best available provider, blocking the calling thread.
+        """
+        return asyncio.run_coroutine_threadsafe(self.agenerate(system_prompt, user_prompt), self.client.loop).result()
+
+    def _candidates(self) -> list[str]:
+        order = [name for name in self.provider_order() if name in self.client.providers]
+        if not order:
+            raise ValueError(f"No known feedback AI provider in {self.provider_order()}")
+        return order
+
+    def _acquire(self, candidates: list[str]) -> str | None:
+        """
+        Pop the next candidate whose circuit lets a call through.
+        This claims a half-open trial, so it is only called right before calling that provider.
+        """
+        while candidates:
+            provider_name = candidates.pop(0)
+            if self.breakers[provider_name].try_acquire():
+                return provider_name
+        return None
+
+    async def _call(self, provider_name: str, system_prompt: str, user_prompt: str) -> LLMResult:
+        try:
+            result = await self.client.agenerate(provider_name, system_prompt, user_prompt)
+        except asyncio.CancelledError:
+            # lost a hedge race, says nothing about the provider's health
+            self.breakers[provider_name].call_cancelled()
+            raise
+        except Exception:
+            self.breakers[provider_name].record(False)
+            raise
+        self.breakers[provider_name].record(True)
+        return result
+
+    def _hedge_delay(self, provider_name: str) -> float | None:
+        if not FEEDBACK_HEDGE_ENABLED:
+            return None
+        if self.client.get_stats()[provider_name]["calls"] < FEEDBACK_HEDGE_MIN_SAMPLES:
+            return None
+        return self.client.latency_percentile(provider_name, FEEDBACK_HEDGE_PERCENTILE)
+
+    async def agenerate(self, system_prompt: str, user_prompt: str) -> LLMResult:
+        order = self._candidates()
+        candidates = list(order)
+        # with every circuit open, still try the primary rather than failing outright
+        primary = self._acquire(candidates) or order[0]
+        last_error = None
+        while primary is not None:
+            primary_task = asyncio.create_task(self._call(primary, system_prompt, user_prompt))
+            hedge_delay = self._hedge_delay(primary) if candidates else None
+            done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+            secondary = self._acquire(candidates) if not done else None
+            if secondary is not None:
+                logging.info(f"{primary} slower than its p{FEEDBACK_HEDGE_PERCENTILE:g} of {hedge_delay:.2f}s, "
+                             f"hedging with {secondary}")
+                pending = {primary_task, asyncio.create_task(self._call(secondary, system_prompt, user_prompt))}
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            for loser in pending:
+                                loser.cancel()
+                            return task.result()
+                        last_error = task.exception()
+                primary = self._acquire(candidates)
+                continue
+            # nothing left to hedge with, keep waiting on the primary
+            await asyncio.wait({primary_task})
+            if primary_task.exception() is None:
+                return primary_task.result()
+            last_error = primary_task.exception()
+            logging.warning(f"Feedback provider {primary} failed ({last_error!r}), falling back")
+            primary = self._acquire(candidates)
+        raise last_error
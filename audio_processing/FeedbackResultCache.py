@@ -0,0 +1,173 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: FeedbackResultCache.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 20:10
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable
+
+from ClientRegistry import get_redis_client
+from FeedbackLLMClient import LLMResult
+from Metrics import CACHE_REQUESTS
+
+FEEDBACK_RESULT_CACHE_ENABLED = os.getenv("FEEDBACK_RESULT_CACHE_ENABLED", "true").lower() == "true"
+FEEDBACK_RESULT_CACHE_TTL = int(os.getenv("FEEDBACK_RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+# least recently used results beyond this count are evicted, redis is shared with the prompt cache
+FEEDBACK_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("FEEDBACK_RESULT_CACHE_MAX_ENTRIES", "20000"))
+# how long a worker may hold the generation lock of a key, the other workers wait for its result meanwhile
+FEEDBACK_RESULT_LOCK_TTL = int(os.getenv("FEEDBACK_RESULT_LOCK_TTL", "300"))
+FEEDBACK_RESULT_POLL_INTERVAL = 0.5
+FEEDBACK_RESULT_KEY_PREFIX = "prepit_feedback_result:"
+FEEDBACK_RESULT_LOCK_PREFIX = "prepit_feedback_result_lock:"
+FEEDBACK_RESULT_INDEX_KEY = "prepit_feedback_results"
+
+# deletes the lock only if it is still ours, it may have expired and been taken by another worker
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def feedback_cache_key(system_prompt: str, user_prompt: str, models: list[str]) -> str:
+    """
+    Get the content address of a feedback request.
+    :param system_prompt: The rendered system prompt.
+    :param user_prompt: The rendered user prompt, which includes the transcript.
+    :param models: The provider/model chain that may answer, in order.
+    :return: The hex sha256 of all of them.
+    """
+    digest = hashlib.sha256()
+    for part in [system_prompt, user_prompt, *models]:
+        encoded = part.encode("utf-8")
+        # length prefixed, so the parts cannot run into each other
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class FeedbackResultCache:
+    """
+    Redis cache of generated feedback, addressed by the hash of the rendered prompts and the models.
+    A resubmitted transcript, a duplicate delivery or a retried job reuses the stored result instead
+    of calling the LLM again. While one worker generates a result, the others asking for the same key
+    wait for it rather than generating it a second time.
+    """
+
+    def __init__(self):
+        self.redis_client = get_redis_client()
+        # hit, miss, waited and error counts
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def __count(self, stat: str):
+        with self._stats_lock:
+            self.stats[stat] += 1
+        CACHE_REQUESTS.labels("feedback_result", stat).inc()
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def get(self, key: str) -> LLMResult | None:
+        """
+        Get the cached result of key, refreshing its recency.
+        :param key: The content address from feedback_cache_key.
+        :return: The result, or None if it is not cached or redis is unreachable.
+        """
+        try:
+            cached = self.redis_client.get(FEEDBACK_RESULT_KEY_PREFIX + key)
+            if cached is None:
+                return None
+            self.redis_client.zadd(FEEDBACK_RESULT_INDEX_KEY, {key: time.time()})
+            return LLMResult(**json.loads(cached))
+        except Exception as e:
+            logging.error(f"Error reading the feedback result cache: {e}")
+            self.__count("error")
+            return None
+
+    def set(self, key: str, result: LLMResult) -> bool:
+        """
+        Store the result of key, evicting the least recently used results over the size limit.
+        :return: True if successful, False otherwise.
+        """
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.set(FEEDBACK_RESULT_KEY_PREFIX + key, json.dumps(result.__dict__), ex=FEEDBACK_RESULT_CACHE_TTL)
+            pipeline.zadd(FEEDBACK_RESULT_INDEX_KEY, {key: time.time()})
+            # entries older than the ttl are gone already, only the index needs cleaning up
+            pipeline.zremrangebyscore(FEEDBACK_RESULT_INDEX_KEY, "-inf", time.time() - FEEDBACK_RESULT_CACHE_TTL)
+            pipeline.zcard(FEEDBACK_RESULT_INDEX_KEY)
+            size = pipeline.execute()[-1]
+            if size > FEEDBACK_RESULT_CACHE_MAX_ENTRIES:
+                evicted = self.redis_client.zpopmin(FEEDBACK_RESULT_INDEX_KEY, size - FEEDBACK_RESULT_CACHE_MAX_ENTRIES)
+                if evicted:
+                    self.redis_client.delete(*[FEEDBACK_RESULT_KEY_PREFIX + evicted_key for evicted_key, _ in evicted])
+            return True
+        except Exception as e:
+            logging.error(f"Error writing the feedback result cache: {e}")
+            self.__count("error")
+            return False
+
+    def get_or_generate(self, key: str, generate: Callable[[], LLMResult]) -> tuple[LLMResult, bool]:
+        """
+        Get the cached result of key, or generate and cache it.
+        If redis is unreachable the result is generated without caching.
+        :param key: The content address from feedback_cache_key.
+        :param generate: Generates the result on a miss.
+        :return: The result, and whether it came from the cache.
+        """
+        if not FEEDBACK_RESULT_CACHE_ENABLED:
+            return generate(), False
+        result = self.get(key)
+        if result is not None:
+            self.__count("hit")
+            return result, True
+        token = uuid.uuid4().hex
+        lock_key = FEEDBACK_RESULT_LOCK_PREFIX + key
+        deadline = time.monotonic() + FEEDBACK_RESULT_LOCK_TTL
+        while True:
+            try:
+                if self.redis_client.set(lock_key, token, nx=True, ex=FEEDBACK_RESULT_LOCK_TTL):
+                    break
+            except Exception as e:
+                logging.error(f"Error taking the feedback result lock: {e}")
+                self.__count("error")
+                token = None
+                break
+            # another worker is generating the same feedback, wait for its result
+            time.sleep(FEEDBACK_RESULT_POLL_INTERVAL)
+            result = self.get(key)
+            if result is not None:
+                self.__count("waited")
+                return result, True
+            if time.monotonic() > deadline:
+                token = None
+                break
+        try:
+            # the holder may have finished between our last look and taking the lock
+            result = self.get(key) if token else None
+            if result is not None:
+                self.__count("waited")
+                return result, True
+            self.__count("miss")
+            result = generate()
+            self.set(key, result)
+            return result, False
+        finally:
+            if token:
+                try:
+                    self.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    logging.error(f"Error releasing the feedback result lock: {e}")
@@ -6,9 +6,9 @@
 @email: rxy216@case.edu
 @time: 6/30/24 01:16
 """
-import boto3
 import logging
-import os
+from ClientRegistry import get_dynamodb_table
+from Metrics import OPERATION_DURATION, OPERATION_ERRORS
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,11 +16,9 @@ logging.basicConfig(level=logging.INFO)
 class FeedbackStorageHandler:
     DYNAMODB_TABLE_NAME = "prepit_ai_feedback"
 
-    def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-2',
-                                       aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID_DYNAMODB"),
-                                       aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY_DYNAMODB"))
-        self.table = self.dynamodb.Table(self.DYNAMODB_TABLE_NAME)
+    @property
+    def table(self):
+        return get_dynamodb_table(self.DYNAMODB_TABLE_NAME)
 
     def put_feedback(self, thread_id: str, agent_id: str, step_id: int, step_title: str, feedback: str) -> bool:
         """
@@ -33,16 +31,18 @@ class FeedbackStorageHandler:
         :return: True if successful, False otherwise.
         """
         try:
-            self.table.put_item(
-                Item={
-                    'thread_id': thread_id,
-                    'step_id': step_id,
-                    'step_title': step_title,
-                    'agent_id': agent_id,
-                    'feedback': feedback
-                }
-            )
+            with OPERATION_DURATION.labels("dynamodb_put_feedback").time():
+                self.table.put_item(
+                    Item={
+                        'thread_id': thread_id,
+                        'step_id': step_id,
+                        'step_title': step_title,
+                        'agent_id': agent_id,
+                        'feedback': feedback
+                    }
+                )
             return True
         except Exception as e:
+            OPERATION_ERRORS.labels("dynamodb_put_feedback").inc()
             logging.error(f"Error putting the feedback into the database: {e}")
             return False
@@ -6,10 +6,35 @@
 @email: rxy216@case.edu
 @time: 6/27/24 00:53
 """
-import boto3
+from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import ClientError
+from s3transfer.subscribers import BaseSubscriber
+from typing import Callable
 import os
 import mimetypes
+import time
+from ClientRegistry import get_s3_transfer_manager
+from Metrics import OPERATION_DURATION, OPERATION_ERRORS
+
+
+class UploadSubscriber(BaseSubscriber):
+    """
+    Times an upload, and reports it as soon as it succeeded.
+    """
+
+    def __init__(self, on_uploaded: Callable[[], None] | None = None):
+        self.on_uploaded = on_uploaded
+        self.queued_at = time.perf_counter()
+
+    def on_done(self, future, **kwargs):
+        try:
+            future.result()
+        except Exception:
+            # reported by whoever waits on the upload
+            return
+        OPERATION_DURATION.labels("s3_upload").observe(time.perf_counter() - self.queued_at)
+        if self.on_uploaded is not None:
+            self.on_uploaded()
 
 
 class FileUploadHandler:
@@ -17,39 +42,85 @@ class FileUploadHandler:
     S3_FOLDER = 'prepit_data/audio/'  # Base folder in S3 to store uploaded files
 
     def __init__(self):
-        self.s3_client = boto3.client('s3')
+        # uploads are queued on the transfer manager of the process, shared by all handlers
+        self.transfer_manager = get_s3_transfer_manager()
 
-    def upload_file(self, local_file_path: str, s3_folder_path: str, is_public: bool = False) -> bool:
+    def object_name(self, local_file_path: str, s3_folder_path: str) -> str:
         """
-        Upload a file to a specified path in S3 with the same filename.
+        Get the S3 key a file is uploaded to.
+        """
+        return f"{self.S3_FOLDER}{s3_folder_path}{os.path.basename(local_file_path)}"
+
+    def submit_upload(self, local_file_path: str, s3_folder_path: str, is_public: bool = False,
+                      on_uploaded: Callable[[str, str], None] | None = None):
+        """
+        Queue the upload of a file to a specified path in S3 with the same filename.
         Make it publicly accessible and set the content type based on the file extension.
         :param local_file_path: The local path of the file to upload.
         :param s3_folder_path: The desired folder path in S3 (relative to the base folder).
         :param is_public: Whether the file should be publicly accessible.
-        :return: The public URL to the file in S3.
+        :param on_uploaded: Called from an upload thread with the local path and the S3 key once it is uploaded.
+        :return: The future of the upload, to pass to wait_upload.
         """
-        file_name = os.path.basename(local_file_path)
-        object_name = f"{self.S3_FOLDER}{s3_folder_path}{file_name}"
+        object_name = self.object_name(local_file_path, s3_folder_path)
 
         if local_file_path.lower().endswith('.mp3'):
             content_type = 'audio/mpeg'
+        elif local_file_path.lower().endswith('.opus'):
+            # Opus clips are in an Ogg container, not every mimetypes table knows the extension
+            content_type = 'audio/ogg'
         else:
             # Determine the content type based on the file extension
             content_type, _ = mimetypes.guess_type(local_file_path)
             if content_type is None:
                 content_type = 'application/octet-stream'  # Default to binary stream if MIME type can't be determined
 
-        try:
-            # Upload the file with content type specified
-            with open(local_file_path, 'rb') as file:
-                self.s3_client.upload_fileobj(file, self.BUCKET_NAME, object_name,
-                                              ExtraArgs={'ContentType': content_type})
-
-            if is_public:
-                # Set the file's ACL to public-read
-                self.s3_client.put_object_acl(ACL='public-read', Bucket=self.BUCKET_NAME, Key=object_name)
+        extra_args = {'ContentType': content_type}
+        if is_public:
+            # set the ACL on the upload itself instead of a second put_object_acl round trip
+            extra_args['ACL'] = 'public-read'
+        subscriber = UploadSubscriber(None if on_uploaded is None else
+                                      lambda: on_uploaded(local_file_path, object_name))
+        return self.transfer_manager.upload(local_file_path, self.BUCKET_NAME, object_name,
+                                            extra_args=extra_args, subscribers=[subscriber])
 
+    @staticmethod
+    def wait_upload(future) -> bool:
+        """
+        Wait for a queued upload.
+        :return: True if successful, False otherwise.
+        """
+        try:
+            future.result()
             return True
-        except ClientError as e:
+        except (ClientError, S3UploadFailedError, OSError) as e:
+            OPERATION_ERRORS.labels("s3_upload").inc()
             print(f"An error occurred: {e}")
             return False
+
+    def upload_file(self, local_file_path: str, s3_folder_path: str, is_public: bool = False) -> bool:
+        """
+        Upload a file to a specified path in S3 with the same filename.
+        Make it publicly accessible and set the content type based on the file extension.
+        :param local_file_path: The local path of the file to upload.
+        :param s3_folder_path: The desired folder path in S3 (relative to the base folder).
+        :param is_public: Whether the file should be publicly accessible.
+        :return: True if successful, False otherwise.
+        """
+        return self.wait_upload(self.submit_upload(local_file_path, s3_folder_path, is_public))
+
+    def upload_files(self, local_file_paths: list[str], s3_folder_path: str, is_public: bool = False,
+                     on_uploaded: Callable[[str, str], None] | None = None) -> dict:
+        """
+        Upload a batch of files concurrently to the same folder in S3.
+        :param local_file_paths: The local paths of the files to upload.
+        :param s3_folder_path: The desired folder path in S3 (relative to the base folder).
+        :param is_public: Whether the files should be publicly accessible.
+        :param on_uploaded: Called from an upload thread with the local path and the S3 key of every file
+                            as soon as it is uploaded, without waiting for the rest of the batch.
+        :return: A dict mapping each local file path to True if its upload succeeded, False otherwise.
+        """
+        # all queued at once, the transfer manager bounds how many run concurrently
+        futures = {path: self.submit_upload(path, s3_folder_path, is_public, on_uploaded)
+                   for path in local_file_paths}
+        return {path: self.wait_upload(future) for path, future in futures.items()}
@@ -0,0 +1,197 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: JobProfiler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 23:50
+"""
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from ClientRegistry import get_shared
+from Metrics import JOB_MEMORY_PEAK
+
+# off, sample (a stack sampler, cheap enough for production) or cprofile (exact call counts, slows the job down)
+PROFILE_MODE = os.getenv("PROFILE_MODE", "off").lower()
+# the container's working directory is read-only for the worker user, point this to a volume to keep the dumps
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/prepit_profiles")
+# only jobs running at least this many seconds are dumped, the others are profiled and thrown away
+PROFILE_SLOW_THRESHOLD = float(os.getenv("PROFILE_SLOW_THRESHOLD", "30"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.01"))
+# tracks the peak python heap of every job, numpy arrays included, at a cost of roughly 2x on allocations
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "false").lower() == "true"
+PROFILE_MAX_STACK_DEPTH = 128
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples the stacks of the threads running profiled jobs, from one background thread per process.
+    The samples of every job are kept as collapsed stacks, the input format of flamegraph.pl and speedscope.
+    """
+    # registers a job owning the whole process, every thread of it is sampled
+    ALL_THREADS = None
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # thread id, or ALL_THREADS -> collapsed stack -> sample count
+        self._threads: dict[int | None, Counter] = {}
+        self._lock = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def start(self, thread_id: int | None) -> Counter:
+        """
+        Start sampling a thread.
+        :param thread_id: The threading.get_ident() of the thread, or ALL_THREADS for every thread of the process,
+                          their stacks then start with the name of the thread.
+        :return: The collapsed stack counts, filled in until stop is called.
+        """
+        with self._lock:
+            samples = self._threads[thread_id] = Counter()
+            self._lock.notify()
+        return samples
+
+    def stop(self, thread_id: int | None):
+        """
+        Stop sampling a thread, its samples are not touched anymore once this returns.
+        """
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._threads:
+                    self._lock.wait()
+                frames = sys._current_frames()
+                for thread_id, samples in self._threads.items():
+                    if thread_id is not self.ALL_THREADS:
+                        self._sample(samples, frames.get(thread_id))
+                        continue
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    for other_thread_id, frame in frames.items():
+                        if other_thread_id != self._thread.ident:
+                            self._sample(samples, frame, thread_names.get(other_thread_id, str(other_thread_id)))
+                del frames
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _sample(samples: Counter, frame, thread_name: str | None = None):
+        stack = []
+        while frame is not None and len(stack) < PROFILE_MAX_STACK_DEPTH:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        if stack and thread_name is not None:
+            stack.append(thread_name)
+        if stack:
+            samples[";".join(reversed(stack))] += 1
+
+
+def get_stack_sampler() -> StackSampler:
+    return get_shared("stack_sampler", lambda: StackSampler(PROFILE_SAMPLE_INTERVAL))
+
+
+# on python 3.12 cProfile uses sys.monitoring, which allows one active profiler per process
+_cprofile_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # a pool recreated while a feedback job holds the lock must not inherit it held
+    global _cprofile_lock
+    _cprofile_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def dump_profile(task_type: str, job_id: str | None, duration: float, summary: dict, samples: Counter | None,
+                 profiler: cProfile.Profile | None) -> str:
+    """
+    Write a job's profile next to a json summary of it.
+    :return: The path of the dump, without extension.
+    """
+    task_dir = os.path.join(PROFILE_DIR, task_type)
+    os.makedirs(task_dir, exist_ok=True)
+    base_path = os.path.join(task_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{job_id or os.getpid()}_{duration:.0f}s")
+    if profiler is not None:
+        profiler.dump_stats(base_path + ".pstats")
+    if samples is not None:
+        with open(base_path + ".collapsed", "w") as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in samples.most_common())
+    with open(base_path + ".json", "w") as file:
+        json.dump(summary, file, indent=2)
+    return base_path
+
+
+@contextmanager
+def profile_job(task_type: str, job_id: str | None, whole_process: bool = False):
+    """
+    Profile the enclosed job according to PROFILE_MODE, a no-op when profiling is off.
+    Jobs slower than PROFILE_SLOW_THRESHOLD are dumped to PROFILE_DIR/<task_type>/.
+    :param task_type: The task type of the job.
+    :param job_id: The ID of the job, None for messages without one.
+    :param whole_process: Whether the job has its process to itself, like the jobs of a process pool.
+                          The sampler then also covers the encoder, upload and other threads the job spawns.
+    """
+    if PROFILE_MODE not in ("sample", "cprofile"):
+        yield
+        return
+    if PROFILE_TRACEMALLOC:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # the peak is per process, jobs sharing the thread pool also share it
+        tracemalloc.reset_peak()
+    profiler = None
+    samples = None
+    sampled_thread = StackSampler.ALL_THREADS if whole_process else threading.get_ident()
+    if PROFILE_MODE == "cprofile" and _cprofile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        # in cprofile mode too when another job of this process holds the profiler
+        samples = get_stack_sampler().start(sampled_thread)
+    started_at = time.time()
+    status = 'failed'
+    try:
+        yield
+        status = 'completed'
+    finally:
+        duration = time.time() - started_at
+        if profiler is not None:
+            profiler.disable()
+            _cprofile_lock.release()
+        else:
+            get_stack_sampler().stop(sampled_thread)
+        memory_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+        if memory_peak is not None:
+            JOB_MEMORY_PEAK.labels(task_type).observe(memory_peak)
+        if duration >= PROFILE_SLOW_THRESHOLD:
+            summary = {
+                'task_type': task_type,
+                'job_id': job_id,
+                'pid': os.getpid(),
+                'status': status,
+                'started_at': started_at,
+                'duration': duration,
+                'memory_peak_bytes': memory_peak,
+                'samples': sum(samples.values()) if samples is not None else None
+            }
+            try:
+                path = dump_profile(task_type, job_id, duration, summary, samples, profiler)
+                logging.warning(f"Slow {task_type} job {job_id} took {duration:.1f}s, profile dumped to {path}")
+            except OSError as e:
+                logging.error(f"Error dumping the profile of {task_type} job {job_id}: {e}")
@@ -0,0 +1,147 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: JobStateHandler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 21:05
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from ClientRegistry import get_redis_client, get_shared
+from Metrics import STAGE_DURATION
+
+# the key layout is shared with the API's JobStore
+JOB_KEY_PREFIX = "prepit_job:"
+JOB_TTL = int(os.getenv("JOB_TTL", str(7 * 24 * 3600)))
+# sets fields of a job unless it completed, in one step so a completion in between is never overwritten
+UPDATE_UNLESS_COMPLETED_SCRIPT = """
+if redis.call("hget", KEYS[1], "status") == "completed" then
+    return 0
+end
+redis.call("hset", KEYS[1], unpack(ARGV, 2))
+redis.call("expire", KEYS[1], ARGV[1])
+return 1
+"""
+
+# the job the current thread is working on, so the stages deep down the pipeline know what to report on
+_current_job_id: ContextVar[str | None] = ContextVar("current_job_id", default=None)
+
+
+class JobStateHandler:
+    """
+    Worker side of the job records created by the API when it queues a job. Besides the status,
+    every stage a job goes through is recorded as <stage>_started_at and <stage>_duration.
+    """
+
+    def __init__(self):
+        self.redis_client = get_redis_client()
+
+    def get_status(self, job_id: str) -> str | None:
+        """
+        Get the status of a job.
+        :param job_id: The ID of the job.
+        :return: 'queued', 'completed' or 'failed', None if the job is unknown or redis is unreachable.
+        """
+        try:
+            return self.redis_client.hget(JOB_KEY_PREFIX + job_id, 'status')
+        except Exception as e:
+            logging.error(f"Error reading the status of job {job_id}: {e}")
+            return None
+
+    def is_completed(self, job_id: str) -> bool:
+        return self.get_status(job_id) == 'completed'
+
+    def update_job(self, job_id: str, fields: dict) -> bool:
+        """
+        Set fields of a job record, refreshing its expiry.
+        :param job_id: The ID of the job.
+        :param fields: The fields to set.
+        :return: True if successful, False otherwise.
+        """
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.hset(JOB_KEY_PREFIX + job_id, mapping=fields)
+            pipeline.expire(JOB_KEY_PREFIX + job_id, JOB_TTL)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.error(f"Error updating job {job_id}: {e}")
+            return False
+
+    def update_unless_completed(self, job_id: str, fields: dict) -> bool:
+        """
+        Set fields of a job record, refreshing its expiry, unless the job already completed.
+        :param job_id: The ID of the job.
+        :param fields: The fields to set.
+        :return: False if the job already completed, True otherwise, also when redis is unreachable.
+        """
+        try:
+            args = [field_or_value for field, value in fields.items() for field_or_value in (field, value)]
+            return bool(self.redis_client.eval(UPDATE_UNLESS_COMPLETED_SCRIPT, 1, JOB_KEY_PREFIX + job_id,
+                                               JOB_TTL, *args))
+        except Exception as e:
+            logging.error(f"Error updating job {job_id}: {e}")
+            return True
+
+    def mark_started(self, job_id: str) -> bool:
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.hset(JOB_KEY_PREFIX + job_id, mapping={'status': 'running', 'started_at': time.time()})
+            pipeline.hincrby(JOB_KEY_PREFIX + job_id, 'attempts', 1)
+            pipeline.expire(JOB_KEY_PREFIX + job_id, JOB_TTL)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.error(f"Error updating job {job_id}: {e}")
+            return False
+
+    def mark_completed(self, job_id: str) -> bool:
+        return self.update_job(job_id, {'status': 'completed', 'finished_at': time.time()})
+
+    def mark_failed(self, job_id: str, reason: str) -> bool:
+        return self.update_job(job_id, {'status': 'failed', 'error': reason[:1024], 'finished_at': time.time()})
+
+
+def get_job_state_handler() -> JobStateHandler:
+    return get_shared("job_state_handler", JobStateHandler)
+
+
+def current_job_id() -> str | None:
+    return _current_job_id.get()
+
+
+@contextmanager
+def job_context(job_id: str | None):
+    """
+    Run the enclosed code on behalf of a job, so its job_stage blocks are recorded on that job.
+    """
+    token = _current_job_id.set(job_id)
+    try:
+        yield
+    finally:
+        _current_job_id.reset(token)
+
+
+@contextmanager
+def job_stage(stage: str):
+    """
+    Time the enclosed code as a pipeline stage, and record it on the current job if there is one.
+    :param stage: The name of the stage, e.g. 'decode'.
+    """
+    job_id = _current_job_id.get()
+    handler = get_job_state_handler() if job_id is not None else None
+    started_at = time.time()
+    if handler is not None:
+        handler.update_job(job_id, {'stage': stage, f'{stage}_started_at': started_at})
+    try:
+        yield
+    finally:
+        duration = time.time() - started_at
+        STAGE_DURATION.labels(stage).observe(duration)
+        if handler is not None:
+            handler.update_job(job_id, {f'{stage}_duration': duration})
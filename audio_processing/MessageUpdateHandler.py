@@ -6,21 +6,23 @@
 @email: rxy216@case.edu
 @time: 6/27/24 00:35
 """
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
+from ClientRegistry import get_dynamodb_resource, get_dynamodb_table
+from Metrics import OPERATION_DURATION, OPERATION_ERRORS
 
 logging.basicConfig(level=logging.INFO)
 
+DYNAMODB_UPDATE_CONCURRENCY = int(os.getenv("DYNAMODB_UPDATE_CONCURRENCY", "16"))
+
 
 class MessageUpdateHandler:
     DYNAMODB_TABLE_NAME = "prepit_chat_msg"
 
-    def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-2',
-                                       aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID_DYNAMODB"),
-                                       aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY_DYNAMODB"))
-        self.table = self.dynamodb.Table(self.DYNAMODB_TABLE_NAME)
+    @property
+    def table(self):
+        return get_dynamodb_table(self.DYNAMODB_TABLE_NAME)
 
     def update_message_audio_flag(self, thread_id: str, created_at: str) -> bool:
         """
@@ -32,17 +34,56 @@ class MessageUpdateHandler:
         """
         try:
             # Update the has_audio field to True
-            self.table.update_item(
-                Key={
-                    'thread_id': thread_id,
-                    'created_at': created_at
-                },
-                UpdateExpression="set has_audio = :val",
-                ExpressionAttributeValues={
-                    ':val': True
-                }
-            )
+            with OPERATION_DURATION.labels("dynamodb_update_message").time():
+                self.table.update_item(
+                    Key={
+                        'thread_id': thread_id,
+                        'created_at': created_at
+                    },
+                    UpdateExpression="set has_audio = :val",
+                    ExpressionAttributeValues={
+                        ':val': True
+                    }
+                )
             return True
         except Exception as e:
+            OPERATION_ERRORS.labels("dynamodb_update_message").inc()
             print(f"Error updating the message audio flag: {e}")
             return False
+
+    def update_message_audio_flags(self, thread_id: str, created_at_list: list[str]) -> dict:
+        """
+        Set has_audio to True on a batch of messages of the same thread concurrently.
+        Each message is updated on its own, so one failing message does not fail the others.
+        :param thread_id: The ID of the thread.
+        :param created_at_list: The creation times of the messages to update.
+        :return: A dict mapping each created_at to True if its update was successful, False otherwise.
+        """
+        if not created_at_list:
+            return {}
+        # clients are thread-safe, resources and tables are not. The resource's client still takes plain
+        # python values, the resource registers its (de)serializers on it
+        client = get_dynamodb_resource().meta.client
+
+        def update(created_at: str) -> bool:
+            try:
+                with OPERATION_DURATION.labels("dynamodb_update_message").time():
+                    client.update_item(
+                        TableName=self.DYNAMODB_TABLE_NAME,
+                        Key={
+                            'thread_id': thread_id,
+                            'created_at': created_at
+                        },
+                        UpdateExpression="set has_audio = :val",
+                        ExpressionAttributeValues={
+                            ':val': True
+                        }
+                    )
+                return True
+            except Exception as e:
+                OPERATION_ERRORS.labels("dynamodb_update_message").inc()
+                print(f"Error updating the message audio flag of {thread_id} {created_at}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=min(DYNAMODB_UPDATE_CONCURRENCY, len(created_at_list))) as executor:
+            return dict(zip(created_at_list, executor.map(update, created_at_list)))
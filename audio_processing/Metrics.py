@@ -0,0 +1,68 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: Metrics.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 23:10
+"""
+import os
+import shutil
+
+# audio tasks run in forked pool processes, each writes its samples to files in this directory and the
+# metrics server of the main process adds them up. It has to be set before prometheus_client is imported
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prepit_metrics")
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, multiprocess,  # noqa: E402
+                               start_http_server)
+
+# audio stages of long recordings take minutes, the default buckets stop at 10 seconds
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+TASK_DURATION = Histogram("prepit_task_duration_seconds", "Time spent running a task",
+                          ["task_type", "status"], buckets=DURATION_BUCKETS)
+TASK_ERRORS = Counter("prepit_task_errors_total", "Failed task attempts", ["task_type", "error"])
+DEAD_LETTERS = Counter("prepit_dead_letters_total", "Tasks parked in a dead-letter queue", ["task_type", "error"])
+STAGE_DURATION = Histogram("prepit_stage_duration_seconds", "Time spent in a pipeline stage",
+                           ["stage"], buckets=DURATION_BUCKETS)
+OPERATION_DURATION = Histogram("prepit_operation_duration_seconds",
+                               "Time spent in a single call to S3, DynamoDB or the audio encoder",
+                               ["operation"], buckets=DURATION_BUCKETS)
+OPERATION_ERRORS = Counter("prepit_operation_errors_total", "Failed calls to S3, DynamoDB or the audio encoder",
+                           ["operation"])
+QUEUE_WAIT = Histogram("prepit_queue_wait_seconds", "Time from publishing a task to its delivery",
+                       ["queue"], buckets=DURATION_BUCKETS)
+# only the main process consumes, so the live maximum is its latest value
+QUEUE_LAG = Gauge("prepit_queue_lag_seconds", "Queue wait of the latest delivered task",
+                  ["queue"], multiprocess_mode="livemax")
+QUEUE_MESSAGES = Gauge("prepit_queue_messages", "Messages ready in a queue", ["queue"], multiprocess_mode="livemax")
+QUEUE_CONSUMERS = Gauge("prepit_queue_consumers", "Consumers of a queue", ["queue"], multiprocess_mode="livemax")
+CACHE_REQUESTS = Counter("prepit_cache_requests_total", "Cache lookups by result, e.g. hit or miss",
+                         ["cache", "result"])
+LLM_REQUEST_DURATION = Histogram("prepit_llm_request_duration_seconds", "Latency of successful LLM calls",
+                                 ["provider"], buckets=DURATION_BUCKETS)
+LLM_FAILURES = Counter("prepit_llm_failures_total", "Failed and retried LLM calls", ["provider", "kind"])
+JOB_MEMORY_PEAK = Histogram("prepit_job_memory_peak_bytes", "Peak traced python heap of a profiled job",
+                            ["task_type"], buckets=tuple(2 ** power for power in range(20, 35)))
+LLM_TOKENS = Counter("prepit_llm_tokens_total", "Tokens used by LLM calls", ["provider", "direction"])
+
+
+def clear_metrics_dir():
+    """
+    Empty the multiprocess metrics directory, samples of a previous run would otherwise be added up too.
+    Only the worker's main process calls this at startup, before any metric is recorded or pool is forked.
+    """
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def start_metrics_server(port: int):
+    """
+    Serve the metrics of this process and of its pool processes over HTTP.
+    :param port: The port to listen on.
+    """
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+    print(f"Serving metrics on port {port}")
@@ -1,12 +1,123 @@
 import json
+import struct
+import threading
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta
-import librosa
+from itertools import accumulate
+import numpy as np
 import soundfile as sf
+import soxr
 import os
 from MessageUpdateHandler import MessageUpdateHandler
 from FileUploadHandler import FileUploadHandler
+from ClientRegistry import get_shared
+from JobStateHandler import job_stage, current_job_id
+from EventPublishHandler import publish_event
+from Metrics import OPERATION_DURATION
 
 PROCESSED_MEDIA_DIR = "./processed_media"
+# libsndfile releases the GIL while encoding, so clips are encoded in parallel threads
+CLIP_ENCODE_WORKERS = int(os.getenv("CLIP_ENCODE_WORKERS", str(os.cpu_count() or 1)))
+# (format tag, bits per sample) -> sample dtype of the WAV encodings we can memory-map directly
+WAV_MEMMAP_DTYPES = {
+    (1, 16): np.dtype('<i2'),
+    (1, 32): np.dtype('<i4'),
+    (3, 32): np.dtype('<f4')
+}
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+# cut clips while the recording is still being read, instead of after loading all of it
+AUDIO_STREAM_PROCESSING = os.getenv("AUDIO_STREAM_PROCESSING", "true").lower() == "true"
+AUDIO_STREAM_BLOCK_FRAMES = int(os.getenv("AUDIO_STREAM_BLOCK_FRAMES", str(64 * 1024)))
+CLIP_EXPORT_WORKERS = int(os.getenv("CLIP_EXPORT_WORKERS", "16"))
+# libsndfile's format and subtype of every clip codec, with the sample rates it can encode at
+CLIP_CODECS = {
+    'mp3': {'format': 'MP3', 'subtype': 'MPEG_LAYER_III', 'extension': 'mp3',
+            'sample_rates': (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000)},
+    'opus': {'format': 'OGG', 'subtype': 'OPUS', 'extension': 'opus',
+             'sample_rates': (8000, 12000, 16000, 24000, 48000)}
+}
+# soxr quality of the resampling to the clips' rate: QQ, LQ, MQ, HQ or VHQ
+CLIP_RESAMPLE_QUALITY = os.getenv("CLIP_RESAMPLE_QUALITY", "HQ")
+
+
+@dataclass(frozen=True)
+class ClipProfile:
+    codec: str  # a key of CLIP_CODECS
+    bitrate: int | None = None  # bits per second, None leaves it to the encoder
+    mono: bool = True
+    sample_rate: int | None = None  # None keeps the recording's rate
+
+    def __post_init__(self):
+        if self.codec not in CLIP_CODECS:
+            raise ValueError(f"Unknown clip codec {self.codec}, expected one of {', '.join(CLIP_CODECS)}")
+
+    @property
+    def extension(self) -> str:
+        return CLIP_CODECS[self.codec]['extension']
+
+    def output_rate(self, rate: int) -> int:
+        """
+        Get the rate the clips of a recording are encoded at, the profile's rate if the recording has it,
+        raised to the closest one the codec supports.
+        :param rate: The sample rate of the recording.
+        """
+        target = min(self.sample_rate or rate, rate)
+        supported = CLIP_CODECS[self.codec]['sample_rates']
+        return next((supported_rate for supported_rate in supported if supported_rate >= target), supported[-1])
+
+    def encoder_args(self, rate: int, channels: int) -> dict:
+        """
+        Get the soundfile.write arguments of a clip, libsndfile takes a compression level instead of a bitrate.
+        """
+        codec = CLIP_CODECS[self.codec]
+        args = {'format': codec['format'], 'subtype': codec['subtype']}
+        if self.bitrate is None:
+            return args
+        if self.codec == 'opus':
+            # levels 0 to 1 map linearly onto 256 to 6 kbps per channel
+            level = (256000 - self.bitrate / channels) / 250000
+        else:
+            # and onto the bitrate range of the MPEG version of the rate, lame rounds to a standard bitrate
+            highest, lowest = (320, 32) if rate >= 32000 else (160, 8) if rate >= 16000 else (64, 8)
+            level = (highest - self.bitrate / 1000) / (highest - lowest)
+            args['bitrate_mode'] = 'CONSTANT'
+        # the MP3 encoder rejects the highest level
+        args['compression_level'] = min(max(level, 0.0), 0.99)
+        return args
+
+
+CLIP_PROFILES = {
+    # what clips have always been, for clients that build the .mp3 URL of a message themselves
+    'original': ClipProfile('mp3'),
+    # wideband speech, a fraction of the size
+    'speech': ClipProfile('opus', bitrate=24000, sample_rate=16000),
+    # for players without Opus support, e.g. older Safari
+    'speech_mp3': ClipProfile('mp3', bitrate=32000, sample_rate=16000)
+}
+
+
+def load_clip_profile() -> ClipProfile:
+    """
+    Get the profile named by CLIP_OUTPUT_PROFILE, with CLIP_CODEC, CLIP_BITRATE, CLIP_SAMPLE_RATE and CLIP_MONO
+    overriding its settings when set.
+    """
+    profile = CLIP_PROFILES[os.getenv("CLIP_OUTPUT_PROFILE", "original")]
+    overrides = {}
+    if os.getenv("CLIP_CODEC"):
+        overrides['codec'] = os.getenv("CLIP_CODEC").lower()
+    if os.getenv("CLIP_BITRATE"):
+        overrides['bitrate'] = int(os.getenv("CLIP_BITRATE"))
+    if os.getenv("CLIP_SAMPLE_RATE"):
+        overrides['sample_rate'] = int(os.getenv("CLIP_SAMPLE_RATE"))
+    if os.getenv("CLIP_MONO"):
+        overrides['mono'] = os.getenv("CLIP_MONO").lower() == "true"
+    return replace(profile, **overrides)
+
+
+CLIP_PROFILE = load_clip_profile()
 
 
 def clean_audio_timestamps(audio_timestamps):
@@ -25,15 +136,20 @@ def clean_audio_timestamps(audio_timestamps):
 
 def map_to_absolute_timestamps(audio_timestamps, audio_started_at, audio_pause_timestamps):
     audio_started_at = datetime.fromtimestamp(audio_started_at / 1000.0)  # Convert to datetime object
+    started_at_ms = audio_started_at.timestamp() * 1000
     pause_durations = [end - start for start, end in audio_pause_timestamps]
-    pause_offsets = [sum(pause_durations[:i]) for i in range(len(pause_durations) + 1)]
-    pause_intervals = [(start, end) for start, end in audio_pause_timestamps]
+    pause_offsets = [0, *accumulate(pause_durations)]
+    # an entry is shifted by pause_offsets[i] of every pause it starts at or after. Sorting the pauses
+    # by their start once turns that into a prefix sum lookup, instead of a scan over all pauses per entry
+    sorted_pauses = sorted((pause_start - started_at_ms, pause_offsets[i])
+                           for i, (pause_start, _) in enumerate(audio_pause_timestamps))
+    pause_thresholds = [threshold for threshold, _ in sorted_pauses]
+    cumulative_offsets = [0, *accumulate(offset for _, offset in sorted_pauses)]
 
     absolute_timestamps = []
     for entry in audio_timestamps:
         relative_start = entry['start'] * 1000  # Convert seconds to milliseconds
-        offset = sum(pause_offsets[i] for i, (pause_start, pause_end) in enumerate(pause_intervals) if
-                     relative_start >= (pause_start - audio_started_at.timestamp() * 1000))
+        offset = cumulative_offsets[bisect_right(pause_thresholds, relative_start)]
         absolute_start = audio_started_at + timedelta(milliseconds=relative_start + offset)
         entry['absolute_start'] = absolute_start
         absolute_timestamps.append(entry)
@@ -43,30 +159,19 @@ def map_to_absolute_timestamps(audio_timestamps, audio_started_at, audio_pause_t
 
 def organize_transcriptions_by_message(absolute_timestamps, user_msg_timestamps):
     sorted_msgs = sorted(user_msg_timestamps.items(), key=lambda x: int(x[0]))
-    result = []
-
-    for i, (timestamp, msg_id) in enumerate(sorted_msgs):
-        if i == 0:
-            prev_timestamp = 0
-        else:
-            prev_timestamp = int(sorted_msgs[i - 1][0])
-
-        current_timestamp = int(timestamp)
-        transcriptions = [entry for entry in absolute_timestamps if
-                          prev_timestamp <= entry['timestamp'] < current_timestamp]
-
-        result.append({"msg_id": msg_id, "transcriptions": transcriptions})
+    boundaries = [int(timestamp) for timestamp, _ in sorted_msgs]
+    # message i collects the entries in [boundaries[i - 1], boundaries[i]), the first one starting at 0,
+    # everything at or after the last boundary goes to the last message
+    buckets = [[] for _ in range(len(sorted_msgs) + 1)]
+    for entry in absolute_timestamps:
+        bucket = bisect_right(boundaries, entry['timestamp'])
+        if bucket == 0 and entry['timestamp'] < 0:
+            continue
+        buckets[bucket].append(entry)
 
-    last_msg_id = sorted_msgs[-1][1]
-    last_timestamp = int(sorted_msgs[-1][0])
-    # if last msg id is the same as the last msg in the result, update the last entry's transcriptions
-    remaining_transcriptions = [entry for entry in absolute_timestamps if entry['timestamp'] >= last_timestamp]
-    if remaining_transcriptions:
-        if result and result[-1]['msg_id'] == last_msg_id:
-            result[-1]['transcriptions'].extend(remaining_transcriptions)
-        else:
-            result.append({"msg_id": last_msg_id,
-                           "transcriptions": remaining_transcriptions})
+    result = [{"msg_id": msg_id, "transcriptions": buckets[i]} for i, (_, msg_id) in enumerate(sorted_msgs)]
+    # remaining transcriptions after the last message timestamp belong to the last message
+    result[-1]['transcriptions'].extend(buckets[-1])
     return result
 
 
@@ -101,37 +206,348 @@ def process_for_audio(organized_transcriptions):
     return final_result
 
 
+def memmap_wav_file(file_path):
+    """
+    Memory-map the sample data of an uncompressed WAV file without decoding it.
+    :param file_path: The path of the WAV file.
+    :return: (rate, data) with data shaped (frames, channels), or None if the encoding is not supported.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        riff_header = file.read(12)
+        if len(riff_header) < 12 or riff_header[0:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+            return None
+        fmt = None
+        while chunk_header := file.read(8):
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = file.read(chunk_size)
+                # chunks are word aligned
+                file.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                break
+            else:
+                file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+        else:
+            return None
+        data_offset = file.tell()
+    if fmt is None or len(fmt) < 16:
+        return None
+    format_tag, channels, rate, _, block_align, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == WAV_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        # the real format tag is the first two bytes of the sub format GUID
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    dtype = WAV_MEMMAP_DTYPES.get((format_tag, bits_per_sample))
+    if dtype is None or block_align != dtype.itemsize * channels:
+        return None
+    # streaming recorders often leave the data size unset, trust the file size instead
+    frames = min(chunk_size, file_size - data_offset) // block_align
+    if frames == 0:
+        return None
+    data = np.memmap(file_path, dtype=dtype, mode='r', offset=data_offset, shape=(frames, channels))
+    return rate, data
+
+
 def load_wav_file(file_path):
-    data, rate = librosa.load(file_path, sr=None)
+    """
+    Load a WAV file without decoding it up front. Returns (rate, data) with data shaped (frames, channels),
+    memory-mapped for plain PCM/float WAVs and read with soundfile otherwise.
+    Slices of it are cheap views, use to_float32 on a segment before encoding it.
+    """
+    memmapped = memmap_wav_file(file_path)
+    if memmapped is not None:
+        return memmapped
+    data, rate = sf.read(file_path, dtype='float32', always_2d=True)
     return rate, data
 
 
+def to_float32(segment_data, mono=True):
+    """
+    Convert a (frames, channels) segment into the float32 signal in [-1, 1] that we encode,
+    downmixed to a single channel if mono.
+    """
+    if np.issubdtype(segment_data.dtype, np.integer):
+        segment_data = segment_data.astype(np.float32) / np.float32(-np.iinfo(segment_data.dtype).min)
+    if mono and segment_data.shape[1] > 1:
+        return segment_data.mean(axis=1, dtype=np.float32, keepdims=True)
+    return np.asarray(segment_data, dtype=np.float32)
+
+
+class ClipResampler:
+    """
+    Converts the blocks of a recording, in order, to the rate and channels of its clips.
+    The recording is resampled once as one continuous stream, however many clips are cut from it.
+    """
+
+    def __init__(self, rate: int, profile: ClipProfile):
+        self.rate = rate
+        self.output_rate = profile.output_rate(rate)
+        self.mono = profile.mono
+        self.channels = 1
+        self.stream = None
+
+    def process(self, block):
+        """
+        :param block: The next block of the recording, shaped (frames, channels).
+        :return: The block at the output rate, float32 shaped (frames, channels), or the block itself if the
+                 rate is kept, clips are converted when they are encoded then.
+        """
+        if self.output_rate == self.rate:
+            self.channels = block.shape[1]
+            return block
+        # downmix first, there is less to resample
+        block = to_float32(block, self.mono)
+        self.channels = block.shape[1]
+        if self.stream is None:
+            self.stream = soxr.ResampleStream(self.rate, self.output_rate, self.channels, dtype='float32',
+                                              quality=CLIP_RESAMPLE_QUALITY)
+        return self.stream.resample_chunk(block)
+
+    def flush(self):
+        """
+        :return: The last frames, held back by the resampler until the end of the recording.
+        """
+        end = np.zeros((0, self.channels), dtype=np.float32)
+        return end if self.stream is None else self.stream.resample_chunk(end, last=True)
+
+
+def resample_recording(data, resampler, block_frames=AUDIO_STREAM_BLOCK_FRAMES):
+    """
+    Resample a loaded recording a block at a time, a memory-mapped recording is never converted whole.
+    :return: The recording at the resampler's output rate, float32 shaped (frames, channels).
+    """
+    if resampler.output_rate == resampler.rate:
+        return data
+    blocks = [resampler.process(data[start:start + block_frames]) for start in range(0, len(data), block_frames)]
+    blocks.append(resampler.flush())
+    return np.concatenate(blocks)
+
+
 def write_audio_file(file_path, data, rate):
-    sf.write(file_path, data, rate)
+    sf.write(file_path, data, rate, **CLIP_PROFILE.encoder_args(rate, data.shape[1]))
 
 
-def cut_audio_segments(rate, data, final_result):
+def encode_audio_segment(file_name, segment_data, rate):
+    # create directories if they don't exist
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with OPERATION_DURATION.labels("clip_encode").time():
+        write_audio_file(file_name, to_float32(segment_data, CLIP_PROFILE.mono), rate)
+    return file_name
+
+
+def clip_file_name(thread_id, ws_conn_sid, msg_id):
+    # replace # in msg_id with _ to avoid path issues
+    msg_id_for_file = msg_id.replace("#", "_")
+    # save file to ./processed_media/{thread_id}/{ws_conn_sid}/{msg_id}.mp3, or the extension of the clip codec
+    return f"{PROCESSED_MEDIA_DIR}/{thread_id}/{ws_conn_sid}/{msg_id_for_file}.{CLIP_PROFILE.extension}"
+
+
+def cut_audio_segments(rate, data, final_result, publish_audio_ready=True):
+    """
+    Cut, encode, upload and flag the clips of a loaded recording.
+    :param rate: The sample rate of the recording.
+    :param data: The recording, shaped (frames, channels).
+    :param final_result: The processed metadata of the messages to cut, with thread_id and ws_conn_sid.
+    :param publish_audio_ready: Whether to announce the recording as done once its clips are exported.
+    :return: The IDs of the messages whose clip was exported.
+    """
+    thread_id = final_result.pop('thread_id')
+    ws_conn_sid = final_result.pop('ws_conn_sid')
+    message_update_handler = get_shared("message_update_handler", MessageUpdateHandler)
+    file_upload_handler = get_shared("file_upload_handler", FileUploadHandler)
+    resampler = ClipResampler(rate, CLIP_PROFILE)
+    output_rate = resampler.output_rate
+    # the frame of the recording data starts at, in the output rate
+    offset = 0
+    if output_rate != rate and final_result:
+        with job_stage("resample"):
+            # only the span the clips cover, a session is cut again every time it grows
+            span_start = max(min(int(info['relative_start'] * rate) for info in final_result.values()), 0)
+            span_end = max(int(info['relative_end'] * rate) for info in final_result.values())
+            data = resample_recording(data[span_start:span_end], resampler)
+            offset = round(span_start * output_rate / rate)
+    clip_files = {}
+    with job_stage("cut"), ThreadPoolExecutor(max_workers=CLIP_ENCODE_WORKERS) as executor:
+        for msg_id, info in final_result.items():
+            start_sample = max(int(info['relative_start'] * output_rate) - offset, 0)
+            end_sample = int(info['relative_end'] * output_rate) - offset
+            # a view into the recording, nothing is copied until the encoder converts it
+            segment_data = data[start_sample:end_sample]
+
+            file_name = clip_file_name(thread_id, ws_conn_sid, msg_id)
+            clip_files[msg_id] = executor.submit(encode_audio_segment, file_name, segment_data, output_rate)
+        clip_files = {msg_id: future.result() for msg_id, future in clip_files.items()}
+    # upload all clips to S3 in one concurrent batch
+    msg_ids_by_file = {file_name: msg_id for msg_id, file_name in clip_files.items()}
+    job_id = current_job_id()
+
+    def on_clip_uploaded(file_name, s3_key):
+        # tell the listening client right away, the rest of the recording may still be uploading
+        publish_event(thread_id, "clip_ready", {'ws_sid': ws_conn_sid, 'job_id': job_id,
+                                                'msg_id': msg_ids_by_file[file_name], 's3_key': s3_key})
+
+    with job_stage("upload"):
+        upload_results = file_upload_handler.upload_files(list(clip_files.values()), f"{thread_id}/", is_public=True,
+                                                          on_uploaded=on_clip_uploaded)
+    uploaded_msg_ids = [msg_id for msg_id, file_name in clip_files.items() if upload_results[file_name]]
+    for msg_id in clip_files.keys() - set(uploaded_msg_ids):
+        print(f"Failed to upload {clip_files[msg_id]}")
+    # update the messages in DynamoDB to set has_audio to True, all at once
+    with job_stage("flag"):
+        flag_results = message_update_handler.update_message_audio_flags(
+            thread_id, [msg_id[-13:] for msg_id in uploaded_msg_ids])
+    exported_msg_ids = [msg_id for msg_id in uploaded_msg_ids if flag_results[msg_id[-13:]]]
+    for msg_id in exported_msg_ids:
+        print(f"Exported {clip_files[msg_id]}")
+    if publish_audio_ready:
+        publish_event(thread_id, "audio_ready", {
+            'ws_sid': ws_conn_sid,
+            'job_id': job_id,
+            'msg_ids': exported_msg_ids,
+            'failed_msg_ids': [msg_id for msg_id in clip_files if msg_id not in exported_msg_ids]
+        })
+    return exported_msg_ids
+
+
+def read_audio_blocks(file_path, block_frames):
+    """
+    Read a recording block by block.
+    :param file_path: The path of the audio file.
+    :param block_frames: The number of frames per block.
+    :return: (rate, blocks) where blocks yields (first frame, data shaped (frames, channels)).
+             Blocks of plain PCM/float WAVs are views into the memory-mapped file.
+    """
+    memmapped = memmap_wav_file(file_path)
+    if memmapped is not None:
+        rate, data = memmapped
+        return rate, ((start, data[start:start + block_frames]) for start in range(0, len(data), block_frames))
+    rate = sf.info(file_path).samplerate
+
+    def decode_blocks():
+        start = 0
+        for block in sf.blocks(file_path, blocksize=block_frames, dtype='float32', always_2d=True):
+            yield start, block
+            start += len(block)
+
+    return rate, decode_blocks()
+
+
+class BlockBuffer:
+    """
+    The blocks of a recording that are read but still needed by a segment that is not cut yet.
+    """
+
+    def __init__(self):
+        self.blocks = deque()  # (first frame, data)
+        self.end = 0  # one past the last frame read
+
+    def append(self, start, block):
+        self.blocks.append((start, block))
+        self.end = start + len(block)
+
+    def segment(self, start, end):
+        """
+        Get the frames [start, end) that were read, without copying if they lie in a single block.
+        """
+        # empty blocks are skipped, concatenating one of another dtype would convert the samples unscaled
+        pieces = [block[max(start - block_start, 0):end - block_start] for block_start, block in self.blocks
+                  if len(block) and block_start < end and block_start + len(block) > start]
+        if len(pieces) == 1:
+            return pieces[0]
+        if not pieces:
+            channels, dtype = (self.blocks[0][1].shape[1], self.blocks[0][1].dtype) if self.blocks else (1, np.float32)
+            return np.zeros((0, channels), dtype=dtype)
+        return np.concatenate(pieces)
+
+    def discard_before(self, frame):
+        while self.blocks and self.blocks[0][0] + len(self.blocks[0][1]) <= frame:
+            self.blocks.popleft()
+
+
+def stream_audio_segments(wav_file_path, final_result, block_frames=AUDIO_STREAM_BLOCK_FRAMES):
+    """
+    Cut, encode, upload and flag the clips of a recording while it is being read. A message's clip is
+    cut as soon as the blocks read so far cover it, then encoded, uploaded and flagged in the background
+    while reading goes on, and announced to the thread's listeners with a clip_ready event.
+    Blocks are resampled to the rate of the clip profile as they are read.
+    :param wav_file_path: The path of the recording.
+    :param final_result: The processed metadata, as returned by process_recording_metadata.
+    :param block_frames: The number of frames read at a time.
+    """
     thread_id = final_result.pop('thread_id')
     ws_conn_sid = final_result.pop('ws_conn_sid')
-    message_update_handler = MessageUpdateHandler()
-    file_upload_handler = FileUploadHandler()
-    for msg_id, info in final_result.items():
-        start_sample = int(info['relative_start'] * rate)
-        end_sample = int(info['relative_end'] * rate)
-        segment_data = data[start_sample:end_sample]
-
-        # replace # in msg_id with _ to avoid path issues
-        msg_id_for_file = msg_id.replace("#", "_")
-        # save file to ./processed_media/{thread_id}/{ws_conn_sid}/{msg_id}.mp3
-        file_name = f"{PROCESSED_MEDIA_DIR}/{thread_id}/{ws_conn_sid}/{msg_id_for_file}.mp3"
-        # create directories if they don't exist
-        os.makedirs(os.path.dirname(file_name), exist_ok=True)
-        write_audio_file(file_name, segment_data, rate)
-        # update the message in DynamoDB to set has_audio to True
-        message_update_handler.update_message_audio_flag(thread_id, msg_id[-13:])
-        # upload the file to S3
-        file_upload_handler.upload_file(file_name, f"{thread_id}/", is_public=True)
+    message_update_handler = get_shared("message_update_handler", MessageUpdateHandler)
+    file_upload_handler = get_shared("file_upload_handler", FileUploadHandler)
+    job_id = current_job_id()
+    rate, blocks = read_audio_blocks(wav_file_path, block_frames)
+    resampler = ClipResampler(rate, CLIP_PROFILE)
+    output_rate = resampler.output_rate
+    # cut in the order the recording covers them, in frames of the output rate
+    segments = sorted(((int(info['relative_start'] * output_rate), int(info['relative_end'] * output_rate), msg_id)
+                       for msg_id, info in final_result.items()), key=lambda segment: segment[1])
+    # bounds the cut segments waiting for an encoder, in case reading outpaces encoding
+    encode_slots = threading.BoundedSemaphore(2 * CLIP_ENCODE_WORKERS)
+
+    def encode(file_name, segment_data):
+        try:
+            return encode_audio_segment(file_name, segment_data, output_rate)
+        finally:
+            encode_slots.release()
+
+    def export(msg_id, encoded):
+        file_name = encoded.result()
+        if not file_upload_handler.upload_file(file_name, f"{thread_id}/", is_public=True):
+            print(f"Failed to upload {file_name}")
+            return False
+        if not message_update_handler.update_message_audio_flag(thread_id, msg_id[-13:]):
+            return False
         print(f"Exported {file_name}")
+        publish_event(thread_id, "clip_ready", {
+            'ws_sid': ws_conn_sid, 'job_id': job_id, 'msg_id': msg_id,
+            's3_key': file_upload_handler.object_name(file_name, f"{thread_id}/")})
+        return True
+
+    exports = {}
+    buffer = BlockBuffer()
+    next_segment = 0
+    with ThreadPoolExecutor(max_workers=CLIP_ENCODE_WORKERS) as encode_executor, \
+            ThreadPoolExecutor(max_workers=CLIP_EXPORT_WORKERS) as export_executor:
+
+        def cut_segment(start, end, msg_id):
+            encode_slots.acquire()
+            encoded = encode_executor.submit(encode, clip_file_name(thread_id, ws_conn_sid, msg_id),
+                                             buffer.segment(start, end))
+            # the export thread waits for its clip's encoder, so uploads start while later clips encode
+            exports[msg_id] = export_executor.submit(export, msg_id, encoded)
+
+        def add_block(block):
+            nonlocal next_segment
+            buffer.append(buffer.end, block)
+            while next_segment < len(segments) and segments[next_segment][1] <= buffer.end:
+                cut_segment(*segments[next_segment])
+                next_segment += 1
+            # segments may overlap, keep everything from the earliest start still to be cut
+            buffer.discard_before(min((start for start, _, _ in segments[next_segment:]), default=buffer.end))
+
+        with job_stage("decode"):
+            for _, block in blocks:
+                # resampled as it is read, blocks are never resampled again for overlapping clips
+                add_block(resampler.process(block))
+            if output_rate != rate:
+                add_block(resampler.flush())
+            # segments running past the end of the recording get what there is, like slicing would
+            for segment in segments[next_segment:]:
+                cut_segment(*segment)
+        with job_stage("export"):
+            results = {msg_id: future.result() for msg_id, future in exports.items()}
+    publish_event(thread_id, "audio_ready", {
+        'ws_sid': ws_conn_sid,
+        'job_id': job_id,
+        'msg_ids': [msg_id for msg_id, exported in results.items() if exported],
+        'failed_msg_ids': [msg_id for msg_id, exported in results.items() if not exported]
+    })
 
 
 def datetime_converter(o):
@@ -141,9 +557,27 @@ def datetime_converter(o):
 
 
 def process_recording_metadata(metadata_file_path) -> dict | bool:
+    with job_stage("metadata"):
+        return _process_recording_metadata(metadata_file_path)
+
+
+def _process_recording_metadata(metadata_file_path) -> dict | bool:
     with open(metadata_file_path, 'r') as file:
         metadata = json.load(file)
+    final_result = process_metadata(metadata)
+    if final_result is False:
+        return False
+    save_processed_metadata(final_result)
+    return final_result
+
 
+def process_metadata(metadata) -> dict | bool:
+    """
+    Turn recording metadata into the per message clip ranges and transcriptions.
+    :param metadata: The recording metadata as uploaded by the client.
+    :return: The clip range and transcriptions of every message with audio, plus thread_id and ws_conn_sid,
+             or False if there is nothing to cut.
+    """
     audio_timestamps = metadata['audio_timestamps']
     audio_started_at = metadata['audio_started_at']
     audio_pause_timestamps = metadata['audio_pause_timestamps']
@@ -167,17 +601,25 @@ def process_recording_metadata(metadata_file_path) -> dict | bool:
     final_result = process_for_audio(organized_transcriptions)
     final_result['thread_id'] = thread_id
     final_result['ws_conn_sid'] = ws_conn_sid
+    return final_result
+
 
+def save_processed_metadata(final_result):
+    thread_id = final_result['thread_id']
+    ws_conn_sid = final_result['ws_conn_sid']
     # save final_result to json file in ./processed_media/{thread_id}/{ws_conn_sid}/thread_id[0:8]_ws_conn_sid_processed.json
     file_name = f"{PROCESSED_MEDIA_DIR}/{thread_id}/{ws_conn_sid}/{thread_id[0:8]}_{ws_conn_sid}_processed.json"
     os.makedirs(os.path.dirname(file_name), exist_ok=True)
     with open(file_name, 'w') as file:
         json.dump(final_result, file, indent=2, default=datetime_converter)
-    file_upload_handler = FileUploadHandler()
+    file_upload_handler = get_shared("file_upload_handler", FileUploadHandler)
     file_upload_handler.upload_file(file_name, f"{thread_id}/")
-    return final_result
 
 
 def process_audio_file(wav_file_path, final_result):
-    rate, data = load_wav_file(wav_file_path)
+    if AUDIO_STREAM_PROCESSING:
+        stream_audio_segments(wav_file_path, final_result)
+        return
+    with job_stage("decode"):
+        rate, data = load_wav_file(wav_file_path)
     cut_audio_segments(rate, data, final_result)
@@ -0,0 +1,317 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: benchmark.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/18/26 00:20
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+# the pipeline's metrics write their samples to this directory, keep away from a worker running on the same host
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prepit_bench_metrics_"))
+
+from ClientRegistry import get_shared, S3_UPLOAD_CONCURRENCY  # noqa: E402
+from MessageUpdateHandler import MessageUpdateHandler  # noqa: E402
+import audio_processing  # noqa: E402
+from audio_processing import (process_recording_metadata, load_wav_file, cut_audio_segments,  # noqa: E402
+                              stream_audio_segments, CLIP_PROFILES)
+
+# metadata the benchmark was run with, a regression check only compares runs of the same workload
+WORKLOAD_FIELDS = ("duration", "rate", "channels", "subtype", "messages", "entries", "pauses", "mode",
+                   "concurrency", "s3_latency", "dynamodb_latency", "clip_profile")
+STAGES = ("metadata", "load", "cut", "total")
+
+
+def generate_wav(path: str, duration: float, rate: int, channels: int, subtype: str, block_seconds: int = 10):
+    """
+    Write a synthetic recording, a quiet tone with noise, block by block so long recordings fit in memory.
+    """
+    rng = np.random.default_rng(0)
+    total_frames = int(duration * rate)
+    with sf.SoundFile(path, 'w', samplerate=rate, channels=channels, subtype=subtype) as file:
+        for start in range(0, total_frames, block_seconds * rate):
+            frames = min(block_seconds * rate, total_frames - start)
+            t = (start + np.arange(frames)) / rate
+            tone = 0.2 * np.sin(2 * np.pi * 220 * t)
+            block = tone[:, None] + 0.05 * rng.standard_normal((frames, channels))
+            file.write(block.astype(np.float32))
+
+
+def generate_metadata(duration: float, messages: int, entries: int, pauses: int, thread_id: str = "bench_thread",
+                      ws_conn_sid: str = "bench_ws", audio_started_at: int = 1_700_000_000_000) -> dict:
+    """
+    Generate the metadata of a recording in the client's format.
+    The recording is split evenly into messages, each spoken as entries transcriptions with an interim
+    result before every final one, and the recording is paused pauses times between messages.
+    """
+    message_seconds = duration / messages
+    pause_after = set(np.linspace(0, messages - 1, pauses + 2, dtype=int)[1:-1]) if pauses else set()
+    audio_timestamps = []
+    audio_pause_timestamps = []
+    user_msg_timestamps = {}
+    paused_ms = 0
+
+    def absolute_ms(relative_seconds: float) -> int:
+        return int(audio_started_at + relative_seconds * 1000 + paused_ms)
+
+    for message in range(messages):
+        message_start = message * message_seconds
+        # a gap of silence before the next message
+        entry_seconds = message_seconds * 0.9 / entries
+        for entry in range(entries):
+            start = round(message_start + entry * entry_seconds, 3)
+            for is_final in (False, True):
+                audio_timestamps.append({
+                    'start': start,
+                    'duration': round(entry_seconds, 3),
+                    'text': f"message {message} part {entry}",
+                    'is_final': is_final,
+                    'timestamp': absolute_ms(start + entry_seconds)
+                })
+        message_end = message_start + message_seconds * 0.9
+        msg_timestamp = absolute_ms(message_end) + 500
+        user_msg_timestamps[str(msg_timestamp)] = f"{thread_id}#{msg_timestamp:013d}"
+        if message in pause_after:
+            pause_start = absolute_ms(message_start + message_seconds)
+            paused_ms += 5000
+            audio_pause_timestamps.append([pause_start, pause_start + 5000])
+    return {
+        'thread_id': thread_id,
+        'ws_conn_sid': ws_conn_sid,
+        'audio_started_at': audio_started_at,
+        'audio_timestamps': audio_timestamps,
+        'audio_pause_timestamps': audio_pause_timestamps,
+        'user_msg_timestamps': user_msg_timestamps
+    }
+
+
+class LocalTransferManager:
+    """
+    Stands in for the S3 transfer manager of FileUploadHandler, copying objects into a local directory.
+    """
+
+    def __init__(self, root: str, latency: float):
+        self.root = root
+        self.latency = latency
+        self.executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_CONCURRENCY)
+
+    def copy(self, local_file_path, bucket, object_name):
+        time.sleep(self.latency)
+        target = os.path.join(self.root, bucket, object_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(local_file_path, target)
+
+    def upload(self, fileobj, bucket, key, extra_args=None, subscribers=None):
+        future = self.executor.submit(self.copy, fileobj, bucket, key)
+        for subscriber in subscribers or []:
+            future.add_done_callback(lambda done, subscriber=subscriber: subscriber.on_done(future=done))
+        return future
+
+
+class LocalMessageUpdateHandler(MessageUpdateHandler):
+    """
+    Stands in for DynamoDB, every update just takes latency seconds.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def update_message_audio_flag(self, thread_id: str, created_at: str) -> bool:
+        time.sleep(self.latency)
+        return True
+
+    def update_message_audio_flags(self, thread_id: str, created_at_list: list[str]) -> dict:
+        if not created_at_list:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(16, len(created_at_list))) as executor:
+            return dict(zip(created_at_list, executor.map(
+                lambda created_at: self.update_message_audio_flag(thread_id, created_at), created_at_list)))
+
+
+class LocalEventPublisher:
+    """
+    Stands in for redis pub/sub, events are counted and dropped.
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, thread_id: str, event: str, data: dict) -> bool:
+        self.published += 1
+        return True
+
+
+def install_stand_ins(workdir: str, s3_latency: float, dynamodb_latency: float, verbose: bool, clip_profile: str):
+    """
+    Register the local stand-ins before the pipeline creates the real clients. Run in every pool process,
+    forked children drop the instances of their parent.
+    """
+    # the pipeline writes its clips relative to the working directory, one per process so concurrent jobs
+    # never clean up each other's clips
+    os.chdir(tempfile.mkdtemp(dir=workdir))
+    if not verbose:
+        # the pipeline prints a line per clip
+        sys.stdout = open(os.devnull, 'w')
+    get_shared("s3_transfer_manager", lambda: LocalTransferManager(os.path.join(workdir, "s3"), s3_latency))
+    get_shared("message_update_handler", lambda: LocalMessageUpdateHandler(dynamodb_latency))
+    get_shared("event_publish_handler", LocalEventPublisher)
+    audio_processing.CLIP_PROFILE = CLIP_PROFILES[clip_profile]
+
+
+def run_job(wav_path: str, metadata_path: str, mode: str) -> dict:
+    """
+    Process one recording like the worker does, timing every stage.
+    :return: The seconds spent per stage, the number of exported clips and their total size in bytes.
+    """
+    timings = {}
+    started_at = time.perf_counter()
+    final_result = process_recording_metadata(metadata_path)
+    timings['metadata'] = time.perf_counter() - started_at
+    clips = len(final_result) - 2
+    if mode == "stream":
+        # decoding overlaps with cutting, there is no separate load stage
+        cut_started_at = time.perf_counter()
+        stream_audio_segments(wav_path, final_result)
+        timings['cut'] = time.perf_counter() - cut_started_at
+    else:
+        load_started_at = time.perf_counter()
+        rate, data = load_wav_file(wav_path)
+        timings['load'] = time.perf_counter() - load_started_at
+        cut_started_at = time.perf_counter()
+        cut_audio_segments(rate, data, final_result)
+        timings['cut'] = time.perf_counter() - cut_started_at
+    timings['total'] = time.perf_counter() - started_at
+    clip_bytes = sum(os.path.getsize(os.path.join(directory, file_name))
+                     for directory, _, file_names in os.walk("processed_media")
+                     for file_name in file_names if not file_name.endswith(".json"))
+    shutil.rmtree("processed_media", ignore_errors=True)
+    return {'timings': timings, 'clips': clips, 'clip_bytes': clip_bytes}
+
+
+def percentiles(values: list[float]) -> dict:
+    return {
+        'mean': float(np.mean(values)),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(np.max(values))
+    }
+
+
+def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="prepit_bench_")
+    try:
+        wav_path = os.path.join(workdir, "recording.wav")
+        metadata_path = os.path.join(workdir, "recording.json")
+        generate_wav(wav_path, args.duration, args.rate, args.channels, args.subtype)
+        with open(metadata_path, 'w') as file:
+            json.dump(generate_metadata(args.duration, args.messages, args.entries, args.pauses), file)
+        # every job of the benchmark runs in a process of its own, like the worker's audio pool
+        with ProcessPoolExecutor(max_workers=args.concurrency, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=install_stand_ins,
+                                 initargs=(workdir, args.s3_latency, args.dynamodb_latency, args.verbose,
+                                           args.clip_profile)) as executor:
+            for _ in range(args.warmup):
+                executor.submit(run_job, wav_path, metadata_path, args.mode).result()
+            started_at = time.perf_counter()
+            jobs = list(executor.map(run_job, *zip(*[(wav_path, metadata_path, args.mode)] * args.iterations)))
+            wall_time = time.perf_counter() - started_at
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    clips = sum(job['clips'] for job in jobs)
+    return {
+        'workload': {field: getattr(args, field) for field in WORKLOAD_FIELDS},
+        'iterations': args.iterations,
+        'wall_time': wall_time,
+        'throughput': {
+            'jobs_per_second': len(jobs) / wall_time,
+            'clips_per_second': clips / wall_time,
+            # seconds of recording processed per second, how many recorders a replica keeps up with
+            'audio_realtime_factor': len(jobs) * args.duration / wall_time
+        },
+        'clip_bytes_per_job': float(np.mean([job['clip_bytes'] for job in jobs])),
+        'stages': {stage: percentiles([job['timings'][stage] for job in jobs])
+                   for stage in STAGES if stage in jobs[0]['timings']}
+    }
+
+
+def print_report(report: dict):
+    workload = report['workload']
+    print(f"\n{workload['duration']:.0f}s recording, {workload['messages']} messages x {workload['entries']} entries, "
+          f"{workload['pauses']} pauses, {workload['mode']} mode, {report['iterations']} jobs "
+          f"at concurrency {workload['concurrency']}")
+    print(f"{'stage':<10}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, stats in report['stages'].items():
+        print(f"{stage:<10}" + "".join(f"{stats[key]:>10.3f}" for key in ('mean', 'p50', 'p95', 'p99', 'max')))
+    throughput = report['throughput']
+    print(f"\n{throughput['jobs_per_second']:.2f} jobs/s, {throughput['clips_per_second']:.1f} clips/s, "
+          f"{throughput['audio_realtime_factor']:.0f}x realtime")
+    print(f"{workload['clip_profile']} clips: {report['clip_bytes_per_job'] / 1024 ** 2:.2f}MB per job")
+
+
+def check_regression(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compare the p50 of every stage with a baseline report of the same workload.
+    :return: A description of every stage that got slower than tolerance allows.
+    """
+    if baseline['workload'] != report['workload']:
+        raise ValueError("The baseline was run with a different workload")
+    regressions = []
+    for stage, stats in report['stages'].items():
+        baseline_p50 = baseline['stages'].get(stage, {}).get('p50')
+        if baseline_p50 and stats['p50'] > baseline_p50 * (1 + tolerance):
+            regressions.append(f"{stage} p50 {stats['p50']:.3f}s vs {baseline_p50:.3f}s in the baseline")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the audio pipeline on a synthetic recording, "
+                                                 "with local stand-ins for S3, DynamoDB and redis.")
+    parser.add_argument("--duration", type=float, default=600, help="recording length in seconds")
+    parser.add_argument("--rate", type=int, default=48000)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--subtype", default="PCM_16", help="WAV sample format, e.g. PCM_16, PCM_24 or FLOAT")
+    parser.add_argument("--messages", type=int, default=30, help="user messages in the recording")
+    parser.add_argument("--entries", type=int, default=10, help="transcript entries per message")
+    parser.add_argument("--pauses", type=int, default=3, help="pauses of the recording, between messages")
+    parser.add_argument("--mode", choices=("stream", "batch"), default="stream",
+                        help="stream_audio_segments, or load_wav_file then cut_audio_segments")
+    parser.add_argument("--clip-profile", choices=tuple(CLIP_PROFILES), default="original",
+                        help="output profile of the clips")
+    parser.add_argument("--iterations", type=int, default=10, help="jobs to measure")
+    parser.add_argument("--warmup", type=int, default=1, help="jobs to run before measuring")
+    parser.add_argument("--concurrency", type=int, default=1, help="jobs running at once, like AUDIO_WORKERS")
+    parser.add_argument("--s3-latency", type=float, default=0.05, help="seconds per S3 upload")
+    parser.add_argument("--dynamodb-latency", type=float, default=0.01, help="seconds per DynamoDB update")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's output")
+    parser.add_argument("--output", help="write the report as json to this file")
+    parser.add_argument("--baseline", help="a json report to compare with, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p50 slowdown against the baseline")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmark(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = check_regression(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -7,14 +7,17 @@
 @time: 6/29/24 22:53
 """
 import json
+import logging
 import os
 from AgentPromptHandler import AgentPromptHandler
 from FeedbackStorageHandler import FeedbackStorageHandler
-from openai import OpenAI
-from anthropic import Anthropic
-from dotenv import load_dotenv
-
-load_dotenv(dotenv_path="/run/secrets/prepit-secret")
+from ClientRegistry import get_shared, get_redis_client
+from FeedbackLLMClient import FeedbackLLMClient, OpenAIProvider, AnthropicProvider, StubProvider
+from FeedbackProviderRouter import FeedbackProviderRouter
+from FeedbackResultCache import FeedbackResultCache, feedback_cache_key
+from TTLCache import TTLCache
+from JobStateHandler import job_stage, current_job_id
+from EventPublishHandler import publish_event
 
 PROCESSED_MEDIA_DIR = "./processed_media"
 FEEDBACK_SYSTEM_PROMPT_TEMPLATE = """
@@ -44,11 +47,67 @@ FEEDBACK_USER_PROMPT_TEMPLATE = """
 {feedback_step_transcript}
 # Please write feedback for the candidate based on the information above. You should directly start the feedback and should not include any extra sentence at the start or the end of your response.
 """
-FEEDBACK_AI_PROVIDER = "openai"  # "openai" or "anthropic"
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-agent_prompt_handler = AgentPromptHandler()
-feedback_storage_handler = FeedbackStorageHandler()
+# providers in order of preference, the first one is the primary and the others are fallbacks.
+# "stub" and "stub-<name>" are local fake providers, e.g. "stub-fast,stub-slow" to try the routing offline
+FEEDBACK_AI_PROVIDERS = os.getenv("FEEDBACK_AI_PROVIDERS", "openai,anthropic")
+# setting this redis key to a provider list overrides FEEDBACK_AI_PROVIDERS at runtime, without a redeploy
+FEEDBACK_AI_PROVIDERS_KEY = "prepit_feedback_providers"
+FEEDBACK_AI_PROVIDERS_REFRESH = float(os.getenv("FEEDBACK_AI_PROVIDERS_REFRESH", "30"))
+STUB_PROVIDER_LATENCY = float(os.getenv("STUB_PROVIDER_LATENCY", "0.5"))
+STUB_PROVIDER_FAILURE_RATE = float(os.getenv("STUB_PROVIDER_FAILURE_RATE", "0"))
+OPENAI_FEEDBACK_MODEL = "gpt-4o"
+ANTHROPIC_FEEDBACK_MODEL = "claude-3-5-sonnet-latest"
+
+
+def get_agent_prompt_handler() -> AgentPromptHandler:
+    return get_shared("agent_prompt_handler", AgentPromptHandler)
+
+
+def get_feedback_storage_handler() -> FeedbackStorageHandler:
+    return get_shared("feedback_storage_handler", FeedbackStorageHandler)
+
+
+def parse_provider_list(providers: str) -> list[str]:
+    return [name.strip() for name in providers.split(",") if name.strip()]
+
+
+def create_feedback_llm_client() -> FeedbackLLMClient:
+    providers = [OpenAIProvider(OPENAI_FEEDBACK_MODEL), AnthropicProvider(ANTHROPIC_FEEDBACK_MODEL)]
+    for name in parse_provider_list(FEEDBACK_AI_PROVIDERS):
+        if name == "stub" or name.startswith("stub-"):
+            providers.append(StubProvider(name, latency=STUB_PROVIDER_LATENCY,
+                                          failure_rate=STUB_PROVIDER_FAILURE_RATE))
+    return FeedbackLLMClient(providers)
+
+
+def get_feedback_llm_client() -> FeedbackLLMClient:
+    return get_shared("feedback_llm_client", create_feedback_llm_client)
+
+
+def get_provider_order() -> list[str]:
+    """
+    Get the current feedback provider order, the redis override if set, FEEDBACK_AI_PROVIDERS otherwise.
+    The override is re-read at most every FEEDBACK_AI_PROVIDERS_REFRESH seconds.
+    """
+    cache = get_shared("feedback_provider_order", lambda: TTLCache(1, FEEDBACK_AI_PROVIDERS_REFRESH))
+    order = cache.get(FEEDBACK_AI_PROVIDERS_KEY)
+    if order is None:
+        try:
+            override = get_redis_client().get(FEEDBACK_AI_PROVIDERS_KEY)
+        except Exception as e:
+            logging.warning(f"Could not read the feedback provider override: {e}")
+            override = None
+        order = parse_provider_list(override or FEEDBACK_AI_PROVIDERS)
+        cache.set(FEEDBACK_AI_PROVIDERS_KEY, order)
+    return order
+
+
+def get_feedback_router() -> FeedbackProviderRouter:
+    return get_shared("feedback_router", lambda: FeedbackProviderRouter(get_feedback_llm_client(), get_provider_order))
+
+
+def get_feedback_result_cache() -> FeedbackResultCache:
+    return get_shared("feedback_result_cache", FeedbackResultCache)
 
 
 def parse_messages_file(messages_file_path: str) -> str:
@@ -73,8 +132,13 @@ def gather_feedback_prompts(agent_id: str, step_id: int) -> dict:
     :param step_id: step id
     :return: feedback prompts
     """
-    current_step_prompt = agent_prompt_handler.get_agent_prompt(agent_id, str(step_id))
-    current_step_prompt = json.loads(current_step_prompt)
+    agent_prompt_handler = get_agent_prompt_handler()
+    agent_prompt_handler.mark_agent_active(agent_id)
+    prompts = agent_prompt_handler.get_agent_prompts(agent_id, [str(step_id), "0"])
+    current_step_prompt = prompts[str(step_id)]
+    case_background_step = prompts["0"]
+    if current_step_prompt is None or case_background_step is None:
+        raise ValueError(f"Missing agent prompt for agent {agent_id} at step {step_id} or 0")
     feedback_step_name = current_step_prompt['title']
     feedback_step_instructions = current_step_prompt['instruction']
     feedback_step_info = current_step_prompt['information']
@@ -82,8 +146,6 @@ def gather_feedback_prompts(agent_id: str, step_id: int) -> dict:
         'answer'] else ""
     if feedback_step_answer.strip():
         feedback_step_answer = f"# And here is the recommended answer, and other comment for you as a feedback provider. You MUST follow instructions here, if there's any, as a feedback provider: {feedback_step_answer}"
-    case_background_step = agent_prompt_handler.get_agent_prompt(agent_id, "0")
-    case_background_step = json.loads(case_background_step)
     case_background = case_background_step['information']
     return {
         "case_background": case_background,
@@ -94,49 +156,6 @@ def gather_feedback_prompts(agent_id: str, step_id: int) -> dict:
     }
 
 
-def openai_generate_feedback(template_contents: dict, formatted_messages: str) -> str:
-    """
-    Generate feedback using OpenAI
-    :param template_contents: feedback prompts
-    :param formatted_messages: formatted messages
-    :return: feedback
-    """
-    template_contents['feedback_step_transcript'] = formatted_messages
-    openai_messages = [
-        {"role": "system", "content": FEEDBACK_SYSTEM_PROMPT_TEMPLATE},
-        {"role": "user", "content": FEEDBACK_USER_PROMPT_TEMPLATE.format(**template_contents)}
-    ]
-    completion = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=openai_messages
-    )
-    print("openai messages: ", openai_messages)
-    print("openai feedback: ", completion.choices[0].message.content)
-    return str(completion.choices[0].message.content)
-
-
-def anthropic_generate_feedback(template_contents: dict, formatted_messages: str) -> str:
-    """
-    Generate feedback using Anthropic
-    :param template_contents: feedback prompts
-    :param formatted_messages: formatted messages
-    :return: feedback
-    """
-    template_contents['feedback_step_transcript'] = formatted_messages
-    anthropic_messages = [
-        {"role": "user", "content": FEEDBACK_USER_PROMPT_TEMPLATE.format(**template_contents)}
-    ]
-    completion = anthropic_client.messages.create(
-        model="claude-3-5-sonnet-latest",
-        system=FEEDBACK_SYSTEM_PROMPT_TEMPLATE,
-        messages=anthropic_messages,
-        max_tokens=1024
-    )
-    print("anthropic messages: ", anthropic_messages)
-    print("anthropic feedback: ", completion.content[0].text)
-    return str(completion.content[0].text)
-
-
 def get_feedback(messages_file_path: str, thread_id: str, agent_id: str, step_id: int):
     """
     Process feedback
@@ -145,22 +164,29 @@ def get_feedback(messages_file_path: str, thread_id: str, agent_id: str, step_id
     :param agent_id: agent id
     :param step_id: step id
     """
-    formatted_messages = parse_messages_file(messages_file_path)
-    feedback_prompts = gather_feedback_prompts(agent_id, step_id)
-    if FEEDBACK_AI_PROVIDER == "openai":
-        feedback = openai_generate_feedback(feedback_prompts, formatted_messages)
-    elif FEEDBACK_AI_PROVIDER == "anthropic":
-        feedback = anthropic_generate_feedback(feedback_prompts, formatted_messages)
-    else:
-        raise ValueError(f"Unknown feedback AI provider: {FEEDBACK_AI_PROVIDER}")
-    feedback_storage_handler.put_feedback(thread_id, agent_id, step_id, feedback_prompts['feedback_step_name'],
-                                          feedback)
+    with job_stage("prompts"):
+        formatted_messages = parse_messages_file(messages_file_path)
+        feedback_prompts = gather_feedback_prompts(agent_id, step_id)
+    feedback_prompts['feedback_step_transcript'] = formatted_messages
+    user_prompt = FEEDBACK_USER_PROMPT_TEMPLATE.format(**feedback_prompts)
+    providers = get_feedback_llm_client().providers
+    models = [f"{name}/{providers[name].model}" for name in get_provider_order() if name in providers]
+    cache_key = feedback_cache_key(FEEDBACK_SYSTEM_PROMPT_TEMPLATE, user_prompt, models)
+    with job_stage("feedback"):
+        result, cached = get_feedback_result_cache().get_or_generate(
+            cache_key, lambda: get_feedback_router().generate(FEEDBACK_SYSTEM_PROMPT_TEMPLATE, user_prompt))
+    if cached:
+        logging.info(f"Reusing cached feedback {cache_key[:12]} for thread {thread_id} step {step_id}")
+    feedback = result.text
+    with job_stage("store"):
+        get_feedback_storage_handler().put_feedback(thread_id, agent_id, step_id,
+                                                    feedback_prompts['feedback_step_name'], feedback)
     feedback_dict = {
         "thread_id": thread_id,
         "agent_id": agent_id,
         "step_id": step_id,
         "step_title": feedback_prompts['feedback_step_name'],
-        "feedback_provider": FEEDBACK_AI_PROVIDER,
+        "feedback_provider": result.provider,
         "feedback": feedback
     }
     # Save the feedback to the processed media directory
@@ -169,4 +195,5 @@ def get_feedback(messages_file_path: str, thread_id: str, agent_id: str, step_id
     with open(feedback_file_path, 'w') as file:
         json.dump(feedback_dict, file, indent=2)
     print(f"Feedback saved to {feedback_file_path}")
+    publish_event(thread_id, "feedback_ready", {'job_id': current_job_id(), **feedback_dict})
     return
@@ -0,0 +1,137 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: session_processing.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 22:40
+"""
+import json
+import os
+import uuid
+
+import numpy as np
+
+from audio_processing import process_metadata, save_processed_metadata, cut_audio_segments
+from ClientRegistry import get_redis_client
+from EventPublishHandler import publish_event
+from JobStateHandler import job_stage, current_job_id
+
+# the spool layout is shared with the API's SessionSpool
+SESSION_SPOOL_DIR = "./unprocessed_media/sessions"
+SESSION_PCM_DTYPES = {
+    'pcm16': np.dtype('<i2'),
+    'float32': np.dtype('<f4')
+}
+SESSION_LOCK_PREFIX = "prepit_session_lock:"
+SESSION_EXPORTED_PREFIX = "prepit_session_exported:"
+SESSION_LOCK_TTL = int(os.getenv("SESSION_LOCK_TTL", "600"))
+SESSION_STATE_TTL = int(os.getenv("SESSION_STATE_TTL", str(7 * 24 * 3600)))
+
+# deletes the lock only if it is still ours, it may have expired and been taken by another worker
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SessionBusyError(Exception):
+    """Another worker is processing the session, the task is retried later."""
+
+
+def load_session(session_id: str) -> tuple[dict, dict]:
+    """
+    Load a session's settings and its metadata merged so far.
+    :return: (session, metadata) with metadata in the format of a whole recording's metadata file.
+    """
+    session_dir = os.path.join(SESSION_SPOOL_DIR, session_id)
+    with open(os.path.join(session_dir, "session.json"), 'r') as file:
+        session = json.load(file)
+    metadata_path = os.path.join(session_dir, "metadata.json")
+    merged = {}
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as file:
+            merged = json.load(file)
+    metadata = {
+        'thread_id': session['thread_id'],
+        'ws_conn_sid': session['ws_sid'],
+        'audio_started_at': session['audio_started_at'],
+        'audio_timestamps': merged.get('audio_timestamps', []),
+        'audio_pause_timestamps': merged.get('audio_pause_timestamps', []),
+        'user_msg_timestamps': merged.get('user_msg_timestamps', {})
+    }
+    return session, metadata
+
+
+def memmap_session_audio(session_id: str, session: dict):
+    """
+    Memory-map the raw audio spooled so far.
+    :return: The samples shaped (frames, channels), only whole frames.
+    """
+    path = os.path.join(SESSION_SPOOL_DIR, session_id, "audio.pcm")
+    dtype = SESSION_PCM_DTYPES[session['sample_format']]
+    frame_bytes = dtype.itemsize * session['channels']
+    frames = os.path.getsize(path) // frame_bytes if os.path.exists(path) else 0
+    if frames == 0:
+        return np.zeros((0, session['channels']), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(frames, session['channels']))
+
+
+def pending_messages(final_result: dict, metadata: dict, exported: set, rate: int, frames: int,
+                     final: bool) -> dict:
+    """
+    Pick the messages whose clip can be cut now.
+    Until the session is finalized the last message may still get transcriptions, and a message
+    is only cut once all of its audio is spooled.
+    """
+    last_msg_id = max(metadata['user_msg_timestamps'].items(), key=lambda item: int(item[0]))[1]
+    return {msg_id: info for msg_id, info in final_result.items()
+            if msg_id not in exported
+            and (final or (msg_id != last_msg_id and int(info['relative_end'] * rate) <= frames))}
+
+
+def process_session(session_id: str, final: bool):
+    """
+    Export the clips of the messages a session has completed so far, or of all of them once it is final.
+    Every clip is exported once, however many tasks the session queues.
+    :param session_id: The ID of the session.
+    :param final: Whether the session ended, which exports the remaining messages and the processed metadata.
+    """
+    redis_client = get_redis_client()
+    lock_key = SESSION_LOCK_PREFIX + session_id
+    token = uuid.uuid4().hex
+    if not redis_client.set(lock_key, token, nx=True, ex=SESSION_LOCK_TTL):
+        raise SessionBusyError(f"Session {session_id} is being processed by another worker")
+    try:
+        with job_stage("metadata"):
+            session, metadata = load_session(session_id)
+            final_result = process_metadata(metadata)
+        if final_result is False:
+            return
+        thread_id = final_result.pop('thread_id')
+        ws_conn_sid = final_result.pop('ws_conn_sid')
+        exported_key = SESSION_EXPORTED_PREFIX + session_id
+        exported = set(redis_client.smembers(exported_key))
+        data = memmap_session_audio(session_id, session)
+        pending = pending_messages(final_result, metadata, exported, session['sample_rate'], len(data), final)
+        print(f"Session {session_id}: {len(pending)} messages to export, {len(exported)} already exported")
+        if pending:
+            exported_now = cut_audio_segments(session['sample_rate'], data,
+                                              {**pending, 'thread_id': thread_id, 'ws_conn_sid': ws_conn_sid},
+                                              publish_audio_ready=False)
+            if exported_now:
+                redis_client.sadd(exported_key, *exported_now)
+                redis_client.expire(exported_key, SESSION_STATE_TTL)
+            exported.update(exported_now)
+        if final:
+            save_processed_metadata({**final_result, 'thread_id': thread_id, 'ws_conn_sid': ws_conn_sid})
+            publish_event(thread_id, "audio_ready", {
+                'ws_sid': ws_conn_sid,
+                'job_id': current_job_id(),
+                'msg_ids': [msg_id for msg_id in final_result if msg_id in exported],
+                'failed_msg_ids': [msg_id for msg_id in final_result if msg_id not in exported]
+            })
+    finally:
+        redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
@@ -6,16 +6,56 @@
 @email: rxy216@case.edu
 @time: 6/26/24 20:54
 """
-import pika
 import json
+import sys
 import time
 import os
-from audio_processing import process_recording_metadata, process_audio_file
-from feedback_processing import get_feedback
+from ConsumerEngine import ConsumerEngine, QueueSpec, PoisonMessageError
+from audio_processing import process_recording_metadata, process_audio_file, CLIP_PROFILE
+from feedback_processing import get_feedback, get_agent_prompt_handler
+from session_processing import process_session, SessionBusyError
+from AgentPromptHandler import PromptCacheWarmer
+from JobStateHandler import get_job_state_handler, job_context
+from JobProfiler import profile_job, PROFILE_MODE, PROFILE_DIR, PROFILE_SLOW_THRESHOLD
+from Metrics import (TASK_DURATION, TASK_ERRORS, DEAD_LETTERS, QUEUE_WAIT, QUEUE_LAG, QUEUE_MESSAGES, QUEUE_CONSUMERS,
+                     clear_metrics_dir, start_metrics_server)
 
 UNPROCESSED_MEDIA_DIR = "./unprocessed_media"
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+# legacy shared queue, still drained so messages published before the queue split are not lost
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "prepit_processing")
+RABBITMQ_AUDIO_QUEUE = os.getenv("RABBITMQ_AUDIO_QUEUE", "prepit_audio_processing")
+RABBITMQ_FEEDBACK_QUEUE = os.getenv("RABBITMQ_FEEDBACK_QUEUE", "prepit_feedback_processing")
+RABBITMQ_MAX_PRIORITY = int(os.getenv("RABBITMQ_MAX_PRIORITY", "10"))
+# comma separated task types this replica consumes, so each task class can be scaled on its own
+WORKER_TASK_TYPES = [task_type.strip() for task_type in
+                     os.getenv("WORKER_TASK_TYPES", "audio_processing,feedback_processing").split(",")
+                     if task_type.strip()]
+# audio slicing is CPU-bound and runs in processes, feedback waits on the LLM and runs in threads
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "2"))
+# feedback threads only wait on the shared LLM event loop, LLM_MAX_CONCURRENCY bounds the real load
+FEEDBACK_WORKERS = int(os.getenv("FEEDBACK_WORKERS", "32"))
+MAX_TASK_RETRIES = int(os.getenv("MAX_TASK_RETRIES", "3"))
+TASK_RETRY_BASE_DELAY_MS = int(os.getenv("TASK_RETRY_BASE_DELAY_MS", "10000"))
+# a missing upload or a malformed message/metadata file fails the same way on every attempt
+NON_RETRYABLE_ERRORS = (PoisonMessageError, KeyError, json.JSONDecodeError, FileNotFoundError)
+# seconds between prompt cache warmups, 0 disables warming
+PROMPT_WARM_INTERVAL = int(os.getenv("PROMPT_WARM_INTERVAL", "600"))
+# comma separated agents that are always kept warm, on top of the recently active ones
+PROMPT_WARM_AGENT_IDS = [agent_id for agent_id in os.getenv("PROMPT_WARM_AGENT_IDS", "").split(",") if agent_id]
+# port of the prometheus metrics of this replica, 0 disables them
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+QUEUE_STATS_INTERVAL = int(os.getenv("QUEUE_STATS_INTERVAL", "15"))
+TASK_POOLS = {
+    'audio_processing': ConsumerEngine.PROCESS_POOL,
+    'audio_session': ConsumerEngine.PROCESS_POOL,
+    'feedback_processing': ConsumerEngine.THREAD_POOL
+}
+# the task types arriving on each task type's queue, chunked sessions share the audio queue and replicas
+QUEUE_TASK_TYPES = {
+    'audio_processing': ['audio_processing', 'audio_session'],
+    'feedback_processing': ['feedback_processing']
+}
 
 
 def process_audio(wav_name, metadata_name):
@@ -37,51 +77,137 @@ def process_feedback(messages_filename, thread_id, agent_id, step_id):
     print(f"Finished processing feedback for {messages_path}")
 
 
-def callback(ch, method, properties, body):
-    message = json.loads(body)
+def audio_task(message):
+    process_audio(message['file_name'], message['metadata_name'])
+
+
+def session_task(message):
+    try:
+        process_session(message['session_id'], message.get('final', False))
+    except SessionBusyError:
+        if message.get('final', False):
+            raise
+        # the worker holding the session, or the next task of it, exports these messages
+        print(f"Skipping incremental task of session {message['session_id']}, it is being processed")
+
+
+def feedback_task(message):
+    process_feedback(message['messages_filename'], message['thread_id'], message['agent_id'], message['step_id'])
+
+
+TASK_HANDLERS = {
+    'audio_processing': audio_task,
+    'audio_session': session_task,
+    'feedback_processing': feedback_task
+}
+
+
+def run_task(message):
+    # messages queued before jobs were tracked have no job_id
+    job_id = message.get('job_id')
     task_type = message['task_type']
-    if task_type == 'audio_processing':
-        file_name = message['file_name']
-        metadata_name = message['metadata_name']
-        try:
-            process_audio(file_name, metadata_name)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        except Exception as e:
-            print(f"Error processing audio {file_name}: {e}")
-    elif task_type == 'feedback_processing':
-        messages_filename = message['messages_filename']
-        thread_id = message['thread_id']
-        agent_id = message['agent_id']
-        step_id = message['step_id']
-        try:
-            process_feedback(messages_filename, thread_id, agent_id, step_id)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        except Exception as e:
-            print(f"Error processing feedback for {messages_filename}: {e}")
-    else:
-        print(f"Unknown task type {task_type}")
+    if job_id and get_job_state_handler().is_completed(job_id):
+        # a duplicate delivery, or a redelivery after the ack was lost
+        print(f"Skipping job {job_id}, it is already completed")
+        TASK_DURATION.labels(task_type, 'skipped').observe(0)
+        return
+    if job_id:
+        get_job_state_handler().mark_started(job_id)
+    started_at = time.time()
+    try:
+        # an audio job owns its pool process, its encoder and upload threads are profiled along with it
+        with job_context(job_id), profile_job(task_type, job_id,
+                                              whole_process=TASK_POOLS[task_type] == ConsumerEngine.PROCESS_POOL):
+            TASK_HANDLERS[task_type](message)
+    except Exception as e:
+        TASK_DURATION.labels(task_type, 'failed').observe(time.time() - started_at)
+        TASK_ERRORS.labels(task_type, type(e).__name__).inc()
+        if job_id:
+            # dead-lettering turns this into failed if no attempt is left
+            get_job_state_handler().update_job(job_id, {'status': 'retrying', 'error': repr(e)[:1024]})
+        raise
+    TASK_DURATION.labels(task_type, 'completed').observe(time.time() - started_at)
+    if job_id:
+        get_job_state_handler().mark_completed(job_id)
+
+
+def on_dead_letter(body: bytes, exception: BaseException):
+    try:
+        message = json.loads(body)
+        job_id = message.get('job_id')
+    except (ValueError, AttributeError):
+        DEAD_LETTERS.labels('unknown', type(exception).__name__).inc()
+        return
+    DEAD_LETTERS.labels(str(message.get('task_type', 'unknown')), type(exception).__name__).inc()
+    if job_id:
+        get_job_state_handler().mark_failed(job_id, repr(exception))
+
+
+def on_redelivered(body: bytes) -> bool:
+    # its worker was lost mid-task, maybe after the task completed but before its ack reached the broker
+    try:
+        job_id = json.loads(body).get('job_id')
+    except (ValueError, AttributeError):
+        return True
+    if not job_id:
+        return True
+    return get_job_state_handler().update_unless_completed(
+        job_id, {'status': 'retrying', 'error': "Redelivered after consumer loss"})
+
+
+def on_delivery(queue: str, wait: float):
+    QUEUE_WAIT.labels(queue).observe(wait)
+    QUEUE_LAG.labels(queue).set(wait)
+
+
+def on_queue_stats(queue: str, messages: int, consumers: int):
+    QUEUE_MESSAGES.labels(queue).set(messages)
+    QUEUE_CONSUMERS.labels(queue).set(consumers)
+
+
+def build_queue_specs() -> list[QueueSpec]:
+    pool_sizes = {'audio_processing': AUDIO_WORKERS, 'feedback_processing': FEEDBACK_WORKERS}
+    task_queues = {'audio_processing': RABBITMQ_AUDIO_QUEUE, 'feedback_processing': RABBITMQ_FEEDBACK_QUEUE}
+    specs = [QueueSpec(task_queues[task_type], pool_sizes[task_type], RABBITMQ_MAX_PRIORITY)
+             for task_type in WORKER_TASK_TYPES]
+    if set(QUEUE_TASK_TYPES) <= set(WORKER_TASK_TYPES):
+        # the legacy queue mixes task types, only replicas handling all of them may drain it
+        specs.append(QueueSpec(RABBITMQ_QUEUE, 1))
+    return specs
 
 
 if __name__ == "__main__":
+    unknown_task_types = [task_type for task_type in WORKER_TASK_TYPES if task_type not in QUEUE_TASK_TYPES]
+    if unknown_task_types or not WORKER_TASK_TYPES:
+        sys.exit(f"Unknown WORKER_TASK_TYPES {', '.join(unknown_task_types) or '(none set)'}, "
+                 f"expected a comma separated list of {', '.join(QUEUE_TASK_TYPES)}")
     print("Starting prepit processing worker")
+    clear_metrics_dir()
+    if PROFILE_MODE != "off":
+        print(f"Profiling jobs ({PROFILE_MODE}), jobs over {PROFILE_SLOW_THRESHOLD}s are dumped to {PROFILE_DIR}")
+    print(f"Encoding clips as {CLIP_PROFILE}")
     # wait for RabbitMQ to start
     print("Waiting for RabbitMQ to start")
     time.sleep(15)
     print("Trying to connect to RabbitMQ")
-    while True:
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
-            break
-        except Exception as e:
-            print(f"RabbitMQ connection failed {e}, retrying in 5 seconds")
-            # retry every 5 seconds
-            time.sleep(5)
-    channel = connection.channel()
-
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
-
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=RABBITMQ_QUEUE, on_message_callback=callback)
-
-    print(f'Waiting for messages in {RABBITMQ_QUEUE}. To exit press CTRL+C')
-    channel.start_consuming()
+    engine = ConsumerEngine(RABBITMQ_HOST, build_queue_specs(), run_task,
+                            pool_sizes={ConsumerEngine.PROCESS_POOL: AUDIO_WORKERS,
+                                        ConsumerEngine.THREAD_POOL: FEEDBACK_WORKERS},
+                            task_pools={task_type: TASK_POOLS[task_type] for queue_type in WORKER_TASK_TYPES
+                                        for task_type in QUEUE_TASK_TYPES[queue_type]},
+                            max_retries=MAX_TASK_RETRIES, retry_base_delay_ms=TASK_RETRY_BASE_DELAY_MS,
+                            non_retryable_errors=NON_RETRYABLE_ERRORS, on_dead_letter=on_dead_letter,
+                            on_redelivered=on_redelivered,
+                            on_delivery=on_delivery, on_queue_stats=on_queue_stats,
+                            queue_stats_interval=QUEUE_STATS_INTERVAL,
+                            # the pool workers start with this script and the audio libraries it imports loaded
+                            preload_modules=['__main__'])
+    engine.start_pools()
+    if WORKER_METRICS_PORT > 0:
+        # serves from a thread, the pool workers are forked from the fork server and never inherit it
+        start_metrics_server(WORKER_METRICS_PORT)
+    if 'feedback_processing' in WORKER_TASK_TYPES and PROMPT_WARM_INTERVAL > 0:
+        # keeps the prompts of the feedback threads of this process warm
+        PromptCacheWarmer(get_agent_prompt_handler(), PROMPT_WARM_INTERVAL, PROMPT_WARM_AGENT_IDS).start()
+    engine.connect()
+    engine.run()
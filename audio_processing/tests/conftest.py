@@ -0,0 +1,16 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: conftest.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/18/26 10:10
+"""
+import os
+import sys
+import tempfile
+
+# the worker's modules import each other by name, like start.py does when run from audio_processing/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# keep the metric files of the tests away from a worker running on the same host
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prepit_test_metrics_"))
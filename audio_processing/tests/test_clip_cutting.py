@@ -0,0 +1,88 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_clip_cutting.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/18/26 16:20
+"""
+import os
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+import audio_processing
+from audio_processing import CLIP_PROFILES, cut_audio_segments, load_wav_file, stream_audio_segments
+
+RECORDING_RATE = 44100
+RECORDING_SECONDS = 2
+AMPLITUDE = 0.5
+# (start, end) in seconds, the last clip runs past the end of the recording
+CLIPS = {
+    "msg#1700000000001": (0.2, 1.2),
+    "msg#1700000000002": (1.0, 2.5)
+}
+
+
+class StubUploadHandler:
+    def object_name(self, local_file_path, s3_folder_path):
+        return s3_folder_path + os.path.basename(local_file_path)
+
+    def upload_file(self, local_file_path, s3_folder_path, is_public=False):
+        return True
+
+    def upload_files(self, local_file_paths, s3_folder_path, is_public=False, on_uploaded=None):
+        return {path: True for path in local_file_paths}
+
+
+class StubMessageUpdateHandler:
+    def update_message_audio_flag(self, thread_id, created_at):
+        return True
+
+    def update_message_audio_flags(self, thread_id, created_at_list):
+        return {created_at: True for created_at in created_at_list}
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    stand_ins = {"file_upload_handler": StubUploadHandler(), "message_update_handler": StubMessageUpdateHandler()}
+    monkeypatch.setattr(audio_processing, "get_shared", lambda name, factory: stand_ins[name])
+    monkeypatch.setattr(audio_processing, "publish_event", lambda thread_id, event, data: True)
+    monkeypatch.setattr(audio_processing, "PROCESSED_MEDIA_DIR", str(tmp_path / "processed"))
+    # a PCM-16 sine, memory-mapped by the pipeline like the uploaded recordings
+    time = np.arange(RECORDING_RATE * RECORDING_SECONDS) / RECORDING_RATE
+    wav_path = str(tmp_path / "recording.wav")
+    sf.write(wav_path, AMPLITUDE * np.sin(2 * np.pi * 440 * time), RECORDING_RATE, subtype='PCM_16')
+    return wav_path
+
+
+def final_result():
+    result = {msg_id: {'relative_start': start, 'relative_end': end} for msg_id, (start, end) in CLIPS.items()}
+    return {**result, 'thread_id': "thread", 'ws_conn_sid': "sid"}
+
+
+def read_clips() -> dict:
+    return {msg_id: sf.read(audio_processing.clip_file_name("thread", "sid", msg_id), always_2d=True)[0]
+            for msg_id in CLIPS}
+
+
+@pytest.mark.parametrize("profile_name", sorted(CLIP_PROFILES))
+def test_streamed_clips_match_cut_clips(profile_name, pipeline, monkeypatch):
+    profile = CLIP_PROFILES[profile_name]
+    monkeypatch.setattr(audio_processing, "CLIP_PROFILE", profile)
+    rate, data = load_wav_file(pipeline)
+    cut_audio_segments(rate, data, final_result())
+    cut_clips = read_clips()
+    stream_audio_segments(pipeline, final_result(), block_frames=RECORDING_RATE // 2)
+    streamed_clips = read_clips()
+
+    output_rate = profile.output_rate(RECORDING_RATE)
+    for msg_id, (start, end) in CLIPS.items():
+        expected_frames = (min(end, RECORDING_SECONDS) - start) * output_rate
+        for clip in (cut_clips[msg_id], streamed_clips[msg_id]):
+            # scaled to [-1, 1] whichever block the clip ends in, lossy codecs overshoot a little
+            assert np.abs(clip).max() == pytest.approx(AMPLITUDE, abs=0.1)
+            # encoders pad up to a frame at either end
+            assert len(clip) == pytest.approx(expected_frames, abs=0.1 * output_rate)
+        assert len(streamed_clips[msg_id]) == pytest.approx(len(cut_clips[msg_id]), abs=0.01 * output_rate)
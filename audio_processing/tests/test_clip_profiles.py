@@ -0,0 +1,44 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_clip_profiles.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/18/26 14:30
+"""
+import numpy as np
+import pytest
+import soundfile as sf
+
+import audio_processing
+from audio_processing import CLIP_PROFILES, ClipResampler, encode_audio_segment, resample_recording
+
+RECORDING_RATE = 44100
+RECORDING_SECONDS = 2
+
+
+def recording():
+    # a stereo tone with some noise, as int16 like the uploaded wav files
+    time = np.arange(RECORDING_RATE * RECORDING_SECONDS) / RECORDING_RATE
+    signal = 0.3 * np.sin(2 * np.pi * 440 * time) + 0.05 * np.random.default_rng(0).standard_normal(len(time))
+    return (np.stack([signal, signal], axis=1) * 32767).astype(np.int16)
+
+
+@pytest.mark.parametrize("profile_name", sorted(CLIP_PROFILES))
+def test_profile_encodes_a_clip(profile_name, tmp_path, monkeypatch):
+    profile = CLIP_PROFILES[profile_name]
+    monkeypatch.setattr(audio_processing, "CLIP_PROFILE", profile)
+    resampler = ClipResampler(RECORDING_RATE, profile)
+    data = resample_recording(recording(), resampler)
+
+    file_name = encode_audio_segment(str(tmp_path / f"clip.{profile.extension}"), data, resampler.output_rate)
+
+    info = sf.info(file_name)
+    assert info.format == audio_processing.CLIP_CODECS[profile.codec]['format']
+    assert info.samplerate == profile.output_rate(RECORDING_RATE)
+    assert info.channels == (1 if profile.mono else 2)
+    assert info.duration == pytest.approx(RECORDING_SECONDS, abs=0.1)
+    if profile.bitrate is not None:
+        # the compression level derived from the bitrate lands near it
+        bitrate = (tmp_path / f"clip.{profile.extension}").stat().st_size * 8 / RECORDING_SECONDS
+        assert bitrate == pytest.approx(profile.bitrate, rel=0.25)
@@ -0,0 +1,136 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_transcript_alignment.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/18/26 10:10
+"""
+import copy
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from audio_processing import map_to_absolute_timestamps, organize_transcriptions_by_message
+
+AUDIO_STARTED_AT = 1_700_000_000_000
+
+
+def baseline_map_to_absolute_timestamps(audio_timestamps, audio_started_at, audio_pause_timestamps):
+    # the implementation the sorted lookups replaced, kept as the reference
+    audio_started_at = datetime.fromtimestamp(audio_started_at / 1000.0)
+    pause_durations = [end - start for start, end in audio_pause_timestamps]
+    pause_offsets = [sum(pause_durations[:i]) for i in range(len(pause_durations) + 1)]
+    pause_intervals = [(start, end) for start, end in audio_pause_timestamps]
+
+    absolute_timestamps = []
+    for entry in audio_timestamps:
+        relative_start = entry['start'] * 1000
+        offset = sum(pause_offsets[i] for i, (pause_start, pause_end) in enumerate(pause_intervals) if
+                     relative_start >= (pause_start - audio_started_at.timestamp() * 1000))
+        entry['absolute_start'] = audio_started_at + timedelta(milliseconds=relative_start + offset)
+        absolute_timestamps.append(entry)
+    return absolute_timestamps
+
+
+def baseline_organize_transcriptions_by_message(absolute_timestamps, user_msg_timestamps):
+    # the implementation the sorted lookups replaced, kept as the reference
+    sorted_msgs = sorted(user_msg_timestamps.items(), key=lambda x: int(x[0]))
+    result = []
+    for i, (timestamp, msg_id) in enumerate(sorted_msgs):
+        prev_timestamp = 0 if i == 0 else int(sorted_msgs[i - 1][0])
+        current_timestamp = int(timestamp)
+        transcriptions = [entry for entry in absolute_timestamps if
+                          prev_timestamp <= entry['timestamp'] < current_timestamp]
+        result.append({"msg_id": msg_id, "transcriptions": transcriptions})
+
+    last_msg_id = sorted_msgs[-1][1]
+    last_timestamp = int(sorted_msgs[-1][0])
+    remaining_transcriptions = [entry for entry in absolute_timestamps if entry['timestamp'] >= last_timestamp]
+    if remaining_transcriptions:
+        if result and result[-1]['msg_id'] == last_msg_id:
+            result[-1]['transcriptions'].extend(remaining_transcriptions)
+        else:
+            result.append({"msg_id": last_msg_id, "transcriptions": remaining_transcriptions})
+    return result
+
+
+def random_entries(rng: random.Random, count: int) -> list[dict]:
+    entries = []
+    for index in range(count):
+        # repeated and integral starts hit the pause thresholds exactly
+        start = rng.choice([rng.uniform(0, 600), float(rng.randint(0, 600)), entries[-1]['start'] if entries else 0.0])
+        entries.append({'start': start, 'duration': rng.uniform(0.1, 10), 'text': f"entry {index}",
+                        'is_final': rng.random() < 0.8,
+                        'timestamp': rng.choice([rng.randint(-1000, 700_000), 0])})
+    return entries
+
+
+def random_pauses(rng: random.Random, count: int, floats: bool) -> list[list]:
+    pauses = []
+    for _ in range(count):
+        start = AUDIO_STARTED_AT + rng.uniform(-5_000, 600_000)
+        duration = rng.uniform(0, 60_000)
+        if not floats:
+            start, duration = int(start), int(duration)
+        pauses.append([start, start + duration])
+    # clients send them in order, but nothing guarantees it
+    if rng.random() < 0.5:
+        rng.shuffle(pauses)
+    return pauses
+
+
+def random_messages(rng: random.Random, count: int, entries: list[dict]) -> dict:
+    # boundaries on entry timestamps, to hit the half-open intervals at their edges
+    candidates = [entry['timestamp'] for entry in entries] + [rng.randint(0, 700_000) for _ in range(count)]
+    timestamps = rng.sample(sorted(set(candidates)), min(count, len(set(candidates))))
+    return {str(timestamp): f"thread#{timestamp:013d}" for timestamp in timestamps}
+
+
+@pytest.mark.parametrize("seed", range(200))
+@pytest.mark.parametrize("floats", [False, True])
+def test_map_to_absolute_timestamps_matches_baseline(seed, floats):
+    rng = random.Random(seed)
+    entries = random_entries(rng, rng.randint(0, 50))
+    pauses = random_pauses(rng, rng.choice([0, 1, rng.randint(2, 20)]), floats)
+    expected = baseline_map_to_absolute_timestamps(copy.deepcopy(entries), AUDIO_STARTED_AT, pauses)
+    actual = map_to_absolute_timestamps(copy.deepcopy(entries), AUDIO_STARTED_AT, pauses)
+    assert len(actual) == len(expected)
+    for actual_entry, expected_entry in zip(actual, expected):
+        # float pauses are summed in another order, which may round differently in the last microsecond
+        tolerance = timedelta(microseconds=1 if floats else 0)
+        assert abs(actual_entry['absolute_start'] - expected_entry['absolute_start']) <= tolerance
+        assert {key: value for key, value in actual_entry.items() if key != 'absolute_start'} == \
+               {key: value for key, value in expected_entry.items() if key != 'absolute_start'}
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_organize_transcriptions_by_message_matches_baseline(seed):
+    rng = random.Random(seed)
+    entries = random_entries(rng, rng.randint(0, 50))
+    messages = random_messages(rng, rng.choice([1, 2, rng.randint(3, 20)]), entries)
+    expected = baseline_organize_transcriptions_by_message(entries, messages)
+    actual = organize_transcriptions_by_message(entries, messages)
+    assert actual == expected
+
+
+def test_organize_transcriptions_without_entries():
+    messages = {"100": "thread#0000000000100", "200": "thread#0000000000200"}
+    assert organize_transcriptions_by_message([], messages) == baseline_organize_transcriptions_by_message(
+        [], messages)
+
+
+def test_organize_transcriptions_without_messages_fails_like_baseline():
+    entries = [{'start': 0.0, 'duration': 1.0, 'text': "entry", 'is_final': True, 'timestamp': 10}]
+    with pytest.raises(IndexError):
+        baseline_organize_transcriptions_by_message(entries, {})
+    with pytest.raises(IndexError):
+        organize_transcriptions_by_message(entries, {})
+
+
+def test_map_to_absolute_timestamps_without_entries_or_pauses():
+    assert map_to_absolute_timestamps([], AUDIO_STARTED_AT, []) == []
+    entry = {'start': 1.5, 'duration': 1.0, 'text': "entry", 'is_final': True, 'timestamp': 10}
+    actual = map_to_absolute_timestamps([dict(entry)], AUDIO_STARTED_AT, [])
+    assert actual == baseline_map_to_absolute_timestamps([dict(entry)], AUDIO_STARTED_AT, [])
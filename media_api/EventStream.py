@@ -0,0 +1,42 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: EventStream.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 21:55
+"""
+import json
+from typing import AsyncIterator, Awaitable, Callable
+
+import redis.asyncio as redis
+
+# the channel layout is shared with the worker's EventPublishHandler, one channel per thread
+EVENTS_CHANNEL_PREFIX = "prepit_events:"
+# a comment line is sent this often when there are no events, so proxies do not drop the idle connection
+EVENT_STREAM_HEARTBEAT = 15
+
+
+async def thread_event_stream(redis_client: redis.Redis, thread_id: str,
+                              is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncIterator[str]:
+    """
+    Stream the events the workers publish for a thread as server-sent events.
+    :param redis_client: The redis client to subscribe with.
+    :param thread_id: The ID of the thread.
+    :param is_disconnected: Tells whether the client went away, e.g. Request.is_disconnected.
+    :return: An async iterator of server-sent event frames.
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(EVENTS_CHANNEL_PREFIX + thread_id)
+    try:
+        yield ": subscribed\n\n"
+        while not await is_disconnected():
+            message = await pubsub.get_message(timeout=EVENT_STREAM_HEARTBEAT)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            event = json.loads(message['data'])
+            yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
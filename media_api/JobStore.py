@@ -0,0 +1,125 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: JobStore.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 20:45
+"""
+import os
+import time
+import uuid
+
+import redis.asyncio as redis
+
+# the key layout is shared with the worker's JobStateHandler
+JOB_KEY_PREFIX = "prepit_job:"
+IDEMPOTENCY_KEY_PREFIX = "prepit_idem:"
+JOB_TTL = int(os.getenv("JOB_TTL", str(7 * 24 * 3600)))
+# a retried request within this window maps back to the job it created
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", str(24 * 3600)))
+# the worker records every stage as <stage>_started_at and <stage>_duration
+STAGE_FIELD_SUFFIXES = ("_started_at", "_duration")
+JOB_TIME_FIELDS = {"created_at", "started_at", "finished_at"}
+
+# deletes the idempotency key only if it still points to the job, so a failed request never frees another's key
+RELEASE_KEY_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+# claims the idempotency key, taking it over from a job that failed for good, in one step
+# so two retries of a failed request can never both take it over
+CLAIM_KEY_SCRIPT = """
+local existing_job_id = redis.call("get", KEYS[1])
+if existing_job_id and redis.call("hget", ARGV[3] .. existing_job_id, "status") ~= "failed" then
+    return existing_job_id
+end
+redis.call("set", KEYS[1], ARGV[1], "ex", ARGV[2])
+return false
+"""
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+def format_job(fields: dict) -> dict:
+    """
+    Turn a raw job hash into the status returned to clients, with the stage timings grouped by stage.
+    """
+    job = {'stages': {}}
+    for field, value in fields.items():
+        for suffix in STAGE_FIELD_SUFFIXES:
+            if field.endswith(suffix):
+                job['stages'].setdefault(field[:-len(suffix)], {})[suffix[1:]] = float(value)
+                break
+        else:
+            job[field] = float(value) if field in JOB_TIME_FIELDS else int(value) if field == 'attempts' else value
+    # in execution order
+    job['stages'] = dict(sorted(job['stages'].items(), key=lambda stage: stage[1].get('started_at', 0)))
+    if 'created_at' in job and 'started_at' in job:
+        job['queue_wait'] = job['started_at'] - job['created_at']
+    if 'created_at' in job and 'finished_at' in job:
+        job['total_duration'] = job['finished_at'] - job['created_at']
+    return job
+
+
+class JobStore:
+    """
+    Redis store of the jobs queued through the API, and of the idempotency keys mapping requests to them.
+    """
+
+    def __init__(self, host: str, port: int = 6379):
+        self.redis_client = redis.Redis(host=host, port=port, decode_responses=True)
+
+    async def close(self):
+        await self.redis_client.aclose()
+
+    async def claim(self, idempotency_key: str, job_id: str) -> str | None:
+        """
+        Claim an idempotency key for a new job.
+        A key whose job failed for good is taken over, so the client can resubmit it.
+        :param idempotency_key: The idempotency key of the request.
+        :param job_id: The ID of the job the request would create.
+        :return: None if the key was claimed for job_id, otherwise the ID of the job that already holds it.
+        """
+        return await self.redis_client.eval(CLAIM_KEY_SCRIPT, 1, IDEMPOTENCY_KEY_PREFIX + idempotency_key,
+                                            job_id, IDEMPOTENCY_KEY_TTL, JOB_KEY_PREFIX)
+
+    async def release(self, idempotency_key: str, job_id: str):
+        """
+        Release an idempotency key claimed by a request that failed before its job was queued.
+        """
+        await self.redis_client.eval(RELEASE_KEY_SCRIPT, 1, IDEMPOTENCY_KEY_PREFIX + idempotency_key, job_id)
+
+    async def create_job(self, job_id: str, task_type: str, thread_id: str):
+        """
+        Record a job as queued.
+        :param job_id: The ID of the job.
+        :param task_type: 'audio_processing', 'audio_session' or 'feedback_processing'.
+        :param thread_id: The thread the job belongs to.
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hset(JOB_KEY_PREFIX + job_id, mapping={
+            'job_id': job_id,
+            'task_type': task_type,
+            'thread_id': thread_id,
+            'status': 'queued',
+            'created_at': time.time()
+        })
+        pipeline.expire(JOB_KEY_PREFIX + job_id, JOB_TTL)
+        await pipeline.execute()
+
+    async def get_jobs(self, job_ids: list[str]) -> dict[str, dict | None]:
+        """
+        Get the status of several jobs in one round trip.
+        :param job_ids: The IDs of the jobs.
+        :return: A dict mapping each job ID to its status, None for unknown or expired jobs.
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipeline.hgetall(JOB_KEY_PREFIX + job_id)
+        results = await pipeline.execute()
+        return {job_id: format_job(fields) if fields else None for job_id, fields in zip(job_ids, results)}
@@ -0,0 +1,17 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: Metrics.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 23:30
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+# the worker reports the queue depth and how long tasks waited, this side covers the requests and what they queue
+REQUEST_DURATION = Histogram("prepit_api_request_duration_seconds", "Time to answer a request, up to the headers",
+                             ["method", "route", "status"],
+                             buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+JOBS_SUBMITTED = Counter("prepit_api_jobs_total", "Job submissions by result: queued, duplicate or failed",
+                         ["task_type", "result"])
+PUBLISHER_BACKLOG = Gauge("prepit_api_publisher_backlog", "Messages buffered while RabbitMQ is unavailable")
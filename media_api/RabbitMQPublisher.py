@@ -0,0 +1,127 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: RabbitMQPublisher.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 10:12
+"""
+import asyncio
+import json
+import logging
+import time
+
+import aio_pika
+from aio_pika.pool import Pool
+
+# read by the workers to measure how long a task waited, taken when the message is handed to publish(),
+# so time spent in the backlog counts too
+PUBLISHED_AT_HEADER = "x-published-at"
+
+
+class PublisherBacklogFullError(Exception):
+    """Raised when the broker is unreachable and the local backlog has no room left."""
+
+
+class RabbitMQPublisher:
+    """
+    Long-lived asyncio publisher shared by all requests of the media API.
+    One robust connection (reconnects on its own), a pool of confirm-mode channels,
+    and a bounded in-memory backlog that buffers messages while the broker is down.
+    """
+
+    def __init__(self, host: str, queues: dict[str, dict | None], channel_pool_size: int = 8,
+                 backlog_size: int = 1000, publish_timeout: float = 10.0, reconnect_interval: float = 5.0):
+        self.url = f"amqp://guest:guest@{host}/"
+        self.queues = queues
+        self.channel_pool_size = channel_pool_size
+        self.publish_timeout = publish_timeout
+        self.reconnect_interval = reconnect_interval
+        self.backlog: asyncio.Queue = asyncio.Queue(maxsize=backlog_size)
+        self.connection: aio_pika.abc.AbstractRobustConnection | None = None
+        self.channel_pool: Pool | None = None
+        self._connected = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        """
+        Start connecting in the background, so the API can come up before RabbitMQ does.
+        """
+        self._tasks.append(asyncio.create_task(self._connect_loop()))
+        self._tasks.append(asyncio.create_task(self._drain_backlog()))
+
+    async def close(self):
+        """
+        Stop the background tasks and close the pool and the connection.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.backlog.qsize():
+            logging.warning(f"Dropping {self.backlog.qsize()} unpublished messages on shutdown")
+        if self.channel_pool is not None:
+            await self.channel_pool.close()
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def _connect_loop(self):
+        while self.connection is None:
+            try:
+                self.connection = await aio_pika.connect_robust(self.url)
+            except Exception as e:
+                logging.warning(f"RabbitMQ connection failed {e}, retrying in {self.reconnect_interval} seconds")
+                await asyncio.sleep(self.reconnect_interval)
+        self.channel_pool = Pool(self._open_channel, max_size=self.channel_pool_size)
+        # declare the queues once, instead of on every publish
+        async with self.channel_pool.acquire() as channel:
+            for queue, arguments in self.queues.items():
+                await channel.declare_queue(queue, durable=True, arguments=arguments)
+        self._connected.set()
+        logging.info("Connected to RabbitMQ")
+
+    async def _open_channel(self) -> aio_pika.abc.AbstractChannel:
+        return await self.connection.channel(publisher_confirms=True)
+
+    async def _publish_now(self, routing_key: str, body: bytes, priority: int | None, published_at: float):
+        async with self.channel_pool.acquire() as channel:
+            # with publisher confirms on, this returns once the broker has persisted the message
+            await channel.default_exchange.publish(
+                aio_pika.Message(body=body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT, priority=priority,
+                                 headers={PUBLISHED_AT_HEADER: published_at}),
+                routing_key=routing_key,
+                timeout=self.publish_timeout
+            )
+
+    async def publish(self, routing_key: str, message: dict, priority: int | None = None):
+        """
+        Publish a persistent message, or buffer it locally if the broker is unavailable.
+        :param routing_key: The queue to publish to.
+        :param message: The message body, serialized to JSON.
+        :param priority: The message priority, only honored by queues declared with x-max-priority.
+        :raises PublisherBacklogFullError: if the message can be neither published nor buffered.
+        """
+        body = json.dumps(message).encode()
+        published_at = time.time()
+        if self._connected.is_set() and self.backlog.empty():
+            try:
+                await self._publish_now(routing_key, body, priority, published_at)
+                return
+            except Exception as e:
+                logging.warning(f"Publish to {routing_key} failed, buffering message: {e}")
+        try:
+            self.backlog.put_nowait((routing_key, body, priority, published_at))
+        except asyncio.QueueFull:
+            raise PublisherBacklogFullError(f"Publisher backlog is full ({self.backlog.maxsize} messages)")
+
+    async def _drain_backlog(self):
+        while True:
+            routing_key, body, priority, published_at = await self.backlog.get()
+            while True:
+                await self._connected.wait()
+                try:
+                    await self._publish_now(routing_key, body, priority, published_at)
+                    break
+                except Exception as e:
+                    logging.warning(f"Backlog publish to {routing_key} failed {e}, "
+                                    f"retrying in {self.reconnect_interval} seconds")
+                    await asyncio.sleep(self.reconnect_interval)
@@ -0,0 +1,164 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: SessionSpool.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 22:20
+"""
+import fcntl
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+
+# the spool layout is shared with the worker's session_processing
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+SESSION_SAMPLE_BYTES = {
+    'pcm16': 2,
+    'float32': 4
+}
+
+
+class InvalidSessionError(Exception):
+    """Raised for an unknown, malformed or already finalized session."""
+
+
+class SessionOffsetError(Exception):
+    """Raised when an audio chunk does not continue the audio spooled so far."""
+
+    def __init__(self, expected_offset: int):
+        super().__init__(f"Audio chunk must start at or before byte {expected_offset}")
+        self.expected_offset = expected_offset
+
+
+class SessionSpool:
+    """
+    Per session spool of a recording uploaded while the interview is still going on: the session's
+    settings, its raw audio so far and its metadata merged from every update. Every method blocks,
+    run them in a thread pool. Writers of the same session are serialized with file locks, so any
+    number of API processes can share the spool.
+    """
+
+    def __init__(self, spool_dir: str):
+        self.spool_dir = spool_dir
+
+    def session_dir(self, session_id: str) -> str:
+        if not SESSION_ID_PATTERN.match(session_id):
+            raise InvalidSessionError(f"Invalid session id {session_id!r}")
+        return os.path.join(self.spool_dir, session_id)
+
+    @contextmanager
+    def _locked(self, session_id: str):
+        if not os.path.isdir(self.session_dir(session_id)):
+            raise InvalidSessionError(f"Unknown session {session_id}")
+        with open(os.path.join(self.session_dir(session_id), ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_json(path: str, content: dict):
+        # written aside and renamed, workers read these files without taking the lock
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        with os.fdopen(fd, "w") as file:
+            json.dump(content, file)
+        os.replace(tmp_path, path)
+
+    def start_session(self, session_id: str, settings: dict) -> dict:
+        """
+        Create a session, or return it unchanged if it already exists, so a retried start is harmless.
+        :param session_id: The ID of the session.
+        :param settings: thread_id, ws_sid, audio_started_at, sample_rate, channels and sample_format.
+        :return: The session's settings.
+        """
+        if settings['sample_format'] not in SESSION_SAMPLE_BYTES:
+            raise InvalidSessionError(f"Unsupported sample format {settings['sample_format']}")
+        os.makedirs(self.session_dir(session_id), exist_ok=True)
+        with self._locked(session_id):
+            session_path = os.path.join(self.session_dir(session_id), "session.json")
+            if os.path.exists(session_path):
+                return self.get_session(session_id)
+            session = {**settings, 'session_id': session_id, 'finalized': False}
+            self._write_json(session_path, session)
+            return session
+
+    def get_session(self, session_id: str) -> dict:
+        session_path = os.path.join(self.session_dir(session_id), "session.json")
+        if not os.path.exists(session_path):
+            raise InvalidSessionError(f"Unknown session {session_id}")
+        with open(session_path, "r") as file:
+            return json.load(file)
+
+    def _open_session(self, session_id: str) -> dict:
+        session = self.get_session(session_id)
+        if session['finalized']:
+            raise InvalidSessionError(f"Session {session_id} is already finalized")
+        return session
+
+    def write_audio(self, session_id: str, offset: int, chunk: bytes) -> int:
+        """
+        Write a chunk of raw audio at its byte offset. Re-sending a chunk that is already spooled,
+        e.g. after a lost response, just writes the same bytes again.
+        :param session_id: The ID of the session.
+        :param offset: The byte offset of the chunk in the session's audio.
+        :param chunk: The raw samples, interleaved, in the session's sample format.
+        :return: The number of audio bytes spooled so far.
+        :raises SessionOffsetError: if the chunk would leave a gap.
+        """
+        with self._locked(session_id):
+            session = self._open_session(session_id)
+            frame_bytes = SESSION_SAMPLE_BYTES[session['sample_format']] * session['channels']
+            if offset % frame_bytes or len(chunk) % frame_bytes:
+                raise InvalidSessionError(f"Audio chunks must be whole frames of {frame_bytes} bytes")
+            fd = os.open(os.path.join(self.session_dir(session_id), "audio.pcm"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if offset > size:
+                    raise SessionOffsetError(size)
+                os.pwrite(fd, chunk, offset)
+                return max(size, offset + len(chunk))
+            finally:
+                os.close(fd)
+
+    def merge_metadata(self, session_id: str, update: dict) -> tuple[int, int]:
+        """
+        Merge a metadata update into the session's metadata. Transcriptions and pauses are appended,
+        exact repeats dropped, and user messages are added by timestamp.
+        :param session_id: The ID of the session.
+        :param update: Any of audio_timestamps, audio_pause_timestamps and user_msg_timestamps.
+        :return: The number of user messages before and after the update.
+        """
+        with self._locked(session_id):
+            self._open_session(session_id)
+            metadata_path = os.path.join(self.session_dir(session_id), "metadata.json")
+            metadata = {'audio_timestamps': [], 'audio_pause_timestamps': [], 'user_msg_timestamps': {}}
+            if os.path.exists(metadata_path):
+                with open(metadata_path, "r") as file:
+                    metadata = json.load(file)
+            messages_before = len(metadata['user_msg_timestamps'])
+            for field in ('audio_timestamps', 'audio_pause_timestamps'):
+                seen = {json.dumps(entry, sort_keys=True) for entry in metadata[field]}
+                for entry in update.get(field, []):
+                    key = json.dumps(entry, sort_keys=True)
+                    if key not in seen:
+                        seen.add(key)
+                        metadata[field].append(entry)
+            metadata['user_msg_timestamps'].update(update.get('user_msg_timestamps', {}))
+            self._write_json(metadata_path, metadata)
+            return messages_before, len(metadata['user_msg_timestamps'])
+
+    def finalize(self, session_id: str) -> dict:
+        """
+        Mark a session as ended, no more audio or metadata is accepted. Finalizing twice is harmless.
+        :return: The session's settings.
+        """
+        with self._locked(session_id):
+            session = self.get_session(session_id)
+            if not session['finalized']:
+                session['finalized'] = True
+                self._write_json(os.path.join(self.session_dir(session_id), "session.json"), session)
+            return session
@@ -0,0 +1,229 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: UploadHandler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/17/26 11:05
+"""
+import hashlib
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from fastapi import Request
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB per read/write
+CONTENT_HASH_PREFIX_LENGTH = 16
+MAX_FORM_FIELD_BYTES = 64 * 1024
+# room for the form fields, boundaries and part headers on top of the files
+MAX_FORM_OVERHEAD_BYTES = 1024 * 1024
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds its configured maximum size."""
+
+
+class InvalidUploadError(Exception):
+    """Raised for a malformed form, or one missing a field or file."""
+
+
+@dataclass
+class StoredUpload:
+    path: str
+    file_name: str
+    sha256: str
+    size: int
+
+
+@dataclass
+class ReceivedFile:
+    tmp_path: str
+    file_name: str
+    sha256: str
+    size: int
+
+
+class MultipartForm:
+    """
+    A multipart form read straight from the request body. Its files are streamed into temp files in
+    dest_dir as they arrive, hashed on the way, and only renamed into place once stored.
+    """
+
+    def __init__(self, dest_dir: str):
+        self.dest_dir = dest_dir
+        self.fields: dict[str, str] = {}
+        self.files: dict[str, ReceivedFile] = {}
+        # temp files not stored yet, removed by discard
+        self.tmp_paths: list[str] = []
+
+    def field(self, name: str, field_type=str):
+        """
+        Get a form field converted to field_type.
+        :raises InvalidUploadError: if the field is missing or does not convert.
+        """
+        if name not in self.fields:
+            raise InvalidUploadError(f"Missing form field {name}")
+        try:
+            return field_type(self.fields[name])
+        except ValueError:
+            raise InvalidUploadError(f"Invalid form field {name}")
+
+    async def store(self, name: str, content_addressed: bool = False) -> StoredUpload:
+        """
+        Move a received file into place, atomically, so readers never see a partial file.
+        :param name: The form field of the file.
+        :param content_addressed: Prefix the name with the content hash, so different uploads under the same
+                                  name never overwrite each other and identical ones share a file.
+        :return: The stored file's path, name, sha256 hex digest and size.
+        :raises InvalidUploadError: if the form has no such file.
+        """
+        received = self.files.get(name)
+        if received is None:
+            raise InvalidUploadError(f"Missing file {name}")
+        file_name = received.file_name
+        if content_addressed:
+            file_name = f"{received.sha256[:CONTENT_HASH_PREFIX_LENGTH]}_{file_name}"
+        final_path = os.path.join(self.dest_dir, file_name)
+        if content_addressed and os.path.exists(final_path):
+            # same content already stored, leave the file a queued job may be reading alone
+            os.remove(received.tmp_path)
+        else:
+            await run_in_threadpool(os.replace, received.tmp_path, final_path)
+        self.tmp_paths.remove(received.tmp_path)
+        return StoredUpload(path=final_path, file_name=file_name, sha256=received.sha256, size=received.size)
+
+    def discard(self):
+        for tmp_path in self.tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.tmp_paths.clear()
+
+
+async def _read_form(request: Request, form: MultipartForm, file_limits: dict[str, int]):
+    content_type, params = parse_options_header(request.headers.get('content-type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in params:
+        raise InvalidUploadError("Expected a multipart/form-data body")
+    # the parser calls back synchronously, its events are handled once it is done with a chunk
+    events = []
+    header = [b'', b'']
+    part_headers = {}
+
+    def on_header_field(data, start, end):
+        header[0] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header[1] += data[start:end]
+
+    def on_header_end():
+        part_headers[header[0].lower()] = header[1]
+        header[0] = header[1] = b''
+
+    def on_headers_finished():
+        events.append(('headers', dict(part_headers)))
+        part_headers.clear()
+
+    parser = MultipartParser(params[b'boundary'], {
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': lambda data, start, end: events.append(('data', data[start:end])),
+        'on_part_end': lambda: events.append(('end', None))
+    })
+    name = None
+    file = None
+    sha256 = None
+    size = 0
+    pending = []  # file data not written yet, written a chunk at a time
+    pending_size = 0
+    field_value = bytearray()
+
+    async def flush():
+        nonlocal pending, pending_size
+        if pending:
+            await run_in_threadpool(file.write, b''.join(pending))
+            pending, pending_size = [], 0
+
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                raise InvalidUploadError(f"Malformed multipart body: {e}")
+            for event, data in events:
+                if event == 'headers':
+                    _, options = parse_options_header(data.get(b'content-disposition', b''))
+                    name = options.get(b'name', b'').decode()
+                    if b'filename' not in options:
+                        field_value = bytearray()
+                        continue
+                    if name not in file_limits:
+                        raise InvalidUploadError(f"Unexpected file {name}")
+                    # never trust a client supplied path
+                    file_name = os.path.basename(options[b'filename'].decode()) or name
+                    fd, tmp_path = tempfile.mkstemp(dir=form.dest_dir, prefix=f".{file_name}.", suffix=".part")
+                    form.tmp_paths.append(tmp_path)
+                    file = os.fdopen(fd, "wb")
+                    form.files[name] = ReceivedFile(tmp_path=tmp_path, file_name=file_name, sha256='', size=0)
+                    sha256 = hashlib.sha256()
+                    size = 0
+                elif event == 'data' and file is not None:
+                    size += len(data)
+                    if size > file_limits[name]:
+                        raise UploadTooLargeError(
+                            f"{name} exceeds the maximum upload size of {file_limits[name]} bytes")
+                    sha256.update(data)
+                    pending.append(data)
+                    pending_size += len(data)
+                    if pending_size >= UPLOAD_CHUNK_SIZE:
+                        await flush()
+                elif event == 'data':
+                    field_value += data
+                    if len(field_value) > MAX_FORM_FIELD_BYTES:
+                        raise UploadTooLargeError(f"Form field {name} exceeds {MAX_FORM_FIELD_BYTES} bytes")
+                elif event == 'end' and file is not None:
+                    await flush()
+                    await run_in_threadpool(file.close)
+                    file = None
+                    form.files[name].sha256 = sha256.hexdigest()
+                    form.files[name].size = size
+                elif event == 'end':
+                    form.fields[name] = field_value.decode()
+            events.clear()
+        parser.finalize()
+        if file is not None:
+            raise InvalidUploadError(f"The body ended in the middle of {name}")
+    finally:
+        if file is not None:
+            file.close()
+
+
+@asynccontextmanager
+async def receive_form(request: Request, dest_dir: str, file_limits: dict[str, int]):
+    """
+    Read a multipart form from the request body as it arrives, without blocking the event loop. Its files are
+    written once, straight to dest_dir, instead of being spooled to a temp file first and copied from there.
+    Received files that are not stored by the end of the block are deleted.
+    :param request: The request.
+    :param dest_dir: The directory to store the files in.
+    :param file_limits: The maximum size of every file the form may contain, by form field.
+    :raises UploadTooLargeError: if the body, a file or a field is too large, before reading the body when the
+                                 declared Content-Length already is.
+    :raises InvalidUploadError: if the body is not a well-formed multipart form.
+    """
+    content_length = request.headers.get('content-length', '')
+    max_bytes = sum(file_limits.values()) + MAX_FORM_OVERHEAD_BYTES
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise UploadTooLargeError(f"The request body of {content_length} bytes exceeds {max_bytes} bytes")
+    os.makedirs(dest_dir, exist_ok=True)
+    form = MultipartForm(dest_dir)
+    try:
+        await _read_form(request, form, file_limits)
+        yield form
+    finally:
+        form.discard()
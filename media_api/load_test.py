@@ -0,0 +1,287 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: load_test.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/18/26 00:50
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+import httpx
+import numpy as np
+
+import main
+from JobStore import format_job
+
+SIZE_UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+# how often the event loop is checked for blocking
+LOOP_LAG_INTERVAL = 0.01
+
+
+class InMemoryPublisher:
+    """
+    Stands in for RabbitMQPublisher, publishing takes latency seconds, like waiting for the broker's confirm.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.published = Counter()
+        self.backlog = asyncio.Queue()
+
+    async def publish(self, routing_key: str, message: dict, priority: int | None = None):
+        await asyncio.sleep(self.latency)
+        self.published[routing_key] += 1
+
+
+class InMemoryJobStore:
+    """
+    Stands in for the redis JobStore, every call takes latency seconds, like a redis round trip.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.jobs: dict[str, dict] = {}
+        self.idempotency_keys: dict[str, str] = {}
+
+    async def close(self):
+        pass
+
+    async def claim(self, idempotency_key: str, job_id: str) -> str | None:
+        await asyncio.sleep(self.latency)
+        existing_job_id = self.idempotency_keys.get(idempotency_key)
+        if existing_job_id is not None and self.jobs.get(existing_job_id, {}).get('status') != 'failed':
+            return existing_job_id
+        self.idempotency_keys[idempotency_key] = job_id
+        return None
+
+    async def release(self, idempotency_key: str, job_id: str):
+        await asyncio.sleep(self.latency)
+        if self.idempotency_keys.get(idempotency_key) == job_id:
+            del self.idempotency_keys[idempotency_key]
+
+    async def create_job(self, job_id: str, task_type: str, thread_id: str):
+        await asyncio.sleep(self.latency)
+        self.jobs[job_id] = {'job_id': job_id, 'task_type': task_type, 'thread_id': thread_id,
+                             'status': 'queued', 'created_at': time.time()}
+
+    async def get_jobs(self, job_ids: list[str]) -> dict[str, dict | None]:
+        await asyncio.sleep(self.latency)
+        return {job_id: format_job(self.jobs[job_id]) if job_id in self.jobs else None for job_id in job_ids}
+
+
+class UploadBody(io.RawIOBase):
+    """
+    A shared payload followed by a unique tail, read without copying the payload, so every request uploads
+    new content without the load generator allocating a body per request.
+    """
+
+    def __init__(self, payload: memoryview, tail: bytes):
+        self.parts = [payload, memoryview(tail)]
+        self.size = len(payload) + len(tail)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        written = 0
+        part_start = 0
+        for part in self.parts:
+            part_end = part_start + len(part)
+            if self.position < part_end and written < len(buffer):
+                count = min(len(buffer) - written, part_end - self.position)
+                offset = self.position - part_start
+                buffer[written:written + count] = part[offset:offset + count]
+                written += count
+                self.position += count
+            part_start = part_end
+        return written
+
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+
+def format_size(size: float) -> str:
+    for unit, factor in reversed(SIZE_UNITS.items()):
+        if size >= factor:
+            return f"{size / factor:.1f}{unit}"
+    return f"{size:.0f}B"
+
+
+async def monitor_loop_lag(lags: list[float], stop: asyncio.Event):
+    """
+    Record how late every short sleep wakes up, which is how long something blocked the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started_at = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lags.append(loop.time() - started_at - LOOP_LAG_INTERVAL)
+
+
+def audio_request(payload: memoryview, metadata: bytes, token: str) -> dict:
+    tail = uuid.uuid4().bytes
+    return {
+        'url': "/new_audio_processing_task",
+        'data': {'thread_id': uuid.uuid4().hex, 'ws_sid': "load_test", 'dynamic_auth_token': token},
+        'files': {'metadata_file': ("metadata.json", metadata, "application/json"),
+                  'wav_file': ("recording.wav", UploadBody(payload, tail), "audio/wav")}
+    }
+
+
+def feedback_request(payload: memoryview, token: str) -> dict:
+    tail = uuid.uuid4().hex.encode()
+    return {
+        'url': "/new_feedback_processing_task",
+        'data': {'thread_id': uuid.uuid4().hex, 'agent_id': "load_test", 'step_id': "0", 'dynamic_auth_token': token},
+        'files': {'messages_file': ("messages.json", UploadBody(payload, tail), "application/json")}
+    }
+
+
+async def run_scenario(client: httpx.AsyncClient, make_request, requests: int, concurrency: int,
+                       trace_memory: bool) -> dict:
+    """
+    Send requests built by make_request, concurrency of them at a time.
+    :return: The latencies, statuses, event loop lag and, with trace_memory, the traced allocation peak.
+    """
+    latencies = []
+    statuses = Counter()
+    lags = []
+    stop = asyncio.Event()
+    pending = iter(range(requests))
+
+    async def user():
+        for _ in pending:
+            request = make_request()
+            started_at = time.perf_counter()
+            response = await client.post(request['url'], data=request['data'], files=request['files'])
+            latencies.append(time.perf_counter() - started_at)
+            statuses[response.status_code] += 1
+
+    if trace_memory:
+        tracemalloc.start()
+    monitor = asyncio.create_task(monitor_loop_lag(lags, stop))
+    started_at = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    wall_time = time.perf_counter() - started_at
+    stop.set()
+    await monitor
+    memory_peak = None
+    if trace_memory:
+        memory_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'requests': requests,
+        'wall_time': wall_time,
+        'rps': requests / wall_time,
+        'p50': float(np.percentile(latencies, 50)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(np.max(latencies)),
+        'loop_lag_p99': float(np.percentile(lags, 99)) if lags else 0.0,
+        'loop_lag_max': float(np.max(lags)) if lags else 0.0,
+        'statuses': dict(statuses),
+        # allocations of the load generator are traced too, it only holds 64KiB chunks of every body
+        'memory_peak_per_request': memory_peak / concurrency if memory_peak is not None else None
+    }
+
+
+async def run_load_test(args) -> list[dict]:
+    # uploads are stored relative to the working directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="prepit_load_test_")
+    os.chdir(workdir)
+    main.app.state.publisher = InMemoryPublisher(args.broker_latency)
+    main.app.state.job_store = InMemoryJobStore(args.redis_latency)
+    token = (await main.generate_dynamic_auth_code())[1]
+    rng = np.random.default_rng(0)
+    metadata = json.dumps({'audio_timestamps': [], 'audio_pause_timestamps': [], 'user_msg_timestamps': {}}).encode()
+    scenarios = [(f"audio {format_size(size)}", size,
+                  lambda payload: audio_request(payload, metadata, token)) for size in args.sizes]
+    scenarios.append((f"feedback {format_size(args.messages_size)}", args.messages_size,
+                      lambda payload: feedback_request(payload, token)))
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=None) as client:
+        try:
+            for name, size, build in scenarios:
+                payload = memoryview(rng.integers(0, 256, size, dtype=np.uint8).tobytes())
+                result = await run_scenario(client, lambda: build(payload), args.requests, args.concurrency, False)
+                if args.memory:
+                    # a separate pass, tracing allocations slows everything down
+                    traced = await run_scenario(client, lambda: build(payload), args.concurrency, args.concurrency,
+                                                True)
+                    result['memory_peak_per_request'] = traced['memory_peak_per_request']
+                results.append({'scenario': name, 'size': size, **result})
+                shutil.rmtree(main.UNPROCESSED_MEDIA_DIR, ignore_errors=True)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_report(results: list[dict], concurrency: int):
+    print(f"\nconcurrency {concurrency}")
+    print(f"{'scenario':<18}{'rps':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'lag p99':>10}{'lag max':>10}"
+          f"{'mem/req':>10}  statuses")
+    for result in results:
+        memory = result['memory_peak_per_request']
+        milliseconds = "".join(f"{result[key] * 1000:>10.1f}"
+                               for key in ('p50', 'p99', 'max', 'loop_lag_p99', 'loop_lag_max'))
+        print(f"{result['scenario']:<18}{result['rps']:>9.1f}{milliseconds}"
+              f"{format_size(memory) if memory is not None else '-':>10}  {result['statuses']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the task endpoints with concurrent multipart uploads, "
+                                                 "against the app in process with in-memory broker and redis.")
+    parser.add_argument("--sizes", default="1MB,16MB,64MB", help="comma separated audio upload sizes")
+    parser.add_argument("--messages-size", default="32KB", help="size of the feedback messages file")
+    parser.add_argument("--requests", type=int, default=200, help="requests per upload size")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--broker-latency", type=float, default=0.002, help="seconds per publish confirm")
+    parser.add_argument("--redis-latency", type=float, default=0.0005, help="seconds per job store call")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the allocation tracing pass")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args(argv)
+    args.sizes = [parse_size(size) for size in args.sizes.split(",")]
+    args.messages_size = parse_size(args.messages_size)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # every request would be logged otherwise
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run_load_test(args))
+    print_report(results, args.concurrency)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -6,12 +6,21 @@
 @email: rxy216@case.edu
 @time: 6/26/24 15:58
 """
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-import pika
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, UploadFile, Form, Header, Query, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.concurrency import run_in_threadpool
 import json
 import os
 import time
 import hashlib
+from RabbitMQPublisher import RabbitMQPublisher, PublisherBacklogFullError
+from UploadHandler import receive_form, UploadTooLargeError, InvalidUploadError
+from JobStore import JobStore, new_job_id
+from EventStream import thread_event_stream
+from SessionSpool import SessionSpool, InvalidSessionError, SessionOffsetError
+from Metrics import REQUEST_DURATION, JOBS_SUBMITTED, PUBLISHER_BACKLOG
 
 import logging
 
@@ -20,53 +29,123 @@ logging.basicConfig(
     format='%(levelname)s:     %(name)s - %(message)s'
 )
 
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
-
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
-RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "prepit_processing")
+REDIS_ADDRESS = os.getenv("REDIS_ADDRESS", "redis")
+RABBITMQ_AUDIO_QUEUE = os.getenv("RABBITMQ_AUDIO_QUEUE", "prepit_audio_processing")
+RABBITMQ_FEEDBACK_QUEUE = os.getenv("RABBITMQ_FEEDBACK_QUEUE", "prepit_feedback_processing")
+RABBITMQ_MAX_PRIORITY = int(os.getenv("RABBITMQ_MAX_PRIORITY", "10"))
+# priorities only order the tasks of one queue. Fresh tasks go ahead of retries, which the worker republishes
+# at priority 0, and a user waits on whole recordings and finalized sessions, not on incremental session exports
+TASK_PRIORITY = int(os.getenv("TASK_PRIORITY", "5"))
+SESSION_INCREMENTAL_TASK_PRIORITY = int(os.getenv("SESSION_INCREMENTAL_TASK_PRIORITY", "1"))
+RABBITMQ_CHANNEL_POOL_SIZE = int(os.getenv("RABBITMQ_CHANNEL_POOL_SIZE", "8"))
+RABBITMQ_PUBLISH_BACKLOG_SIZE = int(os.getenv("RABBITMQ_PUBLISH_BACKLOG_SIZE", "1000"))
 UNPROCESSED_MEDIA_DIR = "./unprocessed_media"
+MAX_AUDIO_UPLOAD_BYTES = int(os.getenv("MAX_AUDIO_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+MAX_METADATA_UPLOAD_BYTES = int(os.getenv("MAX_METADATA_UPLOAD_BYTES", str(32 * 1024 * 1024)))
+MAX_JOB_STATUS_BATCH = 100
+SESSION_SPOOL_DIR = f"{UNPROCESSED_MEDIA_DIR}/sessions"
+MAX_SESSION_CHUNK_BYTES = int(os.getenv("MAX_SESSION_CHUNK_BYTES", str(16 * 1024 * 1024)))
+# bearer token prometheus scrapes /metrics with, the endpoint is open if unset
+METRICS_AUTH_TOKEN = os.getenv("METRICS_AUTH_TOKEN", "")
+
+
+@asynccontextmanager
+async def lifespan(fastapi_app: FastAPI):
+    # one publisher per process, shared by every request
+    queue_arguments = {'x-max-priority': RABBITMQ_MAX_PRIORITY}
+    publisher = RabbitMQPublisher(RABBITMQ_HOST,
+                                  {RABBITMQ_AUDIO_QUEUE: queue_arguments, RABBITMQ_FEEDBACK_QUEUE: queue_arguments},
+                                  channel_pool_size=RABBITMQ_CHANNEL_POOL_SIZE,
+                                  backlog_size=RABBITMQ_PUBLISH_BACKLOG_SIZE)
+    await publisher.start()
+    fastapi_app.state.publisher = publisher
+    PUBLISHER_BACKLOG.set_function(publisher.backlog.qsize)
+    fastapi_app.state.job_store = JobStore(REDIS_ADDRESS)
+    yield
+    await publisher.close()
+    await fastapi_app.state.job_store.close()
 
 
-async def send_audio_to_queue(file_name, metadata_name):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
-    channel = connection.channel()
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None, lifespan=lifespan)
+session_spool = SessionSpool(SESSION_SPOOL_DIR)
 
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
 
-    message = json.dumps({
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started_at = time.perf_counter()
+    response = await call_next(request)
+    # the route template, not the path, so the job and session IDs do not each get their own series
+    route = request.scope.get('route')
+    REQUEST_DURATION.labels(request.method, route.path if route else 'unmatched',
+                            response.status_code).observe(time.perf_counter() - started_at)
+    return response
+
+
+async def send_audio_to_queue(job_id, file_name, metadata_name):
+    await app.state.publisher.publish(RABBITMQ_AUDIO_QUEUE, {
         'task_type': 'audio_processing',  # 'audio_processing' or 'feedback_processing'
+        'job_id': job_id,
         'file_name': file_name,
         'metadata_name': metadata_name
-    })
-    channel.basic_publish(exchange='',
-                          routing_key=RABBITMQ_QUEUE,
-                          body=message,
-                          properties=pika.BasicProperties(
-                              delivery_mode=2,  # make message persistent
-                          ))
-    connection.close()
-
+    }, priority=TASK_PRIORITY)
 
-async def send_feedback_to_queue(messages_filename, thread_id, agent_id, step_id):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
-    channel = connection.channel()
 
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
-
-    message = json.dumps({
+async def send_feedback_to_queue(job_id, messages_filename, thread_id, agent_id, step_id):
+    await app.state.publisher.publish(RABBITMQ_FEEDBACK_QUEUE, {
         'task_type': 'feedback_processing',  # 'audio_processing' or 'feedback_processing
+        'job_id': job_id,
         'messages_filename': messages_filename,
         'thread_id': thread_id,
         'agent_id': agent_id,
         'step_id': step_id
-    })
-    channel.basic_publish(exchange='',
-                          routing_key=RABBITMQ_QUEUE,
-                          body=message,
-                          properties=pika.BasicProperties(
-                              delivery_mode=2,  # make message persistent
-                          ))
-    connection.close()
+    }, priority=TASK_PRIORITY)
+
+
+async def send_session_to_queue(job_id, session_id, final):
+    await app.state.publisher.publish(RABBITMQ_AUDIO_QUEUE, {
+        'task_type': 'audio_session',
+        'job_id': job_id,
+        'session_id': session_id,
+        'final': final
+    }, priority=TASK_PRIORITY if final else SESSION_INCREMENTAL_TASK_PRIORITY)
+
+
+def content_idempotency_key(*parts) -> str:
+    """
+    Derive an idempotency key from the request content, for clients that do not send one.
+    """
+    return hashlib.sha256("\x00".join(str(part) for part in parts).encode()).hexdigest()
+
+
+async def enqueue_job(idempotency_key: str, task_type: str, thread_id: str, send,
+                      job_id: str | None = None) -> tuple[str, bool]:
+    """
+    Queue a job once per idempotency key.
+    :param idempotency_key: The idempotency key of the request.
+    :param task_type: 'audio_processing', 'audio_session' or 'feedback_processing'.
+    :param thread_id: The thread the job belongs to.
+    :param send: Coroutine function publishing the job's message, called with the job ID.
+    :param job_id: The ID of the job, a new random one if not given.
+    :return: The ID of the job, and whether it is a duplicate of an existing one.
+    """
+    job_store = app.state.job_store
+    job_id = job_id or new_job_id()
+    existing_job_id = await job_store.claim(idempotency_key, job_id)
+    if existing_job_id is not None:
+        logging.info(f"Duplicate {task_type} request, returning existing job {existing_job_id}")
+        JOBS_SUBMITTED.labels(task_type, 'duplicate').inc()
+        return existing_job_id, True
+    try:
+        await job_store.create_job(job_id, task_type, thread_id)
+        await send(job_id)
+    except BaseException:
+        JOBS_SUBMITTED.labels(task_type, 'failed').inc()
+        # let the client's retry queue the job again
+        await job_store.release(idempotency_key, job_id)
+        raise
+    JOBS_SUBMITTED.labels(task_type, 'queued').inc()
+    return job_id, False
 
 
 async def generate_dynamic_auth_code():
@@ -89,67 +168,298 @@ async def generate_dynamic_auth_code():
 
 @app.post("/new_audio_processing_task")
 async def audio_processing_task(
-        metadata_file: UploadFile = File(...),
-        wav_file: UploadFile = File(...),
-        thread_id: str = Form(...),
-        ws_sid: str = Form(...),
-        dynamic_auth_token: str = Form(...)
+        request: Request,
+        idempotency_key_header: str | None = Header(None, alias="Idempotency-Key")
 ):
-    # Validate the dynamic auth token
-    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
-    if dynamic_auth_token not in expected_dynamic_auth_tokens:
-        return HTTPException(status_code=401, detail="Access Denied")
+    """
+    A multipart form of metadata_file, wav_file, thread_id, ws_sid, dynamic_auth_token and an optional
+    idempotency_key. The form is read from the body as it arrives, the recording is written to disk once.
+    """
     try:
-        # Save metadata file
-        metadata_path = os.path.join(UNPROCESSED_MEDIA_DIR, metadata_file.filename)
-        with open(metadata_path, "wb") as f:
-            f.write(await metadata_file.read())
+        async with receive_form(request, UNPROCESSED_MEDIA_DIR, {'metadata_file': MAX_METADATA_UPLOAD_BYTES,
+                                                                 'wav_file': MAX_AUDIO_UPLOAD_BYTES}) as form:
+            # Validate the dynamic auth token
+            expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+            if form.fields.get('dynamic_auth_token') not in expected_dynamic_auth_tokens:
+                raise HTTPException(status_code=401, detail="Access Denied")
+            thread_id = form.field('thread_id')
+            ws_sid = form.field('ws_sid')
 
-        # Save wav file
-        wav_file_path = os.path.join(UNPROCESSED_MEDIA_DIR, wav_file.filename)
-        with open(wav_file_path, "wb") as f:
-            f.write(await wav_file.read())
+            # Save metadata file
+            metadata = await form.store('metadata_file', content_addressed=True)
 
-        await send_audio_to_queue(wav_file.filename, metadata_file.filename)
+            # Save wav file
+            wav = await form.store('wav_file', content_addressed=True)
 
-        return {"message": f"Audio processing queued for {wav_file.filename}, {metadata_file.filename}",
-                "wav_file_name": wav_file.filename,
-                "metadata_file_name": metadata_file.filename,
+        client_key = form.fields.get('idempotency_key') or idempotency_key_header
+        key = f"audio_processing:{thread_id}:{client_key}" if client_key else \
+            content_idempotency_key("audio_processing", thread_id, wav.sha256, metadata.sha256)
+        job_id, duplicate = await enqueue_job(
+            key, 'audio_processing', thread_id,
+            lambda queued_job_id: send_audio_to_queue(queued_job_id, wav.file_name, metadata.file_name))
+
+        return {"message": f"Audio processing {'already queued' if duplicate else 'queued'} for "
+                           f"{wav.file_name}, {metadata.file_name}",
+                "job_id": job_id,
+                "duplicate": duplicate,
+                "wav_file_name": wav.file_name,
+                "metadata_file_name": metadata.file_name,
                 "thread_id": thread_id,
                 "ws_sid": ws_sid}
+    except HTTPException:
+        raise
+    except UploadTooLargeError as e:
+        logging.error(f"Error receiving audio: {e}")
+        raise HTTPException(status_code=413, detail="Upload too large")
+    except InvalidUploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PublisherBacklogFullError as e:
+        logging.error(f"Error queueing audio: {e}")
+        raise HTTPException(status_code=503, detail="Processing queue unavailable")
     except Exception as e:
         logging.error(f"Error processing audio: {e}")
-        return HTTPException(status_code=500, detail="Error processing audio")
+        raise HTTPException(status_code=500, detail="Error processing audio")
 
 
 @app.post("/new_feedback_processing_task")
 async def feedback_processing_task(
-        messages_file: UploadFile = File(...),
+        request: Request,
+        idempotency_key_header: str | None = Header(None, alias="Idempotency-Key")
+):
+    """
+    A multipart form of messages_file, thread_id, agent_id, step_id, dynamic_auth_token and an optional
+    idempotency_key.
+    """
+    try:
+        async with receive_form(request, UNPROCESSED_MEDIA_DIR, {'messages_file': MAX_METADATA_UPLOAD_BYTES}) as form:
+            # Validate the dynamic auth token
+            expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+            if form.fields.get('dynamic_auth_token') not in expected_dynamic_auth_tokens:
+                raise HTTPException(status_code=401, detail="Access Denied")
+            thread_id = form.field('thread_id')
+            agent_id = form.field('agent_id')
+            step_id = form.field('step_id', int)
+
+            # Save messages file
+            messages = await form.store('messages_file', content_addressed=True)
+
+        client_key = form.fields.get('idempotency_key') or idempotency_key_header
+        key = f"feedback_processing:{thread_id}:{client_key}" if client_key else \
+            content_idempotency_key("feedback_processing", thread_id, agent_id, step_id, messages.sha256)
+        job_id, duplicate = await enqueue_job(
+            key, 'feedback_processing', thread_id,
+            lambda queued_job_id: send_feedback_to_queue(queued_job_id, messages.file_name, thread_id, agent_id,
+                                                         step_id))
+
+        return {"message": f"Feedback processing {'already queued' if duplicate else 'queued'} for "
+                           f"{messages.file_name}",
+                "job_id": job_id,
+                "duplicate": duplicate,
+                "messages_filename": messages.file_name,
+                "thread_id": thread_id,
+                "agent_id": agent_id,
+                "step_id": step_id}
+    except HTTPException:
+        raise
+    except UploadTooLargeError as e:
+        logging.error(f"Error receiving feedback messages: {e}")
+        raise HTTPException(status_code=413, detail="Upload too large")
+    except InvalidUploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PublisherBacklogFullError as e:
+        logging.error(f"Error queueing feedback: {e}")
+        raise HTTPException(status_code=503, detail="Processing queue unavailable")
+    except Exception as e:
+        logging.error(f"Error processing feedback: {e}")
+        raise HTTPException(status_code=500, detail="Error processing feedback")
+
+
+@app.post("/sessions/{session_id}/start")
+async def start_session(
+        session_id: str,
         thread_id: str = Form(...),
-        agent_id: str = Form(...),
-        step_id: int = Form(...),
+        ws_sid: str = Form(...),
+        audio_started_at: int = Form(...),
+        sample_rate: int = Form(...),
+        channels: int = Form(1),
+        sample_format: str = Form("pcm16"),
         dynamic_auth_token: str = Form(...)
 ):
+    """
+    Start a chunked upload of a recording that is still going on. Audio is then sent as raw interleaved
+    samples to /sessions/{session_id}/audio and metadata updates to /sessions/{session_id}/metadata,
+    clips of completed messages are exported along the way and the rest on /sessions/{session_id}/finalize.
+    """
     # Validate the dynamic auth token
     expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
     if dynamic_auth_token not in expected_dynamic_auth_tokens:
-        return HTTPException(status_code=401, detail="Access Denied")
+        raise HTTPException(status_code=401, detail="Access Denied")
     try:
-        # Save metadata file
-        metadata_path = os.path.join(UNPROCESSED_MEDIA_DIR, messages_file.filename)
-        with open(metadata_path, "wb") as f:
-            f.write(await messages_file.read())
+        session = await run_in_threadpool(session_spool.start_session, session_id, {
+            'thread_id': thread_id,
+            'ws_sid': ws_sid,
+            'audio_started_at': audio_started_at,
+            'sample_rate': sample_rate,
+            'channels': channels,
+            'sample_format': sample_format
+        })
+        return {"message": f"Session {session_id} started", "session": session}
+    except InvalidSessionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error starting session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error starting session")
 
-        await send_feedback_to_queue(messages_file.filename, thread_id, agent_id, step_id)
 
-        return {"message": f"Feedback processing queued for {messages_file.filename}",
-                "messages_filename": messages_file.filename,
-                "thread_id": thread_id,
-                "agent_id": agent_id,
-                "step_id": step_id}
+@app.post("/sessions/{session_id}/audio")
+async def session_audio(
+        session_id: str,
+        chunk: UploadFile = File(...),
+        offset: int = Form(...),
+        dynamic_auth_token: str = Form(...)
+):
+    # Validate the dynamic auth token
+    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+    if dynamic_auth_token not in expected_dynamic_auth_tokens:
+        raise HTTPException(status_code=401, detail="Access Denied")
+    try:
+        data = await chunk.read(MAX_SESSION_CHUNK_BYTES + 1)
+        if len(data) > MAX_SESSION_CHUNK_BYTES:
+            raise HTTPException(status_code=413, detail="Upload too large")
+        size = await run_in_threadpool(session_spool.write_audio, session_id, offset, data)
+        return {"session_id": session_id, "size": size}
+    except HTTPException:
+        raise
+    except SessionOffsetError as e:
+        # the client resumes from the returned offset
+        raise HTTPException(status_code=409, detail={"message": str(e), "expected_offset": e.expected_offset})
+    except InvalidSessionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logging.error(f"Error processing feedback: {e}")
-        return HTTPException(status_code=500, detail="Error processing feedback")
+        logging.error(f"Error receiving audio of session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error receiving session audio")
+
+
+@app.post("/sessions/{session_id}/metadata")
+async def session_metadata(
+        session_id: str,
+        metadata_file: UploadFile = File(...),
+        dynamic_auth_token: str = Form(...)
+):
+    # Validate the dynamic auth token
+    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+    if dynamic_auth_token not in expected_dynamic_auth_tokens:
+        raise HTTPException(status_code=401, detail="Access Denied")
+    try:
+        content = await metadata_file.read(MAX_METADATA_UPLOAD_BYTES + 1)
+        if len(content) > MAX_METADATA_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Upload too large")
+        update = json.loads(content)
+        messages_before, messages_after = await run_in_threadpool(session_spool.merge_metadata, session_id, update)
+        # a message is complete once the next one exists, only then is there something new to export
+        queued = messages_after > messages_before and messages_after > 1
+        if not queued:
+            return {"session_id": session_id, "messages": messages_after, "queued": queued}
+        session = await run_in_threadpool(session_spool.get_session, session_id)
+        # one job per message count, so a retried update neither queues the export twice nor goes untracked
+        job_id, duplicate = await enqueue_job(
+            f"audio_session:{session_id}:{messages_after}", 'audio_session', session['thread_id'],
+            lambda queued_job_id: send_session_to_queue(queued_job_id, session_id, False),
+            job_id=f"{session_id}-{messages_after}")
+        return {"session_id": session_id, "messages": messages_after, "queued": queued,
+                "job_id": job_id, "duplicate": duplicate}
+    except HTTPException:
+        raise
+    except (InvalidSessionError, ValueError, AttributeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PublisherBacklogFullError as e:
+        logging.error(f"Error queueing session {session_id}: {e}")
+        raise HTTPException(status_code=503, detail="Processing queue unavailable")
+    except Exception as e:
+        logging.error(f"Error merging metadata of session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error merging session metadata")
+
+
+@app.post("/sessions/{session_id}/finalize")
+async def finalize_session(session_id: str, dynamic_auth_token: str = Form(...)):
+    # Validate the dynamic auth token
+    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+    if dynamic_auth_token not in expected_dynamic_auth_tokens:
+        raise HTTPException(status_code=401, detail="Access Denied")
+    try:
+        session = await run_in_threadpool(session_spool.finalize, session_id)
+        job_id, duplicate = await enqueue_job(
+            f"audio_session:{session_id}", 'audio_session', session['thread_id'],
+            lambda queued_job_id: send_session_to_queue(queued_job_id, session_id, True))
+        return {"message": f"Session {session_id} {'already finalized' if duplicate else 'finalized'}",
+                "job_id": job_id,
+                "duplicate": duplicate,
+                "thread_id": session['thread_id'],
+                "ws_sid": session['ws_sid']}
+    except InvalidSessionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PublisherBacklogFullError as e:
+        logging.error(f"Error queueing session {session_id}: {e}")
+        raise HTTPException(status_code=503, detail="Processing queue unavailable")
+    except Exception as e:
+        logging.error(f"Error finalizing session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error finalizing session")
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, dynamic_auth_token: str = Query(...)):
+    # Validate the dynamic auth token
+    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+    if dynamic_auth_token not in expected_dynamic_auth_tokens:
+        raise HTTPException(status_code=401, detail="Access Denied")
+    try:
+        job = (await app.state.job_store.get_jobs([job_id]))[job_id]
+    except Exception as e:
+        logging.error(f"Error reading job {job_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error reading job status")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs")
+async def jobs_status(job_ids: list[str] = Query(...), dynamic_auth_token: str = Query(...)):
+    # Validate the dynamic auth token
+    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+    if dynamic_auth_token not in expected_dynamic_auth_tokens:
+        raise HTTPException(status_code=401, detail="Access Denied")
+    if len(job_ids) > MAX_JOB_STATUS_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_JOB_STATUS_BATCH} jobs per request")
+    try:
+        # unknown or expired jobs map to null
+        return {"jobs": await app.state.job_store.get_jobs(job_ids)}
+    except Exception as e:
+        logging.error(f"Error reading jobs: {e}")
+        raise HTTPException(status_code=500, detail="Error reading job status")
+
+
+@app.get("/events/{thread_id}")
+async def thread_events(request: Request, thread_id: str, dynamic_auth_token: str = Query(...)):
+    """
+    Server-sent events of a thread: clip_ready per uploaded clip, audio_ready once a recording is done
+    and feedback_ready with the generated feedback.
+    """
+    # Validate the dynamic auth token
+    expected_dynamic_auth_tokens = await generate_dynamic_auth_code()
+    if dynamic_auth_token not in expected_dynamic_auth_tokens:
+        raise HTTPException(status_code=401, detail="Access Denied")
+    return StreamingResponse(
+        thread_event_stream(app.state.job_store.redis_client, thread_id, request.is_disconnected),
+        media_type="text/event-stream",
+        # no caching or proxy buffering, events have to reach the client as they happen
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/metrics")
+async def metrics(authorization: str | None = Header(None)):
+    if METRICS_AUTH_TOKEN and authorization != f"Bearer {METRICS_AUTH_TOKEN}":
+        raise HTTPException(status_code=401, detail="Access Denied")
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/tttt12341234")